@@ -0,0 +1,89 @@
+"""
+Microbenchmark of the date conversion of the process step.
+
+Compares the chunk-wide conversion of tweet created_at strings and facebook created_time timestamps against the
+previous one value at a time conversion (kept below as a reference) on synthetic values spread over a year, and checks
+that both give the same dates. With --n_posts the process step also runs end to end on synthetic dumps of that size.
+
+Usage:
+    python -m benchmarks.bench_dates --n_values=200000
+    python -m benchmarks.bench_dates --n_values=200000 --n_posts=2000 --comments_per_post=100
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+from dateutil.parser import parse
+
+from benchmarks.synthetic_data import (START_TIMESTAMP, TWEET_TIME_FORMAT, YEAR_SECONDS, generate_facebook_dumps,
+                                       generate_tweet_dump)
+from src.data_processing import facebook_dates, process_data_facebook, process_data_tweet, tweet_dates
+
+COLUMNS = ('id', 'post', 'reply', 'comment', 'time_comment')
+
+
+def _legacy_tweet_dates(created_at):
+    """Previous conversion of tweet created_at strings."""
+    return [parse(value).date() for value in created_at]
+
+
+def _legacy_facebook_dates(created_time):
+    """Previous conversion of facebook created_time timestamps."""
+    return [datetime.datetime.fromtimestamp(value).date() for value in created_time]
+
+
+def generate_values(n_values, seed=0):
+    """Generate created_time timestamps and the matching created_at strings spread over a year."""
+    rng = random.Random(seed)
+    created_time = [START_TIMESTAMP + rng.randrange(YEAR_SECONDS) for _ in range(n_values)]
+    created_at = [datetime.datetime.fromtimestamp(value, datetime.timezone.utc).strftime(TWEET_TIME_FORMAT)
+                  for value in created_time]
+    return created_time, created_at
+
+
+def _timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+def _process_dumps(n_posts, comments_per_post):
+    """Time the process step on synthetic facebook and tweet dumps."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        paths = {name: os.path.join(work_dir, name) for name in ('post.json', 'comment.json', 'tweet.json',
+                                                                    'facebook.csv', 'tweet.csv')}
+        generate_facebook_dumps(paths['post.json'], paths['comment.json'], n_posts, comments_per_post)
+        generate_tweet_dump(paths['tweet.json'], n_posts, comments_per_post)
+        facebook_rows, facebook_time = _timeit(lambda: process_data_facebook(
+            paths['comment.json'], paths['post.json'], *COLUMNS, paths['facebook.csv']))
+        tweet_rows, tweet_time = _timeit(lambda: process_data_tweet(paths['tweet.json'], *COLUMNS, paths['tweet.csv']))
+    print('process facebook {:9d} rows {:8.3f}s'.format(facebook_rows, facebook_time))
+    print('process tweet    {:9d} rows {:8.3f}s'.format(tweet_rows, tweet_time))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Date conversion microbenchmark')
+    parser.add_argument('--n_values', type=int, default=200000)
+    parser.add_argument('--n_posts', type=int, help='also time the process step on synthetic dumps of that size')
+    parser.add_argument('--comments_per_post', type=int, default=100)
+    args = parser.parse_args()
+
+    created_time, created_at = generate_values(args.n_values)
+    legacy_tweet, legacy_tweet_time = _timeit(lambda: _legacy_tweet_dates(created_at))
+    tweet, tweet_time = _timeit(lambda: tweet_dates(created_at))
+    legacy_facebook, legacy_facebook_time = _timeit(lambda: _legacy_facebook_dates(created_time))
+    facebook, facebook_time = _timeit(lambda: facebook_dates(created_time))
+
+    assert list(tweet) == legacy_tweet, 'tweet dates differ from the legacy conversion'
+    assert list(facebook) == legacy_facebook, 'facebook dates differ from the legacy conversion'
+    print('{} values, dates identical'.format(args.n_values))
+    print('tweet legacy      {:.3f}s'.format(legacy_tweet_time))
+    print('tweet column      {:.3f}s  ({:.1f}x)'.format(tweet_time, legacy_tweet_time / tweet_time))
+    print('facebook legacy   {:.3f}s'.format(legacy_facebook_time))
+    print('facebook column   {:.3f}s  ({:.1f}x)'.format(facebook_time, legacy_facebook_time / facebook_time))
+
+    if args.n_posts:
+        _process_dumps(args.n_posts, args.comments_per_post)
@@ -0,0 +1,122 @@
+"""
+Benchmark of the entity query index against filtering the entity output in pandas.
+
+Generates synthetic entity dashboard rows (a long tail of entities over a year, several companies and channels) split
+into data files, indexes them, then times typical analyst questions both ways: loading the entity csv and filtering it
+in pandas as before, and querying the index. Both answers are checked to match. The update of the index with one new
+file is also timed.
+
+Usage:
+    python -m benchmarks.bench_entity_index --n_rows=1000000 --n_files=20
+"""
+import argparse
+import datetime
+import os
+import random
+import tempfile
+import time
+
+import pandas as pd
+
+from src.entity_index import EntityIndex
+from src.table_io import write_table
+
+COMPANIES = ('spacex', 'vg', 'bo')
+CHANNELS = ('tweet', 'facebook')
+TYPES = ('ORG', 'PERSON', 'GPE', 'PRODUCT', 'NORP')
+SENTIMENTS = ('1 star', '2 stars', '3 stars', '4 stars', '5 stars')
+START_DAY = datetime.date(2021, 1, 1)
+
+
+def generate_rows(n_rows, n_entities=20000, seed=0):
+    """Generate entity rows with a zipf-like entity frequency, spread over a year."""
+    rng = random.Random(seed)
+    entities = ['entity{}'.format(i) for i in range(n_entities)]
+    weights = [1 / (i + 1) for i in range(n_entities)]
+    scores = [rng.randint(1, 5) for _ in range(n_rows)]
+    return pd.DataFrame({
+        'entity': rng.choices(entities, weights, k=n_rows),
+        'type': [rng.choice(TYPES) for _ in range(n_rows)],
+        'time': [(START_DAY + datetime.timedelta(days=rng.randrange(365))).isoformat() for _ in range(n_rows)],
+        'sentiment': [SENTIMENTS[score - 1] for score in scores],
+        'score': scores,
+        'company': [rng.choice(COMPANIES) for _ in range(n_rows)],
+        'channel': [rng.choice(CHANNELS) for _ in range(n_rows)]})
+
+
+def pandas_answers(csv_path):
+    """Answer the queries the previous way, loading the entity output and filtering it."""
+    df = pd.read_csv(csv_path)
+    last_30_days = df[(df['entity'] == 'entity3') & (df['company'] == 'spacex') & (df['time'] >= '2021-12-02')
+                      & (df['time'] <= '2021-12-31')]
+    typed = df[(df['type'] == 'PERSON') & (df['company'] == 'vg') & (df['channel'] == 'tweet')
+               & (df['time'] >= '2021-06-01') & (df['time'] <= '2021-06-30')]
+    entity = df[df['entity'] == 'entity42']
+    monthly = entity.groupby(entity['time'].str[:7])['score'].agg(['size', 'sum'])
+    return {'last_30_days': len(last_30_days), 'typed': len(typed), 'monthly': monthly['size'].tolist(),
+            'monthly_score': monthly['sum'].tolist()}
+
+
+def index_answers(index):
+    """Answer the same queries with the index."""
+    last_30_days = index.query('entity3', ['spacex'], start='2021-12-02', end='2021-12-31')
+    typed = index.query(entity_type='PERSON', companies=['vg'], channels=['tweet'], start='2021-06-01',
+                        end='2021-06-30')
+    monthly = index.aggregate(['month'], 'entity42')
+    return {'last_30_days': len(last_30_days), 'typed': len(typed), 'monthly': monthly['count'].tolist(),
+            'monthly_score': monthly['score_sum'].astype(int).tolist()}
+
+
+def run_benchmark(n_rows, n_files, workdir):
+    """
+    Index synthetic entity rows and time the queries with pandas and with the index.
+
+    Returns:
+        dict: timings in seconds and the number of rows.
+    """
+    rows = generate_rows(n_rows)
+    csv_path = os.path.join(workdir, 'entity.csv')
+    write_table(rows, csv_path)
+    files = []
+    for i, part in enumerate(range(0, n_rows, -(-n_rows // n_files))):
+        path = os.path.join(workdir, 'part{}.csv'.format(i))
+        write_table(rows.iloc[part:part + -(-n_rows // n_files)], path)
+        files.append(('all', 'all', path))
+
+    def build_rows(company, channel, path):
+        return pd.read_csv(path)
+
+    index = EntityIndex(os.path.join(workdir, 'entity_index.sqlite'), 'entity_comment')
+    start = time.perf_counter()
+    index.update(files[:-1], build_rows)
+    build_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    index.update(files, build_rows)
+    update_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = pandas_answers(csv_path)
+    pandas_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = index_answers(index)
+    index_seconds = time.perf_counter() - start
+    index.close()
+    assert actual == expected, (actual, expected)
+    return {'n_rows': n_rows, 'n_files': n_files, 'build_seconds': build_seconds,
+            'update_one_file_seconds': update_seconds, 'pandas_seconds': pandas_seconds,
+            'index_seconds': index_seconds}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Entity query index benchmark')
+    parser.add_argument('--n_rows', type=int, default=1000000)
+    parser.add_argument('--n_files', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        result = run_benchmark(args.n_rows, args.n_files, workdir)
+    print('{n_rows} rows in {n_files} files'.format(**result))
+    print('index build {:.2f}s, update with one new file {:.2f}s'.format(result['build_seconds'],
+                                                                       result['update_one_file_seconds']))
+    print('three queries: pandas {:.3f}s, index {:.4f}s ({:.0f}x)'.format(
+        result['pandas_seconds'], result['index_seconds'], result['pandas_seconds'] / result['index_seconds']))
@@ -0,0 +1,215 @@
+"""
+Throughput benchmark of every pipeline step on synthetic dumps.
+
+Facebook and Twitter dumps of the given size are generated, then process, extraction, summarize_entity and
+summarize_sentiment run on them one after the other. Every step runs in a fresh process so its peak memory is its own.
+Extraction uses stub models by default so the benchmark runs offline and measures the pipeline rather than the models:
+a sentiment model with the interface of the transformers pipeline that labels texts by their word count, and a blank
+spacy pipeline with an entity ruler. Use --models=real for the models in config.py.
+
+Usage:
+    python -m benchmarks.bench_pipeline --n_posts=200 --comments_per_post=50 --output=./bench_pipeline.json
+    python -m benchmarks.bench_pipeline --format=parquet --models=real
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+import config
+from benchmarks.synthetic_data import generate_facebook_dumps, generate_tweet_dump
+
+STUB_ENTITY_PATTERNS = [('ORG', 'SpaceX'), ('ORG', 'Blue Origin'), ('ORG', 'Starship'), ('GPE', 'U.S.A')]
+
+
+class StubSentimentModel:
+    """Sentiment model with the interface of a transformers sentiment pipeline, labeling texts by their word count."""
+
+    def __init__(self, labels):
+        import torch
+
+        self._torch = torch
+        self.tokenizer = self._tokenize
+        self.model = self
+        self.name_or_path = 'stub'
+        self.config = SimpleNamespace(id2label=dict(enumerate(labels)))
+
+    def _tokenize(self, texts, padding=True, return_tensors='pt'):
+        return {'word_counts': self._torch.tensor([len(text.split()) for text in texts])}
+
+    def __call__(self, text=None, word_counts=None):
+        if text is not None:
+            label_id = len(text.split()) % len(self.config.id2label)
+            return [{'label': self.config.id2label[label_id], 'score': 1.0}]
+        one_hot = self._torch.nn.functional.one_hot(word_counts % len(self.config.id2label),
+                                                    len(self.config.id2label))
+        return SimpleNamespace(logits=one_hot.float())
+
+
+def stub_ner():
+    """Blank english spacy pipeline with an entity ruler for a few of the generated words."""
+    import spacy
+
+    nlp = spacy.blank('en')
+    ruler = nlp.add_pipe('entity_ruler')
+    ruler.add_patterns([{'label': label, 'pattern': pattern} for label, pattern in STUB_ENTITY_PATTERNS])
+    return nlp
+
+
+def _peak_rss_mb():
+    """Helper to get the peak resident memory of the current process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _count_rows(path):
+    """Helper to get the number of rows of a table."""
+    from src.table_io import read_table
+
+    return len(read_table(path, columns=[config.COMMENT_COL]))
+
+
+def _run_process(channel, paths, output):
+    from src.data_processing import process_data_facebook, process_data_tweet
+
+    columns = (config.ID_COL, config.POST_COL, config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL)
+    if channel == 'facebook':
+        return process_data_facebook(paths['comment'], paths['post'], *columns, output, config.PROCESS_CHUNK_SIZE)
+    return process_data_tweet(paths['both'], *columns, output, config.PROCESS_CHUNK_SIZE)
+
+
+def _run_extraction(input_path, output, models, chunk_size):
+    from src.open_source_sentiment_analyzer import get_text_analysis_columns
+
+    if models == 'stub':
+        sentiment_model = StubSentimentModel(list(config.TRANSFORMER_SENTIMENT_MAP))
+        ner = stub_ner()
+    else:
+        sentiment_model = config.TRANSFORMER_SENTIMENT_ANALYZER
+        ner = config.SPACY_NER
+    get_text_analysis_columns(input_path, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                              config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                              config.ENTITY_COMMENT_COL, sentiment_model, ner, config.ENTITY_BLACKLIST_SPACY,
+                              config.TRANSFORMER_SENTIMENT_MAP, output, batch_size=config.SENTIMENT_BATCH_SIZE,
+                              ner_batch_size=config.SPACY_BATCH_SIZE, TIME_COMMENT_COL=config.TIME_COMMENT_COL,
+                              chunk_size=chunk_size)
+    return _count_rows(input_path)
+
+
+def _run_summarize_entity(data_files, output):
+    from src.dashboard_data_prepare import entity_summerize
+
+    entity_summerize(data_files, config.ENTITY_COMMENT_COL, config.SENTIMENT_COL, config.SCORE_COL,
+                     config.TIME_COMMENT_COL, output)
+    return sum(_count_rows(path) for _, _, path in data_files)
+
+
+def _run_summarize_sentiment(data_files, output):
+    from src.dashboard_data_prepare import sentiment_summerize
+
+    sentiment_summerize(data_files, config.POST_COL, config.REPLY_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                        config.SCORE_COL, config.TIME_COMMENT_COL, output)
+    return sum(_count_rows(path) for _, _, path in data_files)
+
+
+def _child(func, args, queue):
+    """Run a step in the child process and send back its timing, input rows and peak memory."""
+    start = time.perf_counter()
+    rows = func(*args)
+    seconds = time.perf_counter() - start
+    queue.put({'rows': rows, 'seconds': seconds, 'rows_per_second': rows / seconds if seconds else None,
+               'peak_rss_mb': _peak_rss_mb()})
+
+
+def measure_step(func, *args):
+    """
+    Run one step in a fresh process.
+
+    Returns:
+        dict: input rows, seconds, rows per second and peak resident memory in MB of the step.
+    """
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=_child, args=(func, args, queue))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        return {'error': 'exit code {}'.format(process.exitcode)}
+    return queue.get()
+
+
+def _git_commit():
+    """Helper to get the current commit so results can be compared across commits."""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(work_dir, n_posts, comments_per_post, file_format='csv', models='stub', chunk_size=None, seed=0):
+    """
+    Generate the dumps and measure every step on them.
+
+    Returns:
+        dict: benchmark parameters and the measures of every step.
+    """
+    ext = '.' + file_format
+    paths = {'facebook': {'post': os.path.join(work_dir, 'fb_post.json'),
+                          'comment': os.path.join(work_dir, 'fb_comment.json')},
+             'tweet': {'both': os.path.join(work_dir, 'tweet.json')}}
+    generate_facebook_dumps(paths['facebook']['post'], paths['facebook']['comment'], n_posts, comments_per_post,
+                            seed=seed)
+    generate_tweet_dump(paths['tweet']['both'], n_posts, comments_per_post, seed=seed)
+
+    steps = {}
+    extracted = []
+    for channel in ('facebook', 'tweet'):
+        processed = os.path.join(work_dir, channel + '_processed' + ext)
+        steps['process_' + channel] = measure_step(_run_process, channel, paths[channel], processed)
+        output = os.path.join(work_dir, channel + '_extracted' + ext)
+        steps['extraction_' + channel] = measure_step(_run_extraction, processed, output, models, chunk_size)
+        extracted.append(('synthetic', channel, output))
+    steps['summarize_entity'] = measure_step(_run_summarize_entity, extracted, os.path.join(work_dir, 'entity' + ext))
+    steps['summarize_sentiment'] = measure_step(_run_summarize_sentiment, extracted,
+                                                os.path.join(work_dir, 'sentiment' + ext))
+
+    return {'commit': _git_commit(), 'python': platform.python_version(), 'cpu_count': os.cpu_count(),
+            'n_posts': n_posts, 'comments_per_post': comments_per_post, 'format': file_format, 'models': models,
+            'chunk_size': chunk_size, 'steps': steps}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pipeline throughput benchmark')
+    parser.add_argument('--n_posts', type=int, default=200)
+    parser.add_argument('--comments_per_post', type=int, default=50)
+    parser.add_argument('--format', choices=['csv', 'parquet'], default='csv', help='intermediate file format')
+    parser.add_argument('--models', choices=['stub', 'real'], default='stub', help='extraction models')
+    parser.add_argument('--chunk_size', type=int, default=config.EXTRACTION_CHUNK_SIZE,
+                        help='extraction chunk size, 0 to analyze the whole input at once')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--work_dir', help='Directory for the generated dumps and outputs, a temporary one if unset')
+    parser.add_argument('--output', help='Path to save the results as json')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        work_dir = args.work_dir or temporary_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = run_benchmark(work_dir, args.n_posts, args.comments_per_post, args.format, args.models,
+                                args.chunk_size, args.seed)
+
+    for step, result in results['steps'].items():
+        if 'error' in result:
+            print('{:<24} failed: {}'.format(step, result['error']))
+        else:
+            print('{:<24} {:9d} rows {:8.2f}s {:12.0f} rows/s  peak rss {:8.1f}MB'.format(
+                step, result['rows'], result['seconds'], result['rows_per_second'] or 0, result['peak_rss_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,133 @@
+"""
+Agreement and throughput of the int8 and onnx sentiment backends against the current pytorch one.
+
+Every backend runs the same texts through get_sentiment_batch, the way extraction does. The pytorch model of the
+reference is loaded from the same local copy as the other backends, written by pipeline.py export_sentiment, so the
+comparison runs offline on identical weights. The report gives, for every backend, its texts per second and speedup
+over the reference, and its agreement with the reference: share of identical star labels, share within one star, mean
+absolute score and confidence differences, failed texts and the confusion matrix of labels.
+
+Usage:
+    python pipeline.py export_sentiment
+    python -m benchmarks.bench_sentiment_backends --n_texts=2000 --output=./bench_sentiment_backends.json
+    python -m benchmarks.bench_sentiment_backends --from_csv="./data/tweet_data_spaceX.csv" --backends=onnx
+"""
+import argparse
+import json
+import time
+
+import pandas as pd
+
+import config
+from benchmarks.bench_text_cleanup import generate_texts
+from src.open_source_sentiment_analyzer import get_sentiment_batch
+
+BACKENDS = ('int8', 'onnx')
+WARMUP_TEXTS = 16
+
+
+def load_backend(backend, model_dir, threads=None):
+    """Load the sentiment model of a backend, pytorch for the reference."""
+    if backend == 'pytorch':
+        from transformers import pipeline
+
+        return pipeline('sentiment-analysis', model=model_dir)
+    if backend == 'int8':
+        from src.sentiment_backends import load_int8_sentiment_analyzer
+
+        return load_int8_sentiment_analyzer(model_dir)
+    if backend == 'onnx':
+        from src.sentiment_backends import OnnxSentimentAnalyzer
+
+        return OnnxSentimentAnalyzer(model_dir, threads)
+    raise ValueError('unknown backend {}'.format(backend))
+
+
+def measure(model, texts, batch_size):
+    """
+    Run the texts through a sentiment model after a warm-up batch.
+
+    Returns:
+        tuple: sentiment information dictionaries, seconds.
+    """
+    get_sentiment_batch(texts[:WARMUP_TEXTS], model, config.TRANSFORMER_SENTIMENT_MAP, batch_size)
+    start = time.perf_counter()
+    results = get_sentiment_batch(texts, model, config.TRANSFORMER_SENTIMENT_MAP, batch_size)
+    return results, time.perf_counter() - start
+
+
+def agreement(reference, results):
+    """
+    Compare the sentiment results of a backend with the reference ones.
+
+    Returns:
+        dict: label agreement, agreement within one star, mean absolute score and confidence differences, failures
+            and confusion matrix (reference label to backend label counts).
+    """
+    compared = [(expected, actual) for expected, actual in zip(reference, results)
+                if expected['sentiment'] != 'N/A' and actual['sentiment'] != 'N/A']
+    confusion = pd.crosstab(pd.Series([expected['sentiment'] for expected, _ in compared], name='reference'),
+                            pd.Series([actual['sentiment'] for _, actual in compared], name='backend'))
+    count = max(len(compared), 1)
+    return {
+        'compared': len(compared),
+        'failures': sum(actual['sentiment'] == 'N/A' for actual in results),
+        'label_agreement': sum(expected['sentiment'] == actual['sentiment'] for expected, actual in compared) / count,
+        'within_one_star': sum(abs(expected['score'] - actual['score']) <= 1 for expected, actual in compared) / count,
+        'mean_abs_score_diff': sum(abs(expected['score'] - actual['score']) for expected, actual in compared) / count,
+        'mean_abs_confidence_diff': sum(abs(expected['confidence'] - actual['confidence'])
+                                        for expected, actual in compared) / count,
+        'confusion': {label: {column: int(n) for column, n in row.items() if n}
+                      for label, row in confusion.to_dict(orient='index').items()}}
+
+
+def run_benchmark(texts, model_dir, backends=BACKENDS, batch_size=32, threads=None):
+    """
+    Measure the reference and every backend on the texts and compare their results.
+
+    Returns:
+        dict: parameters and, for every backend, its throughput and agreement with the reference.
+    """
+    reference, reference_seconds = measure(load_backend('pytorch', model_dir), texts, batch_size)
+    report = {'model_dir': model_dir, 'n_texts': len(texts), 'batch_size': batch_size,
+              'backends': {'pytorch': {'seconds': reference_seconds,
+                                       'texts_per_second': len(texts) / reference_seconds}}}
+    for backend in backends:
+        results, seconds = measure(load_backend(backend, model_dir, threads), texts, batch_size)
+        report['backends'][backend] = dict(seconds=seconds, texts_per_second=len(texts) / seconds,
+                                           speedup=reference_seconds / seconds, **agreement(reference, results))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sentiment backend agreement and throughput')
+    parser.add_argument('--model_dir', default=config.SENTIMENT_MODEL_DIR,
+                        help='local copy of the model written by pipeline.py export_sentiment')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='backends compared with pytorch')
+    parser.add_argument('--n_texts', type=int, default=2000)
+    parser.add_argument('--from_csv', help='processed csv files separated by comma to take the comments from instead '
+                                           'of generating texts')
+    parser.add_argument('--batch_size', type=int, default=config.SENTIMENT_BATCH_SIZE)
+    parser.add_argument('--threads', type=int, default=config.ONNX_THREADS, help='onnxruntime intra op threads')
+    parser.add_argument('--output', help='Path to save the report as json')
+    args = parser.parse_args()
+
+    if args.from_csv:
+        texts = [str(text) for path in args.from_csv.split(',')
+                 for text in pd.read_csv(path)[config.COMMENT_COL].dropna()][:args.n_texts]
+    else:
+        texts = generate_texts(args.n_texts)
+    report = run_benchmark(texts, args.model_dir, args.backends.split(','), args.batch_size, args.threads)
+
+    print('{} texts, batch size {}'.format(report['n_texts'], report['batch_size']))
+    for backend, result in report['backends'].items():
+        line = '{:<8} {:8.3f}s {:9.1f} texts/s'.format(backend, result['seconds'], result['texts_per_second'])
+        if backend != 'pytorch':
+            line += '  {:5.2f}x  labels agree {:6.2%}  within one star {:6.2%}  mean |score diff| {:.4f}'.format(
+                result['speedup'], result['label_agreement'], result['within_one_star'],
+                result['mean_abs_score_diff'])
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
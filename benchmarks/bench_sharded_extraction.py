@@ -0,0 +1,106 @@
+"""
+Scaling benchmark of the sharded extraction with the number of workers.
+
+Synthetic Facebook dumps are processed, then extracted by a single process and by sharded extractions with an
+increasing number of worker processes. The analysis is a stub that costs a fixed time per text, standing in for the
+model calls that dominate a real extraction, so the benchmark measures how the shards spread that cost over the
+workers. Every sharded output is checked to match the single process output.
+
+Usage:
+    python -m benchmarks.bench_sharded_extraction --n_posts=200 --comments_per_post=50 --workers=1,2,4
+"""
+import argparse
+import filecmp
+import multiprocessing
+import os
+import tempfile
+import time
+
+import config
+from benchmarks.synthetic_data import generate_facebook_dumps
+from src.analysis_utils import extract_file
+from src.data_processing import process_data_facebook
+from src.open_source_sentiment_analyzer import fill_text_columns
+from src.sharded_extraction import merge_shards, run_shard_worker, split_shards
+
+SENTIMENTS = list(config.TRANSFORMER_SENTIMENT_MAP)
+
+
+class StubAnalyzer:
+    """Frame analyzer labeling texts by their word count, sleeping a fixed time per analyzed text."""
+
+    def __init__(self, seconds_per_text):
+        self.seconds_per_text = seconds_per_text
+
+    def _sentiment(self, texts):
+        time.sleep(self.seconds_per_text * len(texts))
+        labels = [SENTIMENTS[len(text.split()) % len(SENTIMENTS)] for text in texts]
+        return [{'sentiment': label, 'confidence': 1.0, 'score': config.TRANSFORMER_SENTIMENT_MAP[label]}
+                for label in labels]
+
+    def _entities(self, texts):
+        time.sleep(self.seconds_per_text * len(texts))
+        return ['{}(ORG)'.format(text.split()[0]) for text in texts]
+
+    def __call__(self, data):
+        return fill_text_columns(data, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                                 config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                                 config.ENTITY_COMMENT_COL, self._sentiment, self._entities)
+
+
+def _worker(output_path, seconds_per_text):
+    """Run one shard worker, in a process of its own."""
+    return run_shard_worker(output_path, StubAnalyzer(seconds_per_text),
+                            [config.ENTITY_POST_COL, config.ENTITY_COMMENT_COL], [config.TIME_COMMENT_COL],
+                            poll_seconds=0.1)
+
+
+def run_benchmark(work_dir, n_posts, comments_per_post, workers, shard_rows, seconds_per_text):
+    """
+    Extract the same processed data with one process and with sharded extractions.
+
+    Returns:
+        dict: rows, single process seconds, and seconds and speedup per number of workers.
+    """
+    path_post = os.path.join(work_dir, 'posts.json')
+    path_comment = os.path.join(work_dir, 'comments.json')
+    data_path = os.path.join(work_dir, 'processed.csv')
+    generate_facebook_dumps(path_post, path_comment, n_posts, comments_per_post)
+    rows = process_data_facebook(path_comment, path_post, config.ID_COL, config.POST_COL, config.REPLY_COL,
+                                 config.COMMENT_COL, config.TIME_COMMENT_COL, data_path)
+
+    single_path = os.path.join(work_dir, 'single.csv')
+    start = time.perf_counter()
+    extract_file(data_path, single_path, StubAnalyzer(seconds_per_text),
+                 [config.ENTITY_POST_COL, config.ENTITY_COMMENT_COL], [config.TIME_COMMENT_COL])
+    result = {'rows': rows, 'single_seconds': time.perf_counter() - start, 'sharded': {}}
+
+    for n_workers in workers:
+        output_path = os.path.join(work_dir, 'sharded_{}.csv'.format(n_workers))
+        start = time.perf_counter()
+        split_shards(data_path, output_path, shard_rows, config.SHARD_LEASE_SECONDS, config.SHARD_MAX_ATTEMPTS,
+                     [config.TIME_COMMENT_COL])
+        with multiprocessing.Pool(n_workers) as pool:
+            pool.starmap(_worker, [(output_path, seconds_per_text)] * n_workers)
+        merge_shards(output_path)
+        seconds = time.perf_counter() - start
+        assert filecmp.cmp(single_path, output_path, shallow=False), output_path
+        result['sharded'][n_workers] = {'seconds': seconds, 'speedup': result['single_seconds'] / seconds}
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sharded extraction scaling benchmark')
+    parser.add_argument('--n_posts', type=int, default=200)
+    parser.add_argument('--comments_per_post', type=int, default=50)
+    parser.add_argument('--workers', default='1,2,4', help='numbers of workers separated by comma')
+    parser.add_argument('--shard_rows', type=int, default=1000)
+    parser.add_argument('--ms_per_text', type=float, default=0.5, help='stub analysis time per text')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = run_benchmark(work_dir, args.n_posts, args.comments_per_post,
+                               [int(n) for n in args.workers.split(',')], args.shard_rows, args.ms_per_text / 1000)
+    print('{} rows, single process {:.2f}s'.format(result['rows'], result['single_seconds']))
+    for n_workers, timing in result['sharded'].items():
+        print('{} workers: {:.2f}s ({:.1f}x)'.format(n_workers, timing['seconds'], timing['speedup']))
@@ -0,0 +1,70 @@
+"""
+Startup benchmark of the pipeline steps.
+
+Every step is measured in a fresh interpreter: the time and peak memory it takes to import config and the modules the
+step imports, and optionally to build the models/clients it reads from config.
+
+Usage:
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --load_models
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+# modules and lazy config attributes used by each step of pipeline.py
+STEPS = {
+    'process': (['src.data_processing'], []),
+    'process_batch': (['src.data_processing'], []),
+    'extraction_open_source': (['src.open_source_sentiment_analyzer'],
+                               ['TRANSFORMER_SENTIMENT_ANALYZER', 'SPACY_NER']),
+    'extraction_azure': (['src.azure_sentiment_analyzer'], ['AZURE_TEXT_ANALYZER']),
+    'summarize_entity': (['src.dashboard_data_prepare'], []),
+    'summarize_sentiment': (['src.dashboard_data_prepare'], []),
+}
+
+_CHILD = '''
+import importlib, json, resource, time
+start = time.perf_counter()
+import config
+import src.analysis_cache, src.data_processing, src.dashboard_data_prepare
+for module in {modules!r}:
+    importlib.import_module(module)
+imported = time.perf_counter() - start
+for attribute in {attributes!r}:
+    getattr(config, attribute)
+loaded = time.perf_counter() - start
+print(json.dumps({{'import_seconds': imported, 'total_seconds': loaded,
+                  'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}}))
+'''
+
+
+def measure_step(modules, attributes):
+    """Measure one step in a fresh interpreter."""
+    completed = subprocess.run([sys.executable, '-c', _CHILD.format(modules=modules, attributes=attributes)],
+                               capture_output=True, text=True)
+    if completed.returncode != 0:
+        return {'error': completed.stderr.strip().splitlines()[-1]}
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pipeline startup benchmark')
+    parser.add_argument('--load_models', action='store_true', help='also build the models/clients each step uses')
+    parser.add_argument('--output', help='Path to save the results as json')
+    args = parser.parse_args()
+
+    results = {}
+    for step, (modules, attributes) in STEPS.items():
+        results[step] = measure_step(modules, attributes if args.load_models else [])
+        result = results[step]
+        if 'error' in result:
+            print('{:<24} failed: {}'.format(step, result['error']))
+        else:
+            print('{:<24} import {:7.3f}s  total {:7.3f}s  peak rss {:8.1f}MB'.format(
+                step, result['import_seconds'], result['total_seconds'], result['peak_rss_mb']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,81 @@
+"""
+Microbenchmark of the text cleanup of the process step.
+
+Compares the precompiled single-pass cleanup against the previous implementation (kept below as a reference) and
+checks that both give byte-identical output.
+
+Usage:
+    python -m benchmarks.bench_text_cleanup --n_texts=200000
+    python -m benchmarks.bench_text_cleanup --n_texts=200000 --from_csv="./data/tweet_data_spaceX.csv"
+"""
+import argparse
+import random
+import re
+import string
+import time
+
+import pandas as pd
+
+from src.data_processing import _text_cleanup, text_cleanup_column
+
+
+def _legacy_strip_all_entities(text):
+    """Previous implementation of _strip_all_entities."""
+    entity_prefixes = ['@', '#']
+    for separator in string.punctuation:
+        if separator not in entity_prefixes:
+            text = text.replace(separator, ' ')
+    words = []
+    for word in text.split():
+        word = word.strip()
+        if word:
+            if word[0] not in entity_prefixes:
+                words.append(word)
+    return ' '.join(words)
+
+
+def _legacy_text_cleanup(text):
+    """Previous implementation of _text_cleanup."""
+    text = re.sub(r"http\S+", "", text)
+    text = _legacy_strip_all_entities(text)
+    return text
+
+
+def generate_texts(n_texts, seed=0):
+    """Generate scrape-like texts mixing words, mentions, hashtags, urls, punctuation, emojis and whitespace."""
+    rng = random.Random(seed)
+    pieces = ['launch', 'rocket', 'Congrats', 'team', 'SpaceX', 'Blue', 'Origin', "it's", 'well-done', 'U.S.A',
+              '@elonmusk', '#space', '#Starship!', 'https://t.co/abc123', 'http://x.y/z?q=1', '🚀', '😍🤣', '…', '—',
+              '(wow)', '100%', '$5', 'a/b', '\t', '\n', 'Ünïcode', '"quoted"', '[tag]', 'end.']
+    return [' '.join(rng.choice(pieces) for _ in range(rng.randint(0, 40))) for _ in range(n_texts)]
+
+
+def _timeit(func):
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Text cleanup microbenchmark')
+    parser.add_argument('--n_texts', type=int, default=200000)
+    parser.add_argument('--from_csv', help='processed csv files separated by comma to sample texts from instead of '
+                                           'generating them')
+    args = parser.parse_args()
+
+    if args.from_csv:
+        samples = [str(text) for path in args.from_csv.split(',')
+                   for column in ('post', 'comment') for text in pd.read_csv(path)[column].dropna()]
+        texts = [samples[i % len(samples)] for i in range(args.n_texts)]
+    else:
+        texts = generate_texts(args.n_texts)
+    legacy, legacy_time = _timeit(lambda: [_legacy_text_cleanup(text) for text in texts])
+    per_text, per_text_time = _timeit(lambda: [_text_cleanup(text) for text in texts])
+    column, column_time = _timeit(lambda: text_cleanup_column(pd.Series(texts)))
+
+    assert per_text == legacy, 'per text cleanup output differs from the legacy implementation'
+    assert column.tolist() == legacy, 'column cleanup output differs from the legacy implementation'
+    print('{} texts, outputs byte-identical'.format(len(texts)))
+    print('legacy      {:.3f}s'.format(legacy_time))
+    print('per text    {:.3f}s  ({:.1f}x)'.format(per_text_time, legacy_time / per_text_time))
+    print('column mode {:.3f}s  ({:.1f}x)'.format(column_time, legacy_time / column_time))
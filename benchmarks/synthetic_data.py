@@ -0,0 +1,147 @@
+"""
+Synthetic scrape generators for the benchmarks.
+
+The dumps have the shapes process_data_facebook and process_data_tweet parse: the Facebook GraphQL timeline feed (posts)
+and display comments (comments) responses, and the Twitter threaded_conversation_with_injections response. They are
+written one element at a time so their size is only bounded by the disk.
+
+Usage:
+    python -m benchmarks.synthetic_data --channel=tweet --n_posts=1000 --comments_per_post=50 --output=./tweets.json
+"""
+import argparse
+import datetime
+import json
+import random
+
+from benchmarks.bench_text_cleanup import generate_texts
+
+# spread comment dates over a year
+START_TIMESTAMP = int(datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc).timestamp())
+YEAR_SECONDS = 365 * 24 * 3600
+TWEET_TIME_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+
+
+def _write_json_array(path, elements):
+    """Helper to write a json array one element at a time."""
+    with open(path, 'w') as f:
+        f.write('[')
+        for i, element in enumerate(elements):
+            if i:
+                f.write(',')
+            json.dump(element, f)
+        f.write(']')
+
+
+def _texts(rng, n_texts):
+    """Helper to get scrape-like texts from a seeded generator."""
+    return generate_texts(n_texts, seed=rng.random())
+
+
+def _facebook_post(post_id, text, comment_count):
+    """Helper to build one edge of the timeline feed response."""
+    return {'node': {
+        'feedback': {'id': post_id},
+        'comet_sections': {
+            'content': {'story': {'comet_sections': {'message': {'story': {'message': {'text': text}}}}}},
+            'feedback': {'story': {'feedback_context': {'feedback_target_with_context': {'ufi_renderer': {
+                'feedback': {'comment_count': {'total_count': comment_count}}}}}}}}}}
+
+
+def _facebook_comment(post_id, text, created_time):
+    """Helper to build one edge of the display comments response."""
+    return {'node': {'body': {'text': text}, 'created_time': created_time, 'parent_feedback': {'id': post_id}}}
+
+
+def generate_facebook_dumps(path_post, path_comment, n_posts, comments_per_post, posts_per_page=10, seed=0):
+    """
+    Write synthetic Facebook post and comment dumps.
+
+    Args:
+        path_post (str): output path of the post dump.
+        path_comment (str): output path of the comment dump.
+        n_posts (int): number of posts.
+        comments_per_post (int): number of comments of every post.
+        posts_per_page (int): number of posts per timeline feed response.
+        seed (int): random seed.
+
+    Returns:
+        int: number of comments written.
+    """
+    rng = random.Random(seed)
+    post_ids = ['feedback:{}'.format(i) for i in range(n_posts)]
+    post_texts = _texts(rng, n_posts)
+
+    def post_pages():
+        for start in range(0, n_posts, posts_per_page):
+            yield {'data': {'node': {'timeline_feed_units': {'edges': [
+                _facebook_post(post_ids[i], post_texts[i], comments_per_post)
+                for i in range(start, min(start + posts_per_page, n_posts))]}}}}
+
+    def comment_pages():
+        for post_id in post_ids:
+            texts = _texts(rng, comments_per_post)
+            yield {'data': {'feedback': {'display_comments': {'edges': [
+                _facebook_comment(post_id, text, START_TIMESTAMP + rng.randrange(YEAR_SECONDS)) for text in texts]}}}}
+
+    _write_json_array(path_post, post_pages())
+    _write_json_array(path_comment, comment_pages())
+    return n_posts * comments_per_post
+
+
+def _tweet_legacy(text, created_at, reply_count=None):
+    """Helper to build the tweet_results of one tweet."""
+    legacy = {'full_text': text, 'created_at': created_at}
+    if reply_count is not None:
+        legacy['reply_count'] = reply_count
+    return {'tweet_results': {'result': {'legacy': legacy}}}
+
+
+def _tweet_time(rng):
+    """Helper to get a random tweet created_at string."""
+    timestamp = START_TIMESTAMP + rng.randrange(YEAR_SECONDS)
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime(TWEET_TIME_FORMAT)
+
+
+def generate_tweet_dump(path, n_posts, comments_per_post, seed=0):
+    """
+    Write a synthetic Twitter conversation dump, one threaded conversation per post.
+
+    Args:
+        path (str): output path of the dump.
+        n_posts (int): number of posts.
+        comments_per_post (int): number of comments of every post.
+        seed (int): random seed.
+
+    Returns:
+        int: number of comments written.
+    """
+    rng = random.Random(seed)
+
+    def conversations():
+        for _ in range(n_posts):
+            post_text = _texts(rng, 1)[0]
+            entries = [{'content': {'itemContent': _tweet_legacy(post_text, _tweet_time(rng), comments_per_post)}}]
+            entries.extend({'content': {'items': [{'item': {'itemContent': _tweet_legacy(text, _tweet_time(rng))}}]}}
+                           for text in _texts(rng, comments_per_post))
+            yield {'data': {'threaded_conversation_with_injections': {'instructions': [{'entries': entries}]}}}
+
+    _write_json_array(path, conversations())
+    return n_posts * comments_per_post
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic scrape generator')
+    parser.add_argument('--channel', choices=['facebook', 'tweet'], required=True)
+    parser.add_argument('--n_posts', type=int, default=1000)
+    parser.add_argument('--comments_per_post', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Path of the tweet dump')
+    parser.add_argument('--path_post', help='Path of the facebook post dump')
+    parser.add_argument('--path_comment', help='Path of the facebook comment dump')
+    args = parser.parse_args()
+
+    if args.channel == 'facebook':
+        generate_facebook_dumps(args.path_post, args.path_comment, args.n_posts, args.comments_per_post,
+                                seed=args.seed)
+    else:
+        generate_tweet_dump(args.output, args.n_posts, args.comments_per_post, seed=args.seed)
@@ -1,33 +1,151 @@
-from dotenv import load_dotenv
+import functools
 import os
-from transformers import pipeline, AutoModelForTokenClassification, AutoTokenizer
-import spacy
-from azure.core.credentials import AzureKeyCredential
-from azure.ai.textanalytics import TextAnalyticsClient
+
+# Models and clients are heavy to build, so they are created on first access of the attributes below (e.g.
+# config.SPACY_NER) and cached for the rest of the process. Steps that don't use them never pay for them.
 
 # Azure analyzer init
-load_dotenv()
-cog_endpoint = os.getenv('COG_SERVICE_ENDPOINT')
-cog_key = os.getenv('COG_SERVICE_KEY')
-credential = AzureKeyCredential(cog_key)
-AZURE_TEXT_ANALYZER = TextAnalyticsClient(endpoint=cog_endpoint, credential=credential)
 ENTITY_BLACKLIST_AZURE = ['Url', 'Quantity', 'DateTime']
 AZURE_SENTIMENT_MAP = {'positive': 1, 'neutral': 0, 'negative': -1}
+# per request document limits of the service and number of concurrent requests
+AZURE_SENTIMENT_BATCH_SIZE = 10
+AZURE_ENTITY_BATCH_SIZE = 5
+AZURE_MAX_WORKERS = 4
+# per request deadline in seconds, retries of throttled/transient failures and end of run retry passes
+AZURE_TIMEOUT_SECONDS = 3.0
+AZURE_MAX_RETRIES = 3
+AZURE_RETRY_BUDGET = 1000
+AZURE_RETRY_PASSES = 1
+
+
+@functools.lru_cache(maxsize=None)
+def get_azure_text_analyzer():
+    """Build the Azure text analytics client from the .env credentials."""
+    from dotenv import load_dotenv
+    from azure.core.credentials import AzureKeyCredential
+    from azure.ai.textanalytics import TextAnalyticsClient
+
+    load_dotenv()
+    cog_endpoint = os.getenv('COG_SERVICE_ENDPOINT')
+    cog_key = os.getenv('COG_SERVICE_KEY')
+    if not cog_endpoint or not cog_key:
+        raise RuntimeError('COG_SERVICE_ENDPOINT and COG_SERVICE_KEY must be set to use the azure api')
+    credential = AzureKeyCredential(cog_key)
+    # the client does not retry on its own, retries go through the RetryPolicy of the azure analyzer
+    return TextAnalyticsClient(endpoint=cog_endpoint, credential=credential, retry_total=0)
+
 
 # Open source analyzer init
 # transformer
-TRANSFORMER_SENTIMENT_ANALYZER = pipeline("sentiment-analysis",  model="nlptown/bert-base-multilingual-uncased-sentiment")
+TRANSFORMER_SENTIMENT_MODEL = "nlptown/bert-base-multilingual-uncased-sentiment"
 TRANSFORMER_SENTIMENT_MAP = {'1 star': 1,
                              '2 stars': 2,
                              '3 stars': 3,
                              '4 stars': 4,
                              '5 stars': 5}
+SENTIMENT_BATCH_SIZE = 32
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer_sentiment_analyzer():
+    """Build the transformer sentiment pipeline."""
+    from transformers import pipeline
+
+    return pipeline("sentiment-analysis", model=TRANSFORMER_SENTIMENT_MODEL)
+
+
+# local copy of the sentiment model for the int8 and onnx backends, written by pipeline.py export_sentiment
+SENTIMENT_MODEL_DIR = './models/sentiment'
+# onnxruntime intra op threads, None for its default
+ONNX_THREADS = None
+
+
+@functools.lru_cache(maxsize=None)
+def get_int8_sentiment_analyzer():
+    """Load the local copy of the sentiment model quantized to int8."""
+    from src.sentiment_backends import load_int8_sentiment_analyzer
+
+    return load_int8_sentiment_analyzer(SENTIMENT_MODEL_DIR)
+
+
+@functools.lru_cache(maxsize=None)
+def get_onnx_sentiment_analyzer():
+    """Load the onnx export of the sentiment model."""
+    from src.sentiment_backends import OnnxSentimentAnalyzer
+
+    return OnnxSentimentAnalyzer(SENTIMENT_MODEL_DIR, ONNX_THREADS)
+
 
-# spacy ner
-SPACY_NER = spacy.load("en_core_web_lg")
+# spacy ner, only ner is kept since it has its own tok2vec layer and .ents is all we read
+SPACY_NER_MODEL = "en_core_web_lg"
+SPACY_NER_EXCLUDE = ['tok2vec', 'tagger', 'parser', 'attribute_ruler', 'lemmatizer', 'senter']
 ENTITY_BLACKLIST_SPACY = ['DATE', 'TIME', 'QUANTITY', 'CARDINAL']
+SPACY_BATCH_SIZE = 256
+SPACY_N_PROCESS = 1
 
 
+@functools.lru_cache(maxsize=None)
+def get_spacy_ner():
+    """Load the spacy ner pipeline."""
+    import spacy
+
+    return spacy.load(SPACY_NER_MODEL, exclude=SPACY_NER_EXCLUDE)
+
+
+_LAZY_ATTRIBUTES = {'AZURE_TEXT_ANALYZER': get_azure_text_analyzer,
+                    'TRANSFORMER_SENTIMENT_ANALYZER': get_transformer_sentiment_analyzer,
+                    'INT8_SENTIMENT_ANALYZER': get_int8_sentiment_analyzer,
+                    'ONNX_SENTIMENT_ANALYZER': get_onnx_sentiment_analyzer,
+                    'SPACY_NER': get_spacy_ner}
+
+
+def __getattr__(name):
+    """Build the models and clients on first access."""
+    if name in _LAZY_ATTRIBUTES:
+        return _LAZY_ATTRIBUTES[name]()
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+# pre-filter of the texts sent to the models or azure (pipeline.py extraction --no_text_filter to turn it off). Missing,
+# empty and letterless texts are skipped, so are texts shorter than TEXT_FILTER_MIN_CHARS characters and texts with
+# less than TEXT_FILTER_MIN_SCRIPT_SHARE of their letters in TEXT_FILTER_SCRIPTS (None to accept every script)
+TEXT_FILTER_MIN_CHARS = 2
+TEXT_FILTER_SCRIPTS = ('LATIN',)
+TEXT_FILTER_MIN_SCRIPT_SHARE = 0.5
+
+# number of rows the process step holds before writing them out
+PROCESS_CHUNK_SIZE = 10000
+
+# number of chunks waiting between two stages of pipeline.py run
+RUN_QUEUE_SIZE = 2
+
+# number of rows the extraction step analyzes between checkpoints
+EXTRACTION_CHUNK_SIZE = 10000
+
+# number of rows per shard of a sharded extraction, a shard is the unit of work a worker claims
+SHARD_ROWS = 50000
+# a worker renews the lease on its shard while analyzing it, the shard goes back to the queue when the lease expires
+SHARD_LEASE_SECONDS = 600
+# number of failed analyses or expired leases after which a shard is marked failed instead of going back to the queue
+SHARD_MAX_ATTEMPTS = 3
+# seconds a worker waits between two claims while the remaining shards are leased by other workers
+SHARD_POLL_SECONDS = 5
+
+# dashboard cubes, number of top entities per period and the period (pandas alias)
+CUBE_TOP_N = 10
+CUBE_PERIOD = 'M'
+
+# persistent analysis cache
+ANALYSIS_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# resident analysis worker (pipeline.py serve), the open source extraction sends its jobs there when --worker gives
+# its url. A model call waits up to WORKER_MAX_WAIT_SECONDS for concurrent requests until it has WORKER_MAX_BATCH texts
+WORKER_HOST = '127.0.0.1'
+WORKER_PORT = 8765
+WORKER_URL = 'http://{}:{}'.format(WORKER_HOST, WORKER_PORT)
+WORKER_MAX_BATCH = 256
+WORKER_MAX_WAIT_SECONDS = 0.01
+
 # Data columns
 ID_COL = 'id'
 POST_COL = 'post'
@@ -39,4 +157,3 @@ SCORE_COL = 'score'
 SENTIMENT_COL = 'sentiment'
 ENTITY_POST_COL = 'entity_post'
 ENTITY_COMMENT_COL = 'entity_comment'
-
@@ -1,63 +1,256 @@
 import argparse
+import cProfile
+import datetime
+import json
+import logging
+import pstats
+import time
 import config
-from src.data_processing import process_data_facebook, process_data_tweet
-from src.open_source_sentiment_analyzer import get_text_analysis_columns
-from src.azure_sentiment_analyzer import get_text_analysis_columns_azure
-from src.dashboard_data_prepare import entity_summerize, sentiment_summerize
+from src import metrics
+from src.analysis_cache import AnalysisCache
+from src.analysis_client import AnalysisClient, AnalysisWorkerError
+from src.table_io import PARQUET_SUFFIX, is_parquet, write_table
+from src.data_processing import process_data_facebook, process_data_tweet, process_data_batch, load_manifest
+from src.dashboard_data_prepare import entity_summerize, normalize_entity, sentiment_summerize
+from src.text_filter import TextFilter
 
-if __name__ == '__main__':
-    # arguments
-    parser = argparse.ArgumentParser(description="")
-    parser.add_argument('step', help='Which step to run',
-                        choices=['process', 'extraction', 'summarize_entity', 'summarize_sentiment'])
-    parser.add_argument('--path_post', help='Local path of post data')
-    parser.add_argument('--path_comment', help='Local path of comment data')
-    parser.add_argument('--path_both', help='Local path of comment and post data')
-    parser.add_argument('--channel', help='social media channel')
-    parser.add_argument('--entity', help='where to extract entity')
-    parser.add_argument('--api', help='text analytics api to use')
-    parser.add_argument('--input', help='Path to data')
-    parser.add_argument('--output', help='Path to save output')
-    parser.add_argument('--info_files', help='Path to information dfs')
-    parser.add_argument('--companies', help='corresponding company names')
-    parser.add_argument('--channels', help='corresponding channel names')
+# number of functions printed with --profile, the full stats are in the dump
+PROFILE_TOP_FUNCTIONS = 30
+# sentiment model of every open source api, the config attributes are only loaded when used
+SENTIMENT_BACKENDS = {'open_source': 'TRANSFORMER_SENTIMENT_ANALYZER',
+                      'open_source_int8': 'INT8_SENTIMENT_ANALYZER',
+                      'open_source_onnx': 'ONNX_SENTIMENT_ANALYZER'}
 
-    args = parser.parse_args()
 
-    # pipeline
+def text_filter(args):
+    """Get the text pre-filter of the step, None when --no_text_filter is given."""
+    if args.no_text_filter:
+        return None
+    return TextFilter(config.TEXT_FILTER_MIN_CHARS, config.TEXT_FILTER_SCRIPTS, config.TEXT_FILTER_MIN_SCRIPT_SHARE)
+
+
+def worker_client(args):
+    """Get a client of the analysis worker when one runs the api and text filter of the step, None otherwise."""
+    if not args.worker or args.api not in SENTIMENT_BACKENDS:
+        return None
+    client = AnalysisClient(args.worker)
+    try:
+        status = client.health()
+    except (OSError, ValueError, AnalysisWorkerError):
+        logging.warning('no analysis worker answers at %s, loading the models in the step', args.worker)
+        return None
+    if not isinstance(status, dict):
+        logging.warning('%s does not answer as an analysis worker, loading the models in the step', args.worker)
+        return None
+    if status.get('api') != args.api:
+        logging.info('the analysis worker at %s runs %s, not %s', args.worker, status.get('api'), args.api)
+        return None
+    step_filter = text_filter(args)
+    if status.get('text_filter') != (None if step_filter is None else step_filter.settings()):
+        logging.info('the analysis worker at %s runs another text filter', args.worker)
+        return None
+    return client
+
 
+def frame_analyzer(args, cache=None):
+    """Get the function adding the analysis columns of the api of the step to a data frame."""
+    client = worker_client(args)
+    if client is not None:
+        from src.open_source_sentiment_analyzer import fill_text_columns
+        logging.info('analyzing on the analysis worker at %s', args.worker)
+        if cache is not None:
+            logging.warning('--cache is ignored, the analysis worker uses its own cache')
+        return lambda data: fill_text_columns(data, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                                              config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                                              config.ENTITY_COMMENT_COL,
+                                              lambda texts: client.analyze(texts, ['sentiment'])['sentiment'],
+                                              lambda texts: client.analyze(texts, ['entity'])['entity'],
+                                              text_filter(args))
+    if args.api in SENTIMENT_BACKENDS:
+        from src.open_source_sentiment_analyzer import analyze_text_columns
+        sentiment_analyzer = getattr(config, SENTIMENT_BACKENDS[args.api])
+        return lambda data: analyze_text_columns(data, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                                                 config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                                                 config.ENTITY_COMMENT_COL, sentiment_analyzer, config.SPACY_NER,
+                                                 config.ENTITY_BLACKLIST_SPACY, config.TRANSFORMER_SENTIMENT_MAP,
+                                                 args.batch_size, args.ner_batch_size, args.n_process, cache,
+                                                 text_filter(args))
+    if args.api == 'azure':
+        from src.azure_sentiment_analyzer import analyze_text_columns_azure, RetryPolicy
+        retry_policy = RetryPolicy(config.AZURE_TIMEOUT_SECONDS, config.AZURE_MAX_RETRIES,
+                                   retry_budget=config.AZURE_RETRY_BUDGET)
+        return lambda data: analyze_text_columns_azure(data, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                                                       config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                                                       config.ENTITY_COMMENT_COL, config.AZURE_TEXT_ANALYZER,
+                                                       config.ENTITY_BLACKLIST_AZURE, config.AZURE_SENTIMENT_MAP, cache,
+                                                       config.AZURE_SENTIMENT_BATCH_SIZE,
+                                                       config.AZURE_ENTITY_BATCH_SIZE, args.max_workers, retry_policy,
+                                                       config.AZURE_RETRY_PASSES, text_filter(args))
+    raise ValueError('--api must be one of {}, azure'.format(', '.join(SENTIMENT_BACKENDS)))
+
+
+def run_step(args):
+    """Run the pipeline step given by the command line arguments."""
     # process data
     if args.step == 'process':
         if args.channel == 'facebook':
             process_data_facebook(args.path_comment, args.path_post, config.ID_COL, config.POST_COL,
-                                  config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL, args.output)
+                                  config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL, args.output,
+                                  config.PROCESS_CHUNK_SIZE)
         elif args.channel == 'tweet':
             process_data_tweet(args.path_both, config.ID_COL, config.POST_COL,
-                               config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL, args.output)
+                               config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL, args.output,
+                               config.PROCESS_CHUNK_SIZE)
+
+    # process every dump of a manifest in parallel
+    elif args.step == 'process_batch':
+        reports = process_data_batch(load_manifest(args.manifest), config.ID_COL, config.POST_COL, config.REPLY_COL,
+                                     config.COMMENT_COL, config.TIME_COMMENT_COL, config.PROCESS_CHUNK_SIZE,
+                                     args.workers)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(reports, f, indent=2)
+        # the other entries are written, the step still fails so schedulers see the failed ones
+        failed = ['{} {}: {}'.format(report['company'], report['channel'], report['error'])
+                  for report in reports if 'error' in report]
+        if failed:
+            raise ValueError('{} of {} manifest entries failed: {}'.format(len(failed), len(reports),
+                                                                           '; '.join(failed)))
+
+    # process, extract and summarize the dumps of a manifest in one streaming pass
+    elif args.step == 'run':
+        from src.streaming_run import streaming_run
+        cache = AnalysisCache(args.cache, config.ANALYSIS_CACHE_MAX_BYTES) if args.cache else None
+        entity_col = config.ENTITY_POST_COL if args.entity == 'post' else config.ENTITY_COMMENT_COL
+        outputs = [path for path in (args.entity_output, args.sentiment_output) if path]
+        reports = streaming_run(load_manifest(args.manifest), frame_analyzer(args, cache), config.ID_COL,
+                                config.POST_COL, config.REPLY_COL, config.COMMENT_COL, config.TIME_COMMENT_COL,
+                                config.SENTIMENT_COL, config.SCORE_COL,
+                                [config.ENTITY_POST_COL, config.ENTITY_COMMENT_COL], entity_col,
+                                entity_output=args.entity_output,
+                                sentiment_output=args.sentiment_output,
+                                cube_dir=args.cube_dir,
+                                cube_ext=PARQUET_SUFFIX if any(is_parquet(path) for path in outputs) else '.csv',
+                                top_n=args.top_n,
+                                period=args.period,
+                                chunk_size=args.chunk_size or config.PROCESS_CHUNK_SIZE,
+                                queue_size=config.RUN_QUEUE_SIZE,
+                                keep_intermediate=args.keep_intermediate)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(reports, f, indent=2)
 
     # extract sentiment and entity information
     elif args.step == 'extraction':
-        if args.api == 'open_source':
+        # a running worker already has the open source models loaded
+        client = worker_client(args)
+        if client is not None:
+            logging.info('sending the extraction to the analysis worker at %s', args.worker)
+            if args.cache:
+                logging.warning('--cache is ignored, the analysis worker uses its own cache')
+            client.extraction(args.input, args.output, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
+                              config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
+                              config.ENTITY_COMMENT_COL, TIME_COMMENT_COL=config.TIME_COMMENT_COL,
+                              incremental=args.incremental, ID_COL=config.ID_COL, chunk_size=args.chunk_size)
+            return
+        cache = AnalysisCache(args.cache, config.ANALYSIS_CACHE_MAX_BYTES) if args.cache else None
+        # analyzers pull in torch/azure, import them only for the api in use
+        if args.api in SENTIMENT_BACKENDS:
+            from src.open_source_sentiment_analyzer import get_text_analysis_columns
             get_text_analysis_columns(args.input, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
                                       config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
                                       config.ENTITY_COMMENT_COL,
-                                      config.TRANSFORMER_SENTIMENT_ANALYZER, config.SPACY_NER,
+                                      getattr(config, SENTIMENT_BACKENDS[args.api]), config.SPACY_NER,
                                       config.ENTITY_BLACKLIST_SPACY,
                                       config.TRANSFORMER_SENTIMENT_MAP,
-                                      args.output)
+                                      args.output,
+                                      batch_size=args.batch_size,
+                                      ner_batch_size=args.ner_batch_size,
+                                      n_process=args.n_process,
+                                      cache=cache,
+                                      TIME_COMMENT_COL=config.TIME_COMMENT_COL,
+                                      incremental=args.incremental,
+                                      ID_COL=config.ID_COL,
+                                      chunk_size=args.chunk_size,
+                                      text_filter=text_filter(args))
         elif args.api == 'azure':
+            from src.azure_sentiment_analyzer import get_text_analysis_columns_azure, RetryPolicy
             get_text_analysis_columns_azure(args.input, config.POST_COL, config.COMMENT_COL, config.SENTIMENT_COL,
                                             config.CONFIDENCE_COL, config.SCORE_COL, config.ENTITY_POST_COL,
                                             config.ENTITY_COMMENT_COL,
                                             config.AZURE_TEXT_ANALYZER,
                                             config.ENTITY_BLACKLIST_AZURE,
                                             config.AZURE_SENTIMENT_MAP,
-                                            args.output)
+                                            args.output,
+                                            cache=cache,
+                                            sentiment_batch_size=config.AZURE_SENTIMENT_BATCH_SIZE,
+                                            entity_batch_size=config.AZURE_ENTITY_BATCH_SIZE,
+                                            max_workers=args.max_workers,
+                                            retry_policy=RetryPolicy(config.AZURE_TIMEOUT_SECONDS,
+                                                                     config.AZURE_MAX_RETRIES,
+                                                                     retry_budget=config.AZURE_RETRY_BUDGET),
+                                            retry_passes=config.AZURE_RETRY_PASSES,
+                                            TIME_COMMENT_COL=config.TIME_COMMENT_COL,
+                                            incremental=args.incremental,
+                                            ID_COL=config.ID_COL,
+                                            chunk_size=args.chunk_size,
+                                            text_filter=text_filter(args))
+
+    # split the input of an extraction into shards for any number of workers
+    elif args.step == 'split_shards':
+        from src.sharded_extraction import split_shards
+        counts = split_shards(args.input, args.output, args.shard_rows, config.SHARD_LEASE_SECONDS,
+                              config.SHARD_MAX_ATTEMPTS, date_cols=[config.TIME_COMMENT_COL])
+        print(json.dumps(counts))
+
+    # analyze the shards of an extraction until they are all done
+    elif args.step == 'shard_worker':
+        from src.sharded_extraction import run_shard_worker
+        cache = AnalysisCache(args.cache, config.ANALYSIS_CACHE_MAX_BYTES) if args.cache else None
+        pre_filter = text_filter(args)
+        report = run_shard_worker(args.output, frame_analyzer(args, cache),
+                                  entity_cols=[config.ENTITY_POST_COL, config.ENTITY_COMMENT_COL],
+                                  date_cols=[config.TIME_COMMENT_COL],
+                                  settings={'api': args.api,
+                                            'text_filter': pre_filter.settings() if pre_filter is not None else None},
+                                  poll_seconds=config.SHARD_POLL_SECONDS,
+                                  max_shards=args.max_shards)
+        print(json.dumps(report))
 
-    # prepare dashboard data
+    # merge the analyzed shards into the extraction output
+    elif args.step == 'merge_shards':
+        from src.sharded_extraction import merge_shards
+        merge_shards(args.output)
+
+    # keep the open source models loaded and serve extraction jobs
+    elif args.step == 'serve':
+        from src.analysis_worker import AnalysisWorker, serve
+        api = args.api or 'open_source'
+        if api not in SENTIMENT_BACKENDS:
+            raise ValueError('the analysis worker serves one of the apis {}'.format(', '.join(SENTIMENT_BACKENDS)))
+        cache = AnalysisCache(args.cache, config.ANALYSIS_CACHE_MAX_BYTES) if args.cache else None
+        worker = AnalysisWorker(getattr(config, SENTIMENT_BACKENDS[api]), config.SPACY_NER,
+                                config.ENTITY_BLACKLIST_SPACY, config.TRANSFORMER_SENTIMENT_MAP,
+                                batch_size=args.batch_size,
+                                ner_batch_size=args.ner_batch_size,
+                                n_process=args.n_process,
+                                cache=cache,
+                                max_batch=config.WORKER_MAX_BATCH,
+                                max_wait=config.WORKER_MAX_WAIT_SECONDS,
+                                api=api,
+                                text_filter=text_filter(args))
+        serve(worker, args.host, args.port)
+
+    # local copy and onnx export of the sentiment model for the int8 and onnx apis
+    elif args.step == 'export_sentiment':
+        from src.sentiment_backends import export_sentiment_model
+        export_sentiment_model(config.TRANSFORMER_SENTIMENT_MODEL, args.output or config.SENTIMENT_MODEL_DIR)
+
+    # prepare dashboard data, the cubes are written in the format of the output
     elif args.step == 'summarize_entity':
         data_files = [(company, channel, path) for company, channel, path in
                       zip(args.companies.split(','), args.channels.split(','), args.info_files.split(','))]
+        cube_ext = PARQUET_SUFFIX if args.output and is_parquet(args.output) else '.csv'
 
         if args.entity == 'comment':
             entity_summerize(data_files,
@@ -65,7 +258,12 @@ if __name__ == '__main__':
                              config.SENTIMENT_COL,
                              config.SCORE_COL,
                              config.TIME_COMMENT_COL,
-                             args.output)
+                             args.output,
+                             cube_dir=args.cube_dir,
+                             top_n=args.top_n,
+                             period=args.period,
+                             cube_ext=cube_ext,
+                             index_path=args.index)
 
         elif args.entity == 'post':
             entity_summerize(data_files,
@@ -73,11 +271,48 @@ if __name__ == '__main__':
                              config.SENTIMENT_COL,
                              config.SCORE_COL,
                              config.TIME_COMMENT_COL,
-                             args.output)
+                             args.output,
+                             cube_dir=args.cube_dir,
+                             top_n=args.top_n,
+                             period=args.period,
+                             cube_ext=cube_ext,
+                             index_path=args.index)
+
+    # answer entity queries from the index written by summarize_entity --index
+    elif args.step == 'query_entity':
+        from src.entity_index import EntityIndex
+        start, end = args.since, args.until
+        entity = None
+        if args.entity_name:
+            entity = normalize_entity(args.entity_name)
+            if not isinstance(entity, str):
+                raise ValueError('nothing is left of the entity {!r} once normalized'.format(args.entity_name))
+        index = EntityIndex(args.index)
+        try:
+            if args.days:
+                # the last days of the index when no end is given, the data may stop well before today
+                end = end or index.last_day()
+                if end is not None:
+                    start = (datetime.date.fromisoformat(end) - datetime.timedelta(days=args.days - 1)).isoformat()
+            filters = dict(entity=entity,
+                           companies=args.companies.split(',') if args.companies else None,
+                           channels=args.channels.split(',') if args.channels else None,
+                           entity_type=args.entity_type, start=start, end=end)
+            if args.aggregate:
+                result = index.aggregate(args.group_by.split(',') if args.group_by else (), **filters)
+            else:
+                result = index.query(limit=args.limit, **filters)
+        finally:
+            index.close()
+        if args.output:
+            write_table(result, args.output)
+        else:
+            print(result.to_string(index=False))
 
     elif args.step == 'summarize_sentiment':
         data_files = [(company, channel, path) for company, channel, path in
                       zip(args.companies.split(','), args.channels.split(','), args.info_files.split(','))]
+        cube_ext = PARQUET_SUFFIX if args.output and is_parquet(args.output) else '.csv'
         sentiment_summerize(data_files,
                             config.POST_COL,
                             config.REPLY_COL,
@@ -85,4 +320,96 @@ if __name__ == '__main__':
                             config.SENTIMENT_COL,
                             config.SCORE_COL,
                             config.TIME_COMMENT_COL,
-                            args.output)
\ No newline at end of file
+                            args.output,
+                            cube_dir=args.cube_dir,
+                            cube_ext=cube_ext)
+
+
+if __name__ == '__main__':
+    # arguments
+    parser = argparse.ArgumentParser(description="")
+    parser.add_argument('step', help='Which step to run',
+                        choices=['process', 'process_batch', 'run', 'extraction', 'split_shards', 'shard_worker',
+                                 'merge_shards', 'serve', 'export_sentiment',
+                                 'summarize_entity', 'query_entity', 'summarize_sentiment'])
+    parser.add_argument('--path_post', help='Local path of post data')
+    parser.add_argument('--path_comment', help='Local path of comment data')
+    parser.add_argument('--path_both', help='Local path of comment and post data')
+    parser.add_argument('--channel', help='social media channel')
+    parser.add_argument('--entity', help='where to extract entity')
+    parser.add_argument('--api', help='text analytics api to use: open_source, open_source_int8, open_source_onnx or '
+                                      'azure')
+    parser.add_argument('--input', help='Path to data')
+    parser.add_argument('--output', help='Path to save output')
+    parser.add_argument('--info_files', help='Path to information dfs')
+    parser.add_argument('--companies', help='corresponding company names')
+    parser.add_argument('--channels', help='corresponding channel names')
+    parser.add_argument('--batch_size', type=int, default=config.SENTIMENT_BATCH_SIZE,
+                        help='number of comments per sentiment model batch')
+    parser.add_argument('--ner_batch_size', type=int, default=config.SPACY_BATCH_SIZE,
+                        help='number of texts per spacy batch')
+    parser.add_argument('--n_process', type=int, default=config.SPACY_N_PROCESS,
+                        help='number of spacy worker processes, -1 to use all cores')
+    parser.add_argument('--max_workers', type=int, default=config.AZURE_MAX_WORKERS,
+                        help='number of concurrent Azure requests')
+    parser.add_argument('--manifest', help='Path to the json manifest of input dumps')
+    parser.add_argument('--workers', type=int, help='number of worker processes, defaults to all cores')
+    parser.add_argument('--cache', help='Path to the sqlite analysis cache shared across runs')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only analyze the rows missing from the existing extraction output')
+    parser.add_argument('--chunk_size', type=int, default=config.EXTRACTION_CHUNK_SIZE,
+                        help='number of rows extraction analyzes between checkpoints, 0 to analyze the whole input at once')
+    parser.add_argument('--shard_rows', type=int, default=config.SHARD_ROWS,
+                        help='number of rows per shard of a sharded extraction')
+    parser.add_argument('--max_shards', type=int, help='number of shards after which a shard worker stops')
+    parser.add_argument('--no_text_filter', action='store_true',
+                        help='analyze every text, including missing, empty, too short, letterless and unsupported '
+                             'language ones')
+    parser.add_argument('--entity_output', help='Path to save the entity dashboard data of a run to')
+    parser.add_argument('--sentiment_output', help='Path to save the sentiment dashboard data of a run to')
+    parser.add_argument('--keep_intermediate', action='store_true',
+                        help='write the processed and extracted data of a run to the output and extracted paths of '
+                             'the manifest entries')
+    parser.add_argument('--cube_dir', help='Directory to write the pre-aggregated dashboard tables to')
+    parser.add_argument('--top_n', type=int, default=config.CUBE_TOP_N, help='number of top entities per period')
+    parser.add_argument('--period', default=config.CUBE_PERIOD, help='period of the top entities, e.g. D, W or M')
+    parser.add_argument('--index', help='Path to the sqlite entity query index summarize_entity updates and '
+                                        'query_entity reads')
+    parser.add_argument('--entity_name', help='entity to query, normalized as in the entity output')
+    parser.add_argument('--entity_type', help='entity type to query, e.g. ORG')
+    parser.add_argument('--since', help='first day of the queried time range, e.g. 2021-09-01')
+    parser.add_argument('--until', help='last day of the queried time range, included')
+    parser.add_argument('--days', type=int, help='number of days of the queried time range, ending on --until or on '
+                                                 'the last day of the index')
+    parser.add_argument('--aggregate', action='store_true',
+                        help='query the sentiment statistics of the matching rows instead of the rows')
+    parser.add_argument('--group_by', help='keys of the aggregate query separated by comma: entity, type, company, '
+                                           'channel, day or month')
+    parser.add_argument('--limit', type=int, help='maximum number of rows of a row query')
+    parser.add_argument('--host', default=config.WORKER_HOST, help='address the analysis worker listens on')
+    parser.add_argument('--port', type=int, default=config.WORKER_PORT, help='port the analysis worker listens on')
+    parser.add_argument('--worker',
+                        help='url of a running analysis worker to send open source extraction to, e.g. {}'.format(
+                            config.WORKER_URL))
+    parser.add_argument('--metrics', help='Path to the json lines file the step appends its metrics to')
+    parser.add_argument('--profile', help='Path to dump the cProfile stats of the step to')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(levelname)s %(message)s')
+    metrics.configure(args.metrics, step=args.step, channel=args.channel, api=args.api,
+                      input=args.input or args.path_both or args.path_comment or args.info_files, output=args.output)
+
+    profiler = cProfile.Profile() if args.profile else None
+    start = time.perf_counter()
+    status = 'failed'
+    if profiler is not None:
+        profiler.enable()
+    try:
+        run_step(args)
+        status = 'succeeded'
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        metrics.flush(status=status, seconds=time.perf_counter() - start)
@@ -0,0 +1,172 @@
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import unicodedata
+from src import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def _normalize_text(text):
+    """Helper to normalize a text before hashing it."""
+    return unicodedata.normalize('NFC', text).strip()
+
+
+def cache_version(*parts):
+    """Helper to build a version string from the model, blacklist and score map a result depends on."""
+    return '|'.join(str(part) for part in parts)
+
+
+class AnalysisCache:
+    """
+    Persistent SQLite cache of analysis results shared across runs and backends.
+
+    Entries are keyed by a sha256 hash of the normalized text, the backend, the analysis kind and a version string,
+    so changing the model or the blacklist never returns stale results. When the stored values grow over max_bytes,
+    the least recently used entries are evicted.
+
+    Args:
+        path (str): path to the sqlite database file.
+        max_bytes (int): maximum total size of the stored values.
+    """
+
+    def __init__(self, path, max_bytes=512 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        # the total size of the values is kept by triggers, so the processes sharing the file all see the same one
+        self._conn.executescript('''
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT, size INTEGER, last_used REAL);
+            CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used);
+            CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER);
+            INSERT OR IGNORE INTO total SELECT 0, COALESCE(SUM(size), 0) FROM results;
+            CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results
+                BEGIN UPDATE total SET size = size + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS results_update AFTER UPDATE OF size ON results
+                BEGIN UPDATE total SET size = size - OLD.size + NEW.size; END;
+            CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results
+                BEGIN UPDATE total SET size = size - OLD.size; END;
+            COMMIT;
+        ''')
+
+    @staticmethod
+    def key(text, backend, kind, version):
+        """Get the cache key of a text for a given backend, analysis kind and version."""
+        raw = '\x1f'.join([backend, kind, version, _normalize_text(text)])
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get_many(self, keys):
+        """
+        Look up cached results.
+
+        Args:
+            keys (list): list of cache keys.
+
+        Returns:
+            dict: mapping from the keys found in the cache to their results.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                rows = self._conn.execute('SELECT key, value FROM results WHERE key IN ({})'.format(
+                    ','.join('?' * len(chunk))), chunk).fetchall()
+                found.update((key, json.loads(value)) for key, value in rows)
+            now = time.time()
+            self._conn.executemany('UPDATE results SET last_used = ? WHERE key = ?', [(now, key) for key in found])
+            self._conn.commit()
+            self.hits += len(found)
+            self.misses += len(unique_keys) - len(found)
+        return found
+
+    def set_many(self, items):
+        """
+        Store results in the cache and evict the least recently used entries if it grew too large.
+
+        Args:
+            items (dict): mapping from cache keys to json serializable results.
+        """
+        if not items:
+            return
+        now = time.time()
+        rows = []
+        for key, value in items.items():
+            value = json.dumps(value)
+            rows.append((key, value, len(value), now))
+        with self._lock:
+            self._conn.executemany('INSERT INTO results VALUES (?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                                   'value = excluded.value, size = excluded.size, last_used = excluded.last_used', rows)
+            if self._total() > self.max_bytes:
+                self._evict()
+            self._conn.commit()
+
+    def _total(self):
+        """Helper to get the total size of the stored values, written by every process sharing the database."""
+        return self._conn.execute('SELECT size FROM total').fetchone()[0]
+
+    def _evict(self):
+        """Helper to delete the least recently used entries until the cache is back under 90% of max_bytes."""
+        excess = self._total() - self.max_bytes * 0.9
+        keys = []
+        freed = 0
+        # walk the least recently used entries only until enough is freed
+        cursor = self._conn.execute('SELECT key, size FROM results ORDER BY last_used')
+        for key, size in cursor:
+            if freed >= excess:
+                break
+            keys.append(key)
+            freed += size
+        cursor.close()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            self._conn.execute('DELETE FROM results WHERE key IN ({})'.format(','.join('?' * len(chunk))), chunk)
+        logger.info('analysis cache: evicted %d entries', len(keys))
+
+    def stats(self):
+        """Get the hit and miss counters along with the current cache size."""
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self._total()}
+
+    def close(self):
+        """Close the underlying database connection."""
+        self._conn.close()
+
+
+def cached_batch(texts, cache, backend, kind, version, analyze_batch, cacheable=lambda result: True):
+    """
+    Run a batch analyzer through the cache so only the texts missing from it are analyzed.
+
+    Args:
+        texts (list): list of target texts.
+        cache (AnalysisCache): analysis cache, or None to analyze every text.
+        backend (str): analysis backend name, e.g. open_source or azure.
+        kind (str): analysis kind, e.g. sentiment or entity.
+        version (str): version of the model and settings the results depend on.
+        analyze_batch (callable): function mapping a list of texts to a list of results in the same order.
+        cacheable (callable): predicate telling whether a result should be stored, failed results should not be.
+
+    Returns:
+        list: results in the same order as the input texts.
+    """
+    if cache is None:
+        return analyze_batch(texts)
+
+    keys = [cache.key(text, backend, kind, version) for text in texts]
+    found = cache.get_many(keys)
+    missing = [i for i, key in enumerate(keys) if key not in found]
+    metrics.increment('cache_hits', len(keys) - len(missing))
+    metrics.increment('cache_misses', len(missing))
+    results = [found.get(key) for key in keys]
+    if missing:
+        for i, result in zip(missing, analyze_batch([texts[i] for i in missing])):
+            results[i] = result
+        cache.set_many({keys[i]: results[i] for i in missing if cacheable(results[i])})
+    return results
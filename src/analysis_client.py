@@ -0,0 +1,86 @@
+import json
+import os
+import urllib.error
+import urllib.request
+
+# Thin client of the resident analysis worker (pipeline.py serve), standard library only so using it never loads the
+# models. Requests skip any http proxy since the worker is local.
+_OPENER = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+
+class AnalysisWorkerError(RuntimeError):
+    """Raised when the worker rejects or fails a job."""
+
+
+class AnalysisClient:
+    """
+    Client sending jobs to a resident analysis worker.
+
+    Args:
+        url (str): base url of the worker, e.g. http://127.0.0.1:8765.
+        timeout (float): seconds to wait for a job, None to wait as long as it takes.
+    """
+
+    def __init__(self, url, timeout=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, path, payload=None, timeout=None):
+        """Helper to send a request and get its json reply, raising AnalysisWorkerError on error replies."""
+        data = None if payload is None else json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=data, headers={'Content-Type': 'application/json'})
+        try:
+            with _OPENER.open(request, timeout=timeout or self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as error:
+            raise AnalysisWorkerError('analysis worker failed on {} ({}): {}'.format(
+                path, error.code, error.read().decode('utf-8', 'replace'))) from None
+
+    def health(self, timeout=1.0):
+        """Get the status of the worker, raising OSError when it can't be reached."""
+        return self._request('/health', timeout=timeout)
+
+    def is_running(self, timeout=1.0):
+        """Tell whether a worker answers at the url."""
+        try:
+            status = self.health(timeout)
+        except (OSError, ValueError, AnalysisWorkerError):
+            return False
+        # anything else answering at the url is not a worker
+        return isinstance(status, dict) and status.get('status') == 'ok'
+
+    def analyze(self, texts, kinds=('sentiment', 'entity'), batch_size=1000):
+        """
+        Analyze texts on the worker, batch_size texts per request.
+
+        Args:
+            texts (list): list of target texts.
+            kinds (list): analyses to run, sentiment and/or entity.
+            batch_size (int): number of texts per request.
+
+        Returns:
+            dict: mapping from every kind to its results in the same order as the texts.
+        """
+        results = {kind: [] for kind in kinds}
+        for start in range(0, len(texts), batch_size):
+            reply = self._request('/analyze', {'texts': list(texts[start:start + batch_size]), 'kinds': list(kinds)})
+            for kind in kinds:
+                results[kind].extend(reply[kind])
+        return results
+
+    def extraction(self, data_path, output_path, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL,
+                   ENTITY_POST_COL, ENTITY_COMMENT_COL, TIME_COMMENT_COL=None, incremental=False, ID_COL=None,
+                   chunk_size=None):
+        """
+        Run the extraction of a data file on the worker, see get_text_analysis_columns. The paths are sent as absolute
+        paths, the worker reads and writes them itself.
+
+        Returns:
+            dict: input and output paths.
+        """
+        return self._request('/extraction', {
+            'data_path': os.path.abspath(data_path), 'output_path': os.path.abspath(output_path),
+            'POST_COL': POST_COL, 'COMMENT_COL': COMMENT_COL, 'SENTIMENT_COL': SENTIMENT_COL,
+            'CONFIDENCE_COL': CONFIDENCE_COL, 'SCORE_COL': SCORE_COL, 'ENTITY_POST_COL': ENTITY_POST_COL,
+            'ENTITY_COMMENT_COL': ENTITY_COMMENT_COL, 'TIME_COMMENT_COL': TIME_COMMENT_COL,
+            'incremental': incremental, 'ID_COL': ID_COL, 'chunk_size': chunk_size})
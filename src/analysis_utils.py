@@ -0,0 +1,84 @@
+import logging
+from collections import Counter
+from src import metrics
+from src.chunked_extraction import chunked_extraction
+from src.incremental_extraction import incremental_extraction
+from src.table_io import read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+
+def analyze_unique(texts, analyze_batch, name='texts'):
+    """
+    Run a batch analyzer once per distinct text and broadcast the results back to every row.
+
+    Args:
+        texts (list): list of target texts, one per row.
+        analyze_batch (callable): function mapping a list of texts to a list of results in the same order.
+        name (str): name of the analyzed column used when reporting.
+
+    Returns:
+        list: results in the same order as the input texts.
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    dedup_ratio = len(texts) / len(unique_texts) if unique_texts else 1.0
+    logger.info('%s: %d rows, %d distinct texts, dedup ratio %.2fx', name, len(texts), len(unique_texts), dedup_ratio)
+    metrics.increment('texts', len(texts))
+    metrics.increment('texts_analyzed', len(unique_texts))
+
+    lookup = dict(zip(unique_texts, analyze_batch(unique_texts)))
+    return [lookup[text] for text in texts]
+
+
+def analyze_filtered(values, analyze_batch, skipped_result, text_filter=None, name='texts'):
+    """
+    Run a batch analyzer over the cells of a text column that pass a text filter, the other rows get a fixed result.
+
+    Args:
+        values (list): cells of a text column, one per row, missing cells included.
+        analyze_batch (callable): function mapping a list of texts to a list of results in the same order.
+        skipped_result: result of the skipped rows.
+        text_filter (TextFilter): filter telling which cells to skip, None to analyze every cell as its string.
+        name (str): name of the analyzed column used when reporting.
+
+    Returns:
+        list: results in the same order as the input values.
+    """
+    if text_filter is None:
+        return analyze_unique([str(value) for value in values], analyze_batch, name)
+
+    reasons = [text_filter.skip_reason(value) for value in values]
+    skipped = Counter(reason for reason in reasons if reason is not None)
+    logger.info('%s: skipped %d of %d rows %s', name, sum(skipped.values()), len(reasons), dict(skipped))
+    for reason, count in skipped.items():
+        metrics.increment('skipped_' + reason, count)
+
+    results = iter(analyze_unique([str(value) for value, reason in zip(values, reasons) if reason is None],
+                                  analyze_batch, name))
+    return [skipped_result if reason is not None else next(results) for reason in reasons]
+
+
+def extract_file(data_path, output_path, analyze, entity_cols, date_cols, incremental=False, ID_COL=None,
+                 COMMENT_COL=None, chunk_size=None):
+    """
+    Run a frame analyzer over an input table and write the output table, incrementally, in checkpointed chunks or all
+    at once.
+
+    Args:
+        data_path (str): path to data.
+        output_path (str): output path.
+        analyze (callable): function adding the analysis columns to a data frame.
+        entity_cols (list): entity columns.
+        date_cols (list): date columns.
+        incremental (bool): only analyze the rows missing from the existing output and merge them into it.
+        ID_COL (str): id column name, part of the row key in incremental mode.
+        COMMENT_COL (str): comment column name, part of the row key in incremental mode.
+        chunk_size (int): number of rows analyzed at a time with a checkpoint after each chunk, None to analyze the
+            whole data at once. Not used in incremental mode.
+    """
+    if incremental:
+        incremental_extraction(data_path, output_path, analyze, ID_COL, COMMENT_COL, entity_cols, date_cols)
+    elif chunk_size:
+        chunked_extraction(data_path, output_path, analyze, chunk_size, entity_cols, date_cols)
+    else:
+        write_table(analyze(read_table(data_path)), output_path, entity_cols, date_cols)
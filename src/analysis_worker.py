@@ -0,0 +1,329 @@
+import inspect
+import ipaddress
+import json
+import logging
+import os
+import queue
+import signal
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from src import metrics
+from src.analysis_utils import extract_file
+
+logger = logging.getLogger(__name__)
+
+# Resident analysis worker. It keeps the open source models loaded between extraction jobs and takes jobs as json over
+# http on localhost: text batches on /analyze and whole files on /extraction. Every model is only called from the
+# thread of its micro batcher, which merges the texts of all the requests waiting for it into one call, so concurrent
+# jobs share forward passes instead of taking turns.
+KINDS = ('sentiment', 'entity')
+
+
+class MicroBatcher:
+    """
+    Merge the texts of concurrent requests into shared calls of a batch analyzer, run on a thread of its own.
+
+    Args:
+        analyze_batch (callable): function mapping a list of texts to a list of results in the same order.
+        max_batch (int): number of texts after which a call starts without waiting for more requests.
+        max_wait (float): seconds a call waits for more requests after the first one comes in.
+        name (str): name of the batcher, used for its thread and metrics.
+    """
+
+    def __init__(self, analyze_batch, max_batch=256, max_wait=0.01, name='batcher'):
+        self.analyze_batch = analyze_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, texts):
+        """
+        Queue texts for the next call.
+
+        Args:
+            texts (list): list of target texts.
+
+        Returns:
+            Future: future of the results in the same order as the texts.
+        """
+        future = Future()
+        if not texts:
+            future.set_result([])
+        else:
+            self._queue.put((list(texts), future))
+        return future
+
+    def __call__(self, texts):
+        """Analyze texts along with the ones of concurrent requests, usable wherever a batch analyzer is expected."""
+        return self.submit(texts).result()
+
+    def close(self):
+        """Stop the thread once the queued requests are done."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _next_requests(self):
+        """Helper to wait for a request, then for more until the batch is full or max_wait has passed."""
+        first = self._queue.get()
+        if first is None:
+            return None
+        requests = [first]
+        size = len(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # closing, put the stop back for the next round
+                self._queue.put(None)
+                break
+            requests.append(request)
+            size += len(request[0])
+        return requests
+
+    def _run(self):
+        while True:
+            requests = self._next_requests()
+            if requests is None:
+                return
+            texts = [text for request_texts, _ in requests for text in request_texts]
+            unique_texts = list(dict.fromkeys(texts))
+            metrics.increment(self.name + '_calls')
+            metrics.increment(self.name + '_requests', len(requests))
+            metrics.increment(self.name + '_texts', len(unique_texts))
+            try:
+                with metrics.timer(self.name):
+                    results = list(self.analyze_batch(unique_texts))
+                if len(results) != len(unique_texts):
+                    raise ValueError('{} returned {} results for {} texts'.format(self.name, len(results),
+                                                                                  len(unique_texts)))
+                lookup = dict(zip(unique_texts, results))
+                responses = [[lookup[text] for text in request_texts] for request_texts, _ in requests]
+            except Exception as exception:
+                # the requests fail, the thread keeps serving the next ones
+                for _, future in requests:
+                    future.set_exception(exception)
+                continue
+            for (_, future), response in zip(requests, responses):
+                future.set_result(response)
+
+
+class AnalysisWorker:
+    """
+    Open source models kept loaded between jobs, called through one micro batcher per model.
+
+    Args:
+        transformer_sentiment_analyzer (transformer sentiment model): sentiment model.
+        spacy_ner (spacy ner pipeline): ner model.
+        entity_blacklist (list): list of entity type that we don't want to include.
+        sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        batch_size (int): number of comments per sentiment model forward pass.
+        ner_batch_size (int): number of texts buffered per spacy batch.
+        n_process (int): number of spacy worker processes, -1 to use all cores.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        max_batch (int): number of texts after which a model call starts without waiting for more requests.
+        max_wait (float): seconds a model call waits for more requests.
+        api (str): name of the sentiment backend, reported in the status so clients only send jobs of that api.
+        text_filter (TextFilter): filter of the texts of extraction jobs not worth analyzing, None to analyze every
+            cell. Its settings are reported in the status.
+    """
+
+    def __init__(self, transformer_sentiment_analyzer, spacy_ner, entity_blacklist, sentiment_score_map,
+                 batch_size=32, ner_batch_size=256, n_process=1, cache=None, max_batch=256, max_wait=0.01,
+                 api='open_source', text_filter=None):
+        from src.open_source_sentiment_analyzer import get_entity_batch, get_sentiment_batch
+
+        self.api = api
+        self.text_filter = text_filter
+        self.cache = cache
+        self.started = time.time()
+        self.jobs = 0
+        self.running = 0
+        self._lock = threading.Lock()
+        self.batchers = {
+            'sentiment': MicroBatcher(
+                lambda texts: get_sentiment_batch(texts, transformer_sentiment_analyzer, sentiment_score_map,
+                                                  batch_size, cache),
+                max_batch, max_wait, 'worker_sentiment'),
+            'entity': MicroBatcher(
+                lambda texts: get_entity_batch(texts, spacy_ner, entity_blacklist, ner_batch_size, n_process, cache),
+                max_batch, max_wait, 'worker_entity')}
+
+    def status(self):
+        """Get the uptime and job counts of the worker."""
+        with self._lock:
+            return {'status': 'ok', 'api': self.api, 'pid': os.getpid(),
+                    'text_filter': None if self.text_filter is None else self.text_filter.settings(),
+                    'uptime_seconds': round(time.time() - self.started, 3), 'jobs': self.jobs, 'running': self.running}
+
+    def _run_job(self, kind, description, job):
+        """Helper to run a job, counting it and emitting its timing to the metrics file."""
+        with self._lock:
+            self.jobs += 1
+            self.running += 1
+        start = time.perf_counter()
+        status = 'failed'
+        try:
+            result = job()
+            status = 'succeeded'
+            return result
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self.running -= 1
+            metrics.observe('worker_' + kind, seconds)
+            metrics.emit({'job': kind, 'description': description, 'status': status, 'seconds': seconds})
+            logger.info('%s job %s %s in %.3fs', kind, description, status, seconds)
+
+    def analyze(self, texts, kinds=KINDS):
+        """
+        Analyze a batch of texts.
+
+        Args:
+            texts (list): list of target texts.
+            kinds (list): analyses to run, sentiment and/or entity.
+
+        Returns:
+            dict: mapping from every kind to its results in the same order as the texts, sentiment information
+                dictionaries and entity strings.
+        """
+        unknown = [kind for kind in kinds if kind not in self.batchers]
+        if unknown:
+            raise ValueError('unknown analysis kinds: {}'.format(', '.join(unknown)))
+        texts = [str(text) for text in texts]
+
+        def job():
+            # the models run side by side on their own threads
+            futures = {kind: self.batchers[kind].submit(texts) for kind in kinds}
+            return {kind: future.result() for kind, future in futures.items()}
+
+        return self._run_job('analyze', '{} texts'.format(len(texts)), job)
+
+    def extraction(self, data_path, output_path, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL,
+                   ENTITY_POST_COL, ENTITY_COMMENT_COL, TIME_COMMENT_COL=None, incremental=False, ID_COL=None,
+                   chunk_size=None):
+        """
+        Extract sentiment and entity information of a data file, see get_text_analysis_columns.
+
+        Returns:
+            dict: input and output paths.
+        """
+        from src.open_source_sentiment_analyzer import fill_text_columns
+
+        def analyze(data):
+            return fill_text_columns(data, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL,
+                                     ENTITY_POST_COL, ENTITY_COMMENT_COL, self.batchers['sentiment'],
+                                     self.batchers['entity'], self.text_filter)
+
+        def job():
+            extract_file(data_path, output_path, analyze, [ENTITY_POST_COL, ENTITY_COMMENT_COL],
+                         [TIME_COMMENT_COL] if TIME_COMMENT_COL else [], incremental, ID_COL, COMMENT_COL, chunk_size)
+            return {'input': data_path, 'output': output_path}
+
+        return self._run_job('extraction', data_path, job)
+
+    def close(self):
+        """Stop the batchers once the queued requests are done."""
+        for batcher in self.batchers.values():
+            batcher.close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Json over http front of the worker, the worker is the server's worker attribute."""
+
+    def _reply(self, code, body):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.server.worker.status())
+        else:
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+
+    def _job(self, body):
+        """Helper to validate a job request and get the call running it."""
+        worker = self.server.worker
+        if self.path == '/analyze':
+            texts = body['texts']
+            kinds = body.get('kinds', KINDS)
+            if not isinstance(texts, list) or not isinstance(kinds, list):
+                raise ValueError('texts and kinds must be lists')
+            unknown = [kind for kind in kinds if kind not in KINDS]
+            if unknown:
+                raise ValueError('unknown analysis kinds: {}'.format(', '.join(map(str, unknown))))
+            return lambda: worker.analyze(texts, kinds)
+        # raises TypeError on missing or unexpected fields
+        inspect.signature(worker.extraction).bind(**body)
+        return lambda: worker.extraction(**body)
+
+    def do_POST(self):
+        if self.path not in ('/analyze', '/extraction'):
+            self._reply(404, {'error': 'unknown path {}'.format(self.path)})
+            return
+        # extraction jobs read and write files of the host, only local clients get to name them
+        if self.path == '/extraction' and not ipaddress.ip_address(self.client_address[0]).is_loopback:
+            self._reply(403, {'error': '/extraction only takes requests from the local host'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+            if not isinstance(body, dict):
+                raise ValueError('the request body must be a json object')
+            job = self._job(body)
+        except (KeyError, TypeError, ValueError) as exception:
+            self._reply(400, {'error': repr(exception)})
+            return
+        try:
+            result = job()
+        except Exception as exception:
+            logger.exception('%s failed', self.path)
+            self._reply(500, {'error': repr(exception)})
+            return
+        self._reply(200, result)
+
+    def log_message(self, format, *args):
+        logger.debug('%s ' + format, self.address_string(), *args)
+
+
+def _interrupt(signum, frame):
+    """Helper to turn a termination signal into a KeyboardInterrupt."""
+    raise KeyboardInterrupt
+
+
+def serve(worker, host='127.0.0.1', port=8765):
+    """
+    Serve analysis jobs until interrupted.
+
+    Args:
+        worker (AnalysisWorker): worker running the jobs.
+        host (str): address to listen on, keep it local since jobs name files of the host.
+        port (int): port to listen on, 0 for any free port.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.worker = worker
+    if threading.current_thread() is threading.main_thread():
+        # stop on SIGTERM as on ctrl-c, e.g. under a service manager
+        signal.signal(signal.SIGTERM, _interrupt)
+    logger.info('analysis worker listening on http://%s:%d', host, server.server_port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('analysis worker stopping')
+    finally:
+        server.server_close()
+        worker.close()
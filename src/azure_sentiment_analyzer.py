@@ -1,8 +1,18 @@
-import errno
-import os
-import signal
-import functools
-import pandas as pd
+import random
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import HttpResponseError, ServiceRequestError, ServiceResponseError
+from src import metrics
+from src.analysis_utils import analyze_filtered, extract_file
+from src.analysis_cache import cache_version, cached_batch
+from src.text_filter import SKIPPED_ENTITY, SKIPPED_SENTIMENT
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = 'azure'
+TRANSIENT_STATUS_CODES = (408, 429, 500, 502, 503, 504)
 
 
 class TimeoutError(Exception):
@@ -10,22 +20,90 @@ class TimeoutError(Exception):
     pass
 
 
-def timeout(seconds=10, error_message=os.strerror(errno.ETIME)):
-    """Timeout call back function."""
-    def decorator(func):
-        def _handle_timeout(signum, frame):
-            raise TimeoutError(error_message)
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            signal.signal(signal.SIGALRM, _handle_timeout)
-            signal.alarm(seconds)
-            try:
-                result = func(*args, **kwargs)
-            finally:
-                signal.alarm(0)
-            return result
-        return wrapper
-    return decorator
+class RetryPolicy:
+    """
+    Per request deadline and retry settings for Azure calls, safe to share across worker threads.
+
+    Args:
+        timeout (float): connection and read deadline of a single request in seconds.
+        max_retries (int): maximum number of retries of a single request.
+        backoff_base (float): base delay of the exponential backoff in seconds.
+        backoff_max (float): maximum delay between two attempts in seconds.
+        retry_budget (int): total number of retries allowed across the run, None for no limit.
+    """
+
+    def __init__(self, timeout=3.0, max_retries=3, backoff_base=0.5, backoff_max=30.0, retry_budget=None):
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retry_budget = retry_budget
+        self._lock = threading.Lock()
+
+    def take_retry(self):
+        """Take one retry from the budget, False if it is spent."""
+        with self._lock:
+            if self.retry_budget is None:
+                return True
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def backoff(self, attempt):
+        """Get the delay before the next attempt, exponential with full jitter."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+def _is_transient(exception):
+    """Helper to tell whether a failed request is worth retrying."""
+    if isinstance(exception, HttpResponseError):
+        return exception.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(exception, (TimeoutError, ServiceRequestError, ServiceResponseError))
+
+
+def _retry_after(exception):
+    """Helper to read the Retry-After header of a throttled request, None if absent."""
+    response = getattr(exception, 'response', None)
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def call_with_retry(request, retry_policy):
+    """
+    Call an Azure request with a per request deadline, retrying throttled and transient failures.
+
+    Args:
+        request (callable): function taking the request keyword arguments (connection_timeout and read_timeout).
+        retry_policy (RetryPolicy): deadline and retry settings.
+
+    Returns:
+        result of the request.
+
+    Raises:
+        TimeoutError: the request still failed with a transient error once its retries were used up.
+    """
+    attempt = 0
+    while True:
+        metrics.increment('azure_calls')
+        try:
+            with metrics.timer('azure_request'):
+                return request(connection_timeout=retry_policy.timeout, read_timeout=retry_policy.timeout)
+        except Exception as exception:
+            if not _is_transient(exception):
+                metrics.increment('azure_failures')
+                raise
+            if getattr(exception, 'status_code', None) == 429:
+                metrics.increment('azure_throttled')
+            if attempt >= retry_policy.max_retries or not retry_policy.take_retry():
+                metrics.increment('azure_timeouts')
+                raise TimeoutError(str(exception)) from exception
+            metrics.increment('azure_retries')
+            delay = _retry_after(exception)
+            time.sleep(retry_policy.backoff(attempt) if delay is None else delay)
+            attempt += 1
 
 
 def batch_information_extraction(documents, cog_client):
@@ -62,8 +140,7 @@ def batch_information_extraction(documents, cog_client):
     return information
 
 
-@timeout(3)
-def get_sentiment_azure(text, cog_client, sentiment_score_map):
+def get_sentiment_azure(text, cog_client, sentiment_score_map, retry_policy=None):
     """
     Given a text string, get sentiment analysis results.
 
@@ -71,11 +148,14 @@ def get_sentiment_azure(text, cog_client, sentiment_score_map):
         text (str): target text.
         cog_client (azure api instance): Azure text analytics client.
         sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
 
     Returns:
         dict: information dictionary containing sentiment class, prediction confidence and corresponding sentiment score.
     """
-    sentimentAnalysis = cog_client.analyze_sentiment([text], show_opinion_mining=True)[0]
+    sentimentAnalysis = call_with_retry(
+        lambda **kwargs: cog_client.analyze_sentiment([text], show_opinion_mining=True, **kwargs),
+        retry_policy or RetryPolicy())[0]
     sentiment = sentimentAnalysis.sentiment
     if sentiment == 'positive':
         confidence = sentimentAnalysis.confidence_scores.positive
@@ -89,8 +169,7 @@ def get_sentiment_azure(text, cog_client, sentiment_score_map):
             "score": sentiment_score_map[sentiment]}
 
 
-@timeout(3)
-def get_entity_azure(text, cog_client, blacklist):
+def get_entity_azure(text, cog_client, blacklist, retry_policy=None):
     """
     Given a text string, get sentiment analysis results.
 
@@ -98,36 +177,204 @@ def get_entity_azure(text, cog_client, blacklist):
         text (str): target text.
         cog_client (azure api instance): Azure text analytics client.
         blacklist (list): list of entity type that we don't want to include.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
 
     Returns:
         list: list of extracted entity along with the entity type (separate by comma)
     """
-    ner = cog_client.recognize_entities(documents=[text])
+    ner = call_with_retry(lambda **kwargs: cog_client.recognize_entities(documents=[text], **kwargs),
+                          retry_policy or RetryPolicy())
     nes = [[e.text+','+e.category for e in doc.entities if e.category not in blacklist] for doc in ner if not doc.is_error][0]
 
     return nes
 
 
-def _get_sentiment_wrapper(text, cog_client, sentiment_score_map):
-    """Wrapper for sentiment extraction to implement timeout error."""
-    try:
-        return get_sentiment_azure(text, cog_client, sentiment_score_map)
-    except TimeoutError:
-        return {'sentiment': 'timeout', 'confidence': 0, 'score': 0}
+def _run_chunks(texts, chunk_size, analyze_chunk, max_workers, timed_out, retry_passes):
+    """
+    Helper to split texts into request sized chunks and analyze them concurrently on a bounded thread pool.
+
+    Documents whose request timed out are collected and sent again at the end, up to retry_passes times.
+    """
+    def run(pending):
+        chunks = [pending[start:start + chunk_size] for start in range(0, len(pending), chunk_size)]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return [result for chunk_results in executor.map(analyze_chunk, chunks) for result in chunk_results]
 
+    results = run(texts)
+    for retry_pass in range(retry_passes):
+        pending = [i for i, result in enumerate(results) if timed_out(result)]
+        if not pending:
+            break
+        logger.info('retrying %d timed out documents, pass %d', len(pending), retry_pass + 1)
+        for i, result in zip(pending, run([texts[i] for i in pending])):
+            results[i] = result
+    return results
+
+
+def _sentiment_record(doc, sentiment_score_map):
+    """Helper to turn a sentiment document result into a sentiment record, N/A if the document failed."""
+    if doc.is_error:
+        metrics.increment('azure_document_errors')
+        return {'sentiment': 'N/A', 'confidence': 0, 'score': 0}
+    return {'sentiment': doc.sentiment,
+            'confidence': getattr(doc.confidence_scores, doc.sentiment),
+            'score': sentiment_score_map[doc.sentiment]}
+
+
+def get_sentiment_azure_batch(texts, cog_client, sentiment_score_map, batch_size=10, max_workers=4, cache=None,
+                              retry_policy=None, retry_passes=1):
+    """
+    Given a list of text strings, get sentiment analysis results with one Azure request per chunk of documents.
+
+    Args:
+        texts (list): list of target texts.
+        cog_client (azure api instance): Azure text analytics client.
+        sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        batch_size (int): number of documents per request, at most the service limit.
+        max_workers (int): number of concurrent requests.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
+        retry_passes (int): number of times timed out documents are sent again at the end.
+
+    Returns:
+        list: information dictionaries in the same order as the input texts, N/A for failed documents and the
+            documents of failed requests, timeout for documents whose request still timed out after the retry passes.
+    """
+    if cache is not None:
+        return cached_batch(texts, cache, CACHE_BACKEND, 'sentiment', cache_version(sorted(sentiment_score_map.items())),
+                            lambda misses: get_sentiment_azure_batch(misses, cog_client, sentiment_score_map,
+                                                                     batch_size, max_workers,
+                                                                     retry_policy=retry_policy,
+                                                                     retry_passes=retry_passes),
+                            lambda result: result['sentiment'] not in ('N/A', 'timeout'))
+    retry_policy = retry_policy or RetryPolicy()
+
+    def analyze_chunk(chunk):
+        try:
+            docs = call_with_retry(lambda **kwargs: cog_client.analyze_sentiment(chunk, **kwargs), retry_policy)
+        except TimeoutError:
+            return [{'sentiment': 'timeout', 'confidence': 0, 'score': 0} for _ in chunk]
+        except HttpResponseError as exception:
+            # a rejected request fails its documents, not the run
+            logger.warning('sentiment request of %d documents failed: %s', len(chunk), exception)
+            metrics.increment('azure_document_errors', len(chunk))
+            return [{'sentiment': 'N/A', 'confidence': 0, 'score': 0} for _ in chunk]
+        return [_sentiment_record(doc, sentiment_score_map) for doc in docs]
+
+    return _run_chunks(texts, batch_size, analyze_chunk, max_workers,
+                       lambda result: result['sentiment'] == 'timeout', retry_passes)
 
-def _get_entity_wrapper(text, cog_client, blacklist):
-    """Wrapper for entity extraction to implement timeout error."""
-    try:
-        return '|'.join(get_entity_azure(text, cog_client, blacklist))
-    except TimeoutError:
-        return ''
+
+def get_entity_azure_batch(texts, cog_client, blacklist, batch_size=5, max_workers=4, cache=None,
+                           retry_policy=None, retry_passes=1):
+    """
+    Given a list of text strings, get their entities with one Azure request per chunk of documents.
+
+    Args:
+        texts (list): list of target texts.
+        cog_client (azure api instance): Azure text analytics client.
+        blacklist (list): list of entity type that we don't want to include.
+        batch_size (int): number of documents per request, at most the service limit.
+        max_workers (int): number of concurrent requests.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
+        retry_passes (int): number of times timed out documents are sent again at the end.
+
+    Returns:
+        list: entity strings in the same order as the input texts, empty for failed documents and the documents of
+            failed requests, None for documents whose request still timed out after the retry passes.
+    """
+    if cache is not None:
+        return cached_batch(texts, cache, CACHE_BACKEND, 'entity', cache_version(sorted(blacklist)),
+                            lambda misses: get_entity_azure_batch(misses, cog_client, blacklist,
+                                                                  batch_size, max_workers,
+                                                                  retry_policy=retry_policy,
+                                                                  retry_passes=retry_passes),
+                            lambda result: result is not None)
+    retry_policy = retry_policy or RetryPolicy()
+
+    def analyze_chunk(chunk):
+        try:
+            ner = call_with_retry(lambda **kwargs: cog_client.recognize_entities(documents=chunk, **kwargs),
+                                  retry_policy)
+        except TimeoutError:
+            return [None for _ in chunk]
+        except HttpResponseError as exception:
+            # a rejected request fails its documents, not the run
+            logger.warning('entity request of %d documents failed: %s', len(chunk), exception)
+            metrics.increment('azure_document_errors', len(chunk))
+            return ['' for _ in chunk]
+        metrics.increment('azure_document_errors', sum(doc.is_error for doc in ner))
+        return ['' if doc.is_error else '|'.join(e.text + ',' + e.category for e in doc.entities
+                                                   if e.category not in blacklist) for doc in ner]
+
+    return _run_chunks(texts, batch_size, analyze_chunk, max_workers, lambda result: result is None, retry_passes)
+
+
+def analyze_text_columns_azure(data, POST_COL, COMMENT_COL, SENTIMENT_COL,
+                               CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL, ENTITY_COMMENT_COL,
+                               cog_client, entity_blacklist, sentiment_score_map,
+                               cache=None, sentiment_batch_size=10, entity_batch_size=5,
+                               max_workers=4, retry_policy=None, retry_passes=1, text_filter=None):
+    """
+    Add the sentiment and entity columns to a data frame of posts and comments using Azure API.
+
+    Args:
+        data (pd.DataFrame): processed data, modified in place.
+        POST_COL (str): post column name.
+        COMMENT_COL (str): comment column name.
+        SENTIMENT_COL (str): sentiment column name.
+        CONFIDENCE_COL (str): sentiment prediction confidence column name.
+        SCORE_COL (str): sentiment score column name.
+        ENTITY_POST_COL (str): post entity column name.
+        ENTITY_COMMENT_COL (str): comment entity column name.
+        cog_client (azure api instance): Azure text analytics client.
+        entity_blacklist (list): list of entity type that we don't want to include.
+        sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        sentiment_batch_size (int): number of documents per sentiment request.
+        entity_batch_size (int): number of documents per entity recognition request.
+        max_workers (int): number of concurrent requests.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
+        retry_passes (int): number of times timed out documents are sent again at the end of the run.
+        text_filter (TextFilter): filter of the texts not worth a request, their rows get the skipped results. None
+            to send every cell.
+
+    Returns:
+        pd.DataFrame: the data with the new columns.
+    """
+    # extract sentiment and create corresponding columns
+    sentiment_results = analyze_filtered(
+        list(data[COMMENT_COL]),
+        lambda texts: get_sentiment_azure_batch(texts, cog_client, sentiment_score_map,
+                                                sentiment_batch_size, max_workers, cache,
+                                                retry_policy, retry_passes),
+        SKIPPED_SENTIMENT, text_filter, 'comment sentiment')
+    data[SENTIMENT_COL] = [e['sentiment'] for e in sentiment_results]
+    data[CONFIDENCE_COL] = [e['confidence'] for e in sentiment_results]
+    data[SCORE_COL] = [e['score'] for e in sentiment_results]
+
+    # extract entity and create corresponding columns, posts and comments share requests
+    entities = analyze_filtered(
+        list(data[POST_COL]) + list(data[COMMENT_COL]),
+        lambda texts: get_entity_azure_batch(texts, cog_client, entity_blacklist,
+                                             entity_batch_size, max_workers, cache,
+                                             retry_policy, retry_passes),
+        SKIPPED_ENTITY, text_filter, 'post and comment entities')
+    entities = ['' if e is None else e for e in entities]
+    data[ENTITY_POST_COL] = entities[:len(data)]
+    data[ENTITY_COMMENT_COL] = entities[len(data):]
+    if cache is not None:
+        logger.info('analysis cache: %s', cache.stats())
+    return data
 
 
 def get_text_analysis_columns_azure(data_path, POST_COL, COMMENT_COL, SENTIMENT_COL,
                                     CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL, ENTITY_COMMENT_COL,
                                     cog_client, entity_blacklist, sentiment_score_map,
-                                    output_path):
+                                    output_path, cache=None, sentiment_batch_size=10, entity_batch_size=5,
+                                    max_workers=4, retry_policy=None, retry_passes=1, TIME_COMMENT_COL=None,
+                                    incremental=False, ID_COL=None, chunk_size=None, text_filter=None):
     """
     Process the data to extract sentiment and entity information and store the new csv file to target.
 
@@ -144,24 +391,28 @@ def get_text_analysis_columns_azure(data_path, POST_COL, COMMENT_COL, SENTIMENT_
         entity_blacklist (list): list of entity type that we don't want to include.
         sentiment_score_map (dict): mapping from sentiment class to quantitative score.
         output_path (str): output path.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        sentiment_batch_size (int): number of documents per sentiment request.
+        entity_batch_size (int): number of documents per entity recognition request.
+        max_workers (int): number of concurrent requests.
+        retry_policy (RetryPolicy): deadline and retry settings, None for the defaults.
+        retry_passes (int): number of times timed out documents are sent again at the end of the run.
+        TIME_COMMENT_COL (str): time of comment column name, stored as dates in parquet output.
+        incremental (bool): only analyze the rows missing from the existing output and merge them into it.
+        ID_COL (str): id column name, part of the row key in incremental mode.
+        chunk_size (int): number of rows analyzed at a time with a checkpoint after each chunk, None to analyze the
+            whole data at once. Not used in incremental mode.
+        text_filter (TextFilter): filter of the texts not worth a request, None to send every cell.
 
     Returns:
         None
     """
-    data = pd.read_csv(data_path)
+    def analyze(data):
+        return analyze_text_columns_azure(data, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL,
+                                          ENTITY_POST_COL, ENTITY_COMMENT_COL, cog_client, entity_blacklist,
+                                          sentiment_score_map, cache, sentiment_batch_size, entity_batch_size,
+                                          max_workers, retry_policy, retry_passes, text_filter)
 
-    # extract sentiment and create corresponding columns
-    data['sentiment_results'] = data[COMMENT_COL].apply(
-        lambda e: _get_sentiment_wrapper(str(e), cog_client, sentiment_score_map))
-    data[SENTIMENT_COL] = data['sentiment_results'].apply(lambda e: e['sentiment'])
-    data[CONFIDENCE_COL] = data['sentiment_results'].apply(lambda e: e['confidence'])
-    data[SCORE_COL] = data['sentiment_results'].apply(lambda e: e['score'])
-
-    # extract entity and create corresponding columns
-    data[ENTITY_POST_COL] = data[POST_COL].apply(
-        lambda e: _get_entity_wrapper(str(e), cog_client, entity_blacklist))
-    data[ENTITY_COMMENT_COL] = data[COMMENT_COL].apply(
-        lambda e: _get_entity_wrapper(str(e), cog_client, entity_blacklist))
-
-    # save file
-    data.to_csv(output_path, index=False)
+    entity_cols = [ENTITY_POST_COL, ENTITY_COMMENT_COL]
+    date_cols = [TIME_COMMENT_COL] if TIME_COMMENT_COL else []
+    extract_file(data_path, output_path, analyze, entity_cols, date_cols, incremental, ID_COL, COMMENT_COL, chunk_size)
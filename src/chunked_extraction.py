@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import shutil
+import pandas as pd
+from src.table_io import is_parquet, iter_table, read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+# Every finished chunk is written to its own part file in a directory next to the output, along with a checkpoint
+# telling how many chunks are done. A restarted run skips those chunks, and the parts are merged into the output once
+# the whole input is analyzed.
+PARTS_SUFFIX = '.parts'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+
+def _input_signature(data_path):
+    """Helper to identify the version of the input by its path, size and modification time."""
+    stat = os.stat(data_path)
+    return [os.path.abspath(data_path), stat.st_size, stat.st_mtime_ns]
+
+
+def _read_checkpoint(parts_dir, data_path, chunk_size):
+    """Helper to get the number of chunks and rows already done, (0, 0) when no checkpoint matches this run."""
+    try:
+        with open(os.path.join(parts_dir, CHECKPOINT_FILE)) as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return 0, 0
+    # the parts of a previous version of the input don't go with the chunks of this one
+    if checkpoint.get('input') != _input_signature(data_path) or checkpoint.get('chunk_size') != chunk_size:
+        return 0, 0
+    return checkpoint['chunks'], checkpoint['rows']
+
+
+def _write_checkpoint(parts_dir, data_path, chunk_size, chunks, rows):
+    """Helper to atomically record the number of chunks done."""
+    path = os.path.join(parts_dir, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'input': _input_signature(data_path), 'chunk_size': chunk_size, 'chunks': chunks, 'rows': rows},
+                  f)
+    os.replace(path + '.tmp', path)
+
+
+def _part_path(parts_dir, index, ext):
+    """Helper to get the path of a chunk's part file."""
+    return os.path.join(parts_dir, 'part-{:06d}{}'.format(index, ext))
+
+
+def _merged_schema(part_paths):
+    """Helper to get the schema of the merged parts, widening int columns that are float in some parts."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schemas = [pq.read_schema(part_path) for part_path in part_paths]
+    schema = schemas[0]
+    for other in schemas[1:]:
+        for i, field in enumerate(schema):
+            other_field = other.field(field.name)
+            if pa.types.is_integer(field.type) and pa.types.is_floating(other_field.type):
+                schema = schema.set(i, other_field)
+    return schema
+
+
+def _widened_csv_columns(part_paths):
+    """Helper to get the columns that are int in some csv parts and float in others."""
+    int_cols = set()
+    float_cols = set()
+    for part_path in part_paths:
+        for col, dtype in pd.read_csv(part_path).dtypes.items():
+            if pd.api.types.is_integer_dtype(dtype):
+                int_cols.add(col)
+            elif pd.api.types.is_float_dtype(dtype):
+                float_cols.add(col)
+    return int_cols & float_cols
+
+
+def merge_parts(part_paths, output_path):
+    """
+    Concatenate part files into the output, one part in memory at a time.
+
+    The output holds the same data as the concatenated parts written at once: int columns that are float in some parts
+    are float in the whole output.
+
+    Args:
+        part_paths (list): paths of the part files, in order.
+        output_path (str): output path, csv or parquet like the parts.
+    """
+    if is_parquet(output_path):
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(output_path, _merged_schema(part_paths))
+        for part_path in part_paths:
+            writer.write_table(pq.read_table(part_path).cast(writer.schema))
+        writer.close()
+        return
+
+    widened = _widened_csv_columns(part_paths) if len(part_paths) > 1 else set()
+    with open(output_path, 'wb') as output:
+        for i, part_path in enumerate(part_paths):
+            if widened:
+                data = pd.read_csv(part_path)
+                int_cols = [col for col in widened if pd.api.types.is_integer_dtype(data[col])]
+                if int_cols:
+                    # rewritten as the float column of a table written at once, e.g. 30.0 instead of 30
+                    data.astype({col: float for col in int_cols}).to_csv(output, index=False, header=i == 0)
+                    continue
+            with open(part_path, 'rb') as part:
+                if i > 0:
+                    part.readline()
+                shutil.copyfileobj(part, output)
+
+
+def chunked_extraction(data_path, output_path, analyze, chunk_size, entity_cols=(), date_cols=()):
+    """
+    Analyze the processed data chunk by chunk, checkpointing every finished chunk so an interrupted run resumes from
+    the last completed chunk. Memory use is bounded by the chunk size rather than the input size.
+
+    Args:
+        data_path (str): path to the processed data.
+        output_path (str): output path.
+        analyze (callable): function adding the analysis columns to a data frame and returning it.
+        chunk_size (int): number of rows analyzed at a time.
+        entity_cols (list): entity columns of the output.
+        date_cols (list): date columns of the output.
+
+    Returns:
+        None
+    """
+    parts_dir = output_path + PARTS_SUFFIX
+    ext = os.path.splitext(output_path)[1]
+    chunks, rows = _read_checkpoint(parts_dir, data_path, chunk_size)
+    if chunks:
+        logger.info('chunked extraction: resuming after %d chunks, %d rows', chunks, rows)
+    else:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+        os.makedirs(parts_dir)
+
+    for chunk in iter_table(data_path, chunk_size, skip_chunks=chunks):
+        part_path = _part_path(parts_dir, chunks, ext)
+        base, part_ext = os.path.splitext(part_path)
+        write_table(analyze(chunk), base + '.tmp' + part_ext, entity_cols, date_cols)
+        os.replace(base + '.tmp' + part_ext, part_path)
+        chunks += 1
+        rows += len(chunk)
+        _write_checkpoint(parts_dir, data_path, chunk_size, chunks, rows)
+        logger.info('chunked extraction: %d chunks, %d rows done', chunks, rows)
+
+    if chunks == 0:
+        # no rows to analyze, the output only gets the columns
+        write_table(analyze(read_table(data_path)), output_path, entity_cols, date_cols)
+    else:
+        base, _ = os.path.splitext(output_path)
+        merge_parts([_part_path(parts_dir, i, ext) for i in range(chunks)], base + '.tmp' + ext)
+        os.replace(base + '.tmp' + ext, output_path)
+    shutil.rmtree(parts_dir)
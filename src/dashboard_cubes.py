@@ -0,0 +1,212 @@
+import hashlib
+import json
+import logging
+import os
+import pandas as pd
+from src.table_io import read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+# Pre-aggregated dashboard tables. Every input file gets a partial cube of additive statistics (row count, score sum
+# and count, one count per sentiment class) by day, kept in the cube directory along with the size and modification
+# time of the file it comes from. A later run only aggregates the files that are new or changed and sums the partials,
+# so new daily files are rolled up without going through the older ones again.
+PARTIALS_MANIFEST = 'partials.json'
+SENTIMENT_KEYS = ['day', 'company', 'channel']
+ENTITY_DAILY_KEYS = ['day', 'entity', 'type', 'company', 'channel']
+ENTITY_KEYS = ['entity', 'type', 'company', 'channel']
+TOP_KEYS = ['period', 'company', 'channel']
+CLASS_PREFIX = 'sentiment_'
+SHARE_PREFIX = 'share_'
+
+
+def aggregate(data, keys, time_col, sentiment_col, score_col):
+    """
+    Aggregate dashboard rows into additive statistics.
+
+    Args:
+        data (pd.DataFrame): dashboard rows with the key columns, except day which is taken from time_col.
+        keys (list): columns to group by.
+        time_col (str): time column, truncated to the day.
+        sentiment_col (str): sentiment class column.
+        score_col (str): sentiment score column.
+
+    Returns:
+        pd.DataFrame: one row per key with count, score_sum, score_count and one sentiment_<class> count per class.
+    """
+    score = pd.to_numeric(data[score_col], errors='coerce')
+    stats = pd.DataFrame({'day': pd.to_datetime(data[time_col], errors='coerce').dt.normalize()}, index=data.index)
+    for key in keys:
+        if key != 'day':
+            stats[key] = data[key]
+    stats['count'] = 1
+    stats['score_sum'] = score.fillna(0)
+    stats['score_count'] = score.notna().astype(int)
+    classes = pd.get_dummies(data[sentiment_col].astype(object), prefix=CLASS_PREFIX[:-1], prefix_sep='_', dtype=int)
+    stats = pd.concat([stats, classes], axis=1)
+    return stats.groupby(keys, dropna=False, sort=True).sum().reset_index()
+
+
+def sum_cubes(cubes, keys):
+    """Add up cubes of additive statistics, classes missing from a cube count as 0."""
+    cubes = [cube for cube in cubes if len(cube)]
+    if not cubes:
+        return pd.DataFrame(columns=keys + ['count', 'score_sum', 'score_count'])
+    total = pd.concat(cubes).groupby(keys, dropna=False, sort=True).sum(min_count=0).reset_index()
+    count_cols = ['count', 'score_count'] + [col for col in total.columns if col.startswith(CLASS_PREFIX)]
+    total[count_cols] = total[count_cols].fillna(0).astype('int64')
+    return total
+
+
+def _finalize(cube):
+    """Helper to add the mean score and the share of every sentiment class to a cube."""
+    cube = cube.copy()
+    cube['score_mean'] = cube['score_sum'] / cube['score_count'].where(cube['score_count'] > 0)
+    for col in [col for col in cube.columns if col.startswith(CLASS_PREFIX)]:
+        cube[SHARE_PREFIX + col[len(CLASS_PREFIX):]] = cube[col] / cube['count'].where(cube['count'] > 0)
+    return cube
+
+
+def _file_signature(path):
+    """Helper to get the size and modification time telling whether an input file changed."""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def _read_partial(path):
+    """Helper to read a partial cube back with its day column as datetimes."""
+    partial = read_table(path)
+    partial['day'] = pd.to_datetime(partial['day'])
+    return partial
+
+
+def rollup(cube_dir, kind, data_files, build_partial, keys, ext='.csv'):
+    """
+    Update the partial cubes of the data files that are new or changed and sum all of them.
+
+    Args:
+        cube_dir (str): directory holding the cubes.
+        kind (str): cube name, the partials are kept in a sub directory of that name.
+        data_files (list): (company, channel, path) tuples of the data files.
+        build_partial (callable): function mapping (company, channel, path) to the partial cube of one data file.
+        keys (list): key columns of the cube.
+        ext (str): file extension of the partials, .csv or .parquet.
+
+    Returns:
+        pd.DataFrame: sum of the partial cubes of the data files.
+    """
+    partial_dir = os.path.join(cube_dir, kind)
+    os.makedirs(partial_dir, exist_ok=True)
+    manifest_path = os.path.join(partial_dir, PARTIALS_MANIFEST)
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    current = {}
+    built = 0
+    for company, channel, path in data_files:
+        name = hashlib.sha1('|'.join([company, channel, os.path.abspath(path)]).encode('utf-8')).hexdigest()[:16]
+        record = dict(company=company, channel=channel, path=os.path.abspath(path), ext=ext, **_file_signature(path))
+        partial_path = os.path.join(partial_dir, name + ext)
+        if manifest.get(name) != record or not os.path.exists(partial_path):
+            write_table(build_partial(company, channel, path), partial_path, date_cols=['day'])
+            built += 1
+        current[name] = record
+
+    for name, record in manifest.items():
+        if name not in current:
+            stale_path = os.path.join(partial_dir, name + record.get('ext', ext))
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(current, f, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    logger.info('%s cube: %d files, %d aggregated, %d reused', kind, len(current), built, len(current) - built)
+
+    return sum_cubes([_read_partial(os.path.join(partial_dir, name + ext)) for name in current], keys)
+
+
+def top_entities(entity_daily, top_n=10, period='M'):
+    """
+    Get the most mentioned entities of every period, company and channel.
+
+    Args:
+        entity_daily (pd.DataFrame): entity cube by day.
+        top_n (int): number of entities kept per period, company and channel.
+        period (str): pandas period alias, e.g. D, W or M.
+
+    Returns:
+        pd.DataFrame: period, company, channel, rank, entity, type and their statistics.
+    """
+    cube = entity_daily.dropna(subset=['day']).copy()
+    cube['period'] = cube['day'].dt.to_period(period).astype(str)
+    cube = sum_cubes([cube.drop(columns=['day'])], TOP_KEYS + ['entity', 'type'])
+    cube = cube.sort_values(TOP_KEYS + ['count', 'entity', 'type'], ascending=[True, True, True, False, True, True])
+    cube = cube.groupby(TOP_KEYS, sort=False).head(top_n)
+    cube.insert(3, 'rank', cube.groupby(TOP_KEYS, sort=False).cumcount() + 1)
+    return _finalize(cube.reset_index(drop=True))
+
+
+def write_sentiment_cubes(cube_dir, data_files, build_partial, ext='.csv'):
+    """
+    Roll up and write the sentiment cube by day, company and channel.
+
+    Args:
+        cube_dir (str): directory holding the cubes.
+        data_files (list): (company, channel, path) tuples of the data files.
+        build_partial (callable): function mapping (company, channel, path) to the partial cube of one data file.
+        ext (str): file extension of the cubes, .csv or .parquet.
+    """
+    daily = rollup(cube_dir, 'sentiment', data_files, build_partial, SENTIMENT_KEYS, ext)
+    write_sentiment_tables(cube_dir, daily, ext)
+
+
+def write_sentiment_tables(cube_dir, daily, ext='.csv'):
+    """
+    Write the sentiment cube by day, company and channel from its additive statistics.
+
+    Args:
+        cube_dir (str): directory holding the cubes.
+        daily (pd.DataFrame): sum of the sentiment cubes by day, company and channel.
+        ext (str): file extension of the cubes, .csv or .parquet.
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    write_table(_finalize(daily), os.path.join(cube_dir, 'sentiment_daily' + ext), date_cols=['day'])
+
+
+def write_entity_cubes(cube_dir, name, data_files, build_partial, top_n=10, period='M', ext='.csv'):
+    """
+    Roll up and write the entity cubes: by day, by entity over the whole time range and the top entities per period.
+
+    Args:
+        cube_dir (str): directory holding the cubes.
+        name (str): cube name, e.g. the entity column the cubes come from.
+        data_files (list): (company, channel, path) tuples of the data files.
+        build_partial (callable): function mapping (company, channel, path) to the partial cube of one data file.
+        top_n (int): number of entities kept per period, company and channel.
+        period (str): pandas period alias of the top entities, e.g. D, W or M.
+        ext (str): file extension of the cubes, .csv or .parquet.
+    """
+    daily = rollup(cube_dir, name, data_files, build_partial, ENTITY_DAILY_KEYS, ext)
+    write_entity_tables(cube_dir, name, daily, top_n, period, ext)
+
+
+def write_entity_tables(cube_dir, name, daily, top_n=10, period='M', ext='.csv'):
+    """
+    Write the entity cubes by day, by entity and the top entities per period from the additive statistics by day.
+
+    Args:
+        cube_dir (str): directory holding the cubes.
+        name (str): cube name, e.g. the entity column the cubes come from.
+        daily (pd.DataFrame): sum of the entity cubes by day, entity, type, company and channel.
+        top_n (int): number of entities kept per period, company and channel.
+        period (str): pandas period alias of the top entities, e.g. D, W or M.
+        ext (str): file extension of the cubes, .csv or .parquet.
+    """
+    os.makedirs(cube_dir, exist_ok=True)
+    write_table(_finalize(daily), os.path.join(cube_dir, name + '_daily' + ext), date_cols=['day'])
+    write_table(_finalize(sum_cubes([daily.drop(columns=['day'])], ENTITY_KEYS)),
+                os.path.join(cube_dir, name + ext))
+    write_table(top_entities(daily, top_n, period), os.path.join(cube_dir, name + '_top' + ext))
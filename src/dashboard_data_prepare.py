@@ -1,6 +1,11 @@
 import pandas as pd
 import unicodedata
 import numpy as np
+from src.table_io import read_table, split_entity, write_table
+from src.dashboard_cubes import ENTITY_DAILY_KEYS, SENTIMENT_KEYS, aggregate, write_entity_cubes, write_sentiment_cubes
+from src.entity_index import EntityIndex
+
+ENTITY_COLUMNS = ['entity', 'type', 'time', 'sentiment', 'score', 'company', 'channel']
 
 
 def _remove_non_ascii(entity):
@@ -14,8 +19,8 @@ def _to_lowercase(entity):
     return entity.lower()
 
 
-def _entity_normalization(entity):
-    """Helper to normalize entities."""
+def normalize_entity(entity):
+    """Normalize an entity the way the entity output stores it, NaN when nothing is left."""
     entity = _to_lowercase(entity)
     entity = _remove_non_ascii(entity)
     if entity=='':
@@ -23,55 +28,127 @@ def _entity_normalization(entity):
     return entity
 
 
-def _generate_entity_dict(row, sentiment_col, score_col, time_comment_col, entity_col, company, channel):
-    """Helper to generate entity information list."""
-    return [(_entity_normalization(e.split(',')[0]),
-             e.split(',')[1],
-             row[time_comment_col],
-             row[sentiment_col],
-             row[score_col],
-             company,
-             channel
-             ) for e in row[entity_col].split('|')]
-
-
-def entity_summerize(data_files, entity_col, sentiment_col, score_col, time_comment_col, output_path):
-    """Generate entity csv file for dashboard using."""
-
-    entity_sentiment_df = pd.DataFrame()
+def _explode_entities(data, entity_col):
+    """
+    Helper to turn the entity column into one row per entity.
+
+    The column holds either 'text,TYPE|text,TYPE' strings (csv) or lists of text/type structs (parquet).
+
+    Returns:
+        pd.DataFrame: entity and type columns, indexed by the row of data each entity comes from.
+    """
+    column = data[entity_col]
+    if len(column) and not isinstance(column.iloc[0], str):
+        entities = column.explode()
+        raw_entity = entities.map(lambda e: e['text'] if isinstance(e, dict) else np.nan)
+        entity_type = entities.map(lambda e: e['type'] if isinstance(e, dict) else np.nan)
+    else:
+        entities = column.astype(str).str.split('|').explode()
+        # split every distinct entity string once, with the same rule as the parquet structs
+        parts = {entity: split_entity(entity) for entity in entities.unique()}
+        raw_entity = entities.map({entity: text for entity, (text, _) in parts.items()})
+        entity_type = entities.map({entity: entity_type for entity, (_, entity_type) in parts.items()})
+    # normalize every distinct entity string once
+    normalized = {entity: normalize_entity(entity) for entity in raw_entity.dropna().unique()}
+    return pd.DataFrame({'entity': raw_entity.map(normalized), 'type': entity_type}, index=entities.index)
+
+
+def entity_frame(data, entity_col, sentiment_col, score_col, time_comment_col, company, channel):
+    """Build the entity dashboard rows of the extracted data of one company and channel."""
+    data = data.dropna(subset=[entity_col]).reset_index(drop=True)
+    df = _explode_entities(data, entity_col)
+    df['time'] = data[time_comment_col].to_numpy()[df.index]
+    df['sentiment'] = data[sentiment_col].to_numpy()[df.index]
+    df['score'] = data[score_col].to_numpy()[df.index]
+    df['company'] = company
+    df['channel'] = channel
+    return df.dropna(subset=['entity'])
+
+
+def entity_summerize(data_files, entity_col, sentiment_col, score_col, time_comment_col, output_path,
+                     cube_dir=None, top_n=10, period='M', cube_ext='.csv', index_path=None):
+    """
+    Generate entity csv file for dashboard using.
+
+    With cube_dir, the entity cubes by day and by entity and the top entities per period are also written there. They
+    are rolled up from per file partial cubes, so only new or changed data files are aggregated. With index_path, the
+    entity query index at that path is updated the same way, see EntityIndex. Without output_path, only the cubes and
+    the index are written.
+    """
+
+    frames = {}
     # merge all the entity data files and add company/channel tags
-    for data_file in data_files:
-        company = data_file[0]
-        channel = data_file[1]
-        path = data_file[2]
-
-        data = pd.read_csv(path)
-        data = data.dropna(subset=[entity_col])
-
-        entities = list(
-            data.apply(lambda row: _generate_entity_dict(row, sentiment_col, score_col, time_comment_col, entity_col, company, channel), axis=1))
-        entities = [item for sublist in entities for item in sublist]
-        df = pd.DataFrame(entities, columns=['entity', 'type', 'time', 'sentiment', 'score', 'company', 'channel'])
-        df = df.dropna(subset=['entity'])
-        entity_sentiment_df = entity_sentiment_df.append(df)
-
-    entity_sentiment_df.to_csv(output_path, index=False)
-
-
-def sentiment_summerize(data_files, post_col, reply_col, comment_col, sentiment_col, score_col, time_comment_col, output_path):
-    """Generate sentiment csv file for dashboard using."""
-
-    sentiment_df = pd.DataFrame()
+    if output_path is not None:
+        for data_file in data_files:
+            company = data_file[0]
+            channel = data_file[1]
+            path = data_file[2]
+
+            data = read_table(path, columns=[entity_col, sentiment_col, score_col, time_comment_col])
+            frames[tuple(data_file)] = entity_frame(data, entity_col, sentiment_col, score_col, time_comment_col,
+                                                    company, channel)
+
+        entity_sentiment_df = pd.concat(frames.values()) if frames else pd.DataFrame(columns=ENTITY_COLUMNS)
+        write_table(entity_sentiment_df, output_path, date_cols=['time'])
+
+    if cube_dir is not None:
+        def build_partial(company, channel, path):
+            df = frames.get((company, channel, path))
+            if df is None:
+                data = read_table(path, columns=[entity_col, sentiment_col, score_col, time_comment_col])
+                df = entity_frame(data, entity_col, sentiment_col, score_col, time_comment_col, company, channel)
+            return aggregate(df, ENTITY_DAILY_KEYS, 'time', 'sentiment', 'score')
+
+        write_entity_cubes(cube_dir, entity_col, [tuple(data_file) for data_file in data_files], build_partial,
+                           top_n, period, cube_ext)
+
+    if index_path is not None:
+        def build_rows(company, channel, path):
+            df = frames.get((company, channel, path))
+            if df is None:
+                data = read_table(path, columns=[entity_col, sentiment_col, score_col, time_comment_col])
+                df = entity_frame(data, entity_col, sentiment_col, score_col, time_comment_col, company, channel)
+            return df
+
+        index = EntityIndex(index_path, entity_col)
+        try:
+            index.update([tuple(data_file) for data_file in data_files], build_rows)
+        finally:
+            index.close()
+
+
+def sentiment_summerize(data_files, post_col, reply_col, comment_col, sentiment_col, score_col, time_comment_col, output_path,
+                        cube_dir=None, cube_ext='.csv'):
+    """
+    Generate sentiment csv file for dashboard using.
+
+    With cube_dir, the sentiment cube by day, company and channel is also written there, rolled up from per file
+    partial cubes. Without output_path, only the cube is written.
+    """
+
+    frames = {}
     # merge all the sentiment data files and add company/channel tags
-    for data_file in data_files:
-        company = data_file[0]
-        channel = data_file[1]
-        path = data_file[2]
-
-        data = pd.read_csv(path)
-        data = data[[post_col, reply_col, comment_col, sentiment_col, score_col, time_comment_col]]
-        data['company'] = company
-        data['channel'] = channel
-        sentiment_df = sentiment_df.append(data)
-
-    sentiment_df.to_csv(output_path, index=False)
\ No newline at end of file
+    if output_path is not None:
+        for data_file in data_files:
+            company = data_file[0]
+            channel = data_file[1]
+            path = data_file[2]
+
+            data = read_table(path, columns=[post_col, reply_col, comment_col, sentiment_col, score_col, time_comment_col])
+            data['company'] = company
+            data['channel'] = channel
+            frames[tuple(data_file)] = data
+
+        sentiment_df = pd.concat(frames.values()) if frames else pd.DataFrame()
+        write_table(sentiment_df, output_path, date_cols=[time_comment_col])
+
+    if cube_dir is not None:
+        def build_partial(company, channel, path):
+            data = frames.get((company, channel, path))
+            if data is None:
+                data = read_table(path, columns=[sentiment_col, score_col, time_comment_col])
+                data['company'] = company
+                data['channel'] = channel
+            return aggregate(data, SENTIMENT_KEYS, time_comment_col, sentiment_col, score_col)
+
+        write_sentiment_cubes(cube_dir, [tuple(data_file) for data_file in data_files], build_partial, cube_ext)
@@ -1,38 +1,362 @@
 import pandas as pd
+import numpy as np
 import datetime
+import functools
 import json
+import logging
+import time
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from json.decoder import WHITESPACE
 from dateutil.parser import parse
+from src import metrics
+from src.json_paths import RecordSchema
+from src.table_io import TableWriter
 import re
 import string
 
+logger = logging.getLogger(__name__)
+
+ENTITY_PREFIXES = '@#'
+URL_PATTERN = re.compile(r"http\S+")
+# every punctuation character but the entity prefixes becomes a space. Punctuation is ascii and utf-8 never uses
+# ascii bytes inside multi-byte characters, so translating the encoded bytes is safe and much faster than str.translate
+PUNCTUATION_TABLE = bytes.maketrans(
+    ''.join(separator for separator in string.punctuation if separator not in ENTITY_PREFIXES).encode('ascii'),
+    b' ' * (len(string.punctuation) - len(ENTITY_PREFIXES)))
+# record separator used to clean up a whole column as one string, it is whitespace for both re and str.split
+COLUMN_SEPARATOR = '\x1e'
+
+
+def _replace_punctuation(text):
+    """Helper to replace all punctuation but the entity prefixes with spaces."""
+    return text.encode('utf-8', 'surrogatepass').translate(PUNCTUATION_TABLE).decode('utf-8', 'surrogatepass')
+
+
+def _drop_entity_words(text):
+    """Helper to split text into words, drop the ones starting with an entity prefix and join them back."""
+    if '@' in text or '#' in text:
+        return ' '.join([word for word in text.split() if word[0] not in ENTITY_PREFIXES])
+    return ' '.join(text.split())
+
 
 def _strip_all_entities(text):
     """Helper to delete all the @ and hashtags from text."""
-    entity_prefixes = ['@', '#']
-    for separator in string.punctuation:
-        if separator not in entity_prefixes:
-            text = text.replace(separator, ' ')
-    words = []
-    for word in text.split():
-        word = word.strip()
-        if word:
-            if word[0] not in entity_prefixes:
-                words.append(word)
-    return ' '.join(words)
+    return _drop_entity_words(_replace_punctuation(text))
 
 
 def _text_cleanup(text):
     """Helper to clean up the text."""
     # remove urls
-    text = re.sub(r"http\S+", "", text)
+    text = URL_PATTERN.sub("", text)
     # delete entity
     text = _strip_all_entities(text)
 
     return text
 
 
+def text_cleanup_column(texts):
+    """
+    Clean up a whole column of texts in one call.
+
+    The texts are joined into one string so url removal and punctuation replacement run once over the column, then
+    split back into one cleaned text per row. The output is identical to calling _text_cleanup on every text.
+
+    Args:
+        texts (pd.Series or list): texts to clean up.
+
+    Returns:
+        pd.Series or list: cleaned texts, a series keeps the index of the input.
+    """
+    joined = COLUMN_SEPARATOR.join(texts)
+    if joined.count(COLUMN_SEPARATOR) == max(len(texts) - 1, 0):
+        joined = _replace_punctuation(URL_PATTERN.sub('', joined))
+        cleaned = [_drop_entity_words(text) for text in joined.split(COLUMN_SEPARATOR)] if len(texts) else []
+    else:
+        # a text contains the separator itself, clean up one text at a time
+        cleaned = [_text_cleanup(text) for text in texts]
+
+    if isinstance(texts, pd.Series):
+        return pd.Series(cleaned, index=texts.index, name=texts.name, dtype=object)
+    return cleaned
+
+# twitter created_at, e.g. Wed Oct 10 20:19:24 +0000 2018
+TWEET_TIME_FORMAT = '%a %b %d %H:%M:%S %z %Y'
+DAY_SECONDS = 24 * 3600
+
+
+def tweet_dates(created_at):
+    """
+    Convert tweet created_at strings to the dates they show, as dateutil.parser.parse(value).date() does.
+
+    The strings are parsed in one pass with the twitter time format. Values it does not match, and all of them when
+    they are not in a single utc offset, go through dateutil one at a time.
+
+    Args:
+        created_at (list or np.ndarray): created_at strings.
+
+    Returns:
+        np.ndarray: datetime.date of every value.
+    """
+    values = pd.Series(created_at, dtype=object)
+    with warnings.catch_warnings():
+        # mixed utc offsets give an object series, and a warning on recent pandas
+        warnings.simplefilter('ignore', FutureWarning)
+        try:
+            parsed = pd.to_datetime(values, format=TWEET_TIME_FORMAT, errors='coerce')
+        except ValueError:
+            parsed = None
+    if parsed is None or not pd.api.types.is_datetime64_any_dtype(parsed):
+        return np.array([parse(value).date() for value in values], dtype=object)
+    dates = np.asarray(parsed.dt.date, dtype=object)
+    for i in np.flatnonzero(parsed.isna().to_numpy()):
+        dates[i] = parse(values.iat[i]).date()
+    return dates
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _day_offset(day):
+    """
+    Helper to get the local utc offset in seconds datetime.fromtimestamp applies through a utc day since the epoch, nan
+    when it changes within the day.
+    """
+    start = time.localtime(day * DAY_SECONDS).tm_gmtoff
+    end = time.localtime(day * DAY_SECONDS + DAY_SECONDS - 1).tm_gmtoff
+    return start if start == end else float('nan')
+
+
+def facebook_dates(created_time):
+    """
+    Convert facebook created_time unix timestamps to local dates, as datetime.datetime.fromtimestamp(value).date() does.
+
+    The local utc offset is looked up once per utc day, and cached across calls, and a date is built once per local day,
+    the rest runs in numpy. Timestamps of a day where the offset changes (daylight saving time), and the ones out of the
+    range numpy and the platform localtime both handle, go through datetime.fromtimestamp one at a time.
+
+    Args:
+        created_time (list or np.ndarray): unix timestamps in seconds.
+
+    Returns:
+        np.ndarray: datetime.date of every value, None for timestamps out of the range of dates.
+    """
+    try:
+        seconds = np.floor(np.asarray(created_time, dtype='float64'))
+    except (TypeError, ValueError):
+        seconds = np.floor(pd.to_numeric(pd.Series(created_time, dtype=object), errors='coerce').to_numpy('float64'))
+    dates = np.full(len(seconds), None, dtype=object)
+    vectorized = np.isfinite(seconds) & (seconds >= 0) & (seconds < 1 << 32)
+    if vectorized.any():
+        days, inverse = np.unique(seconds[vectorized] // DAY_SECONDS, return_inverse=True)
+        offsets = np.array([_day_offset(day) for day in days.astype('int64').tolist()], dtype='float64')[inverse]
+        steady = ~np.isnan(offsets)
+        local_days, local_inverse = np.unique((seconds[vectorized] + np.nan_to_num(offsets)) // DAY_SECONDS,
+                                              return_inverse=True)
+        local = np.asarray(pd.to_datetime(local_days, unit='D').date, dtype=object)[local_inverse]
+        positions = np.flatnonzero(vectorized)
+        dates[positions[steady]] = local[steady]
+        vectorized[positions[~steady]] = False
+    for i in np.flatnonzero(~vectorized).tolist():
+        try:
+            dates[i] = datetime.datetime.fromtimestamp(created_time[i]).date()
+        except (TypeError, ValueError, OverflowError, OSError):
+            dates[i] = None
+    return dates
+
+
+# json paths of the scraped records, add a root to support a new schema variant
+FACEBOOK_POST_PAGE = RecordSchema({'posts': ('edges',)}, roots=[('data', 'node', 'timeline_feed_units')])
+FACEBOOK_POST = RecordSchema(
+    {'id': ('feedback', 'id'),
+     'text': ('comet_sections', 'content', 'story', 'comet_sections', 'message', 'story', 'message', 'text'),
+     'reply': ('comet_sections', 'feedback', 'story', 'feedback_context', 'feedback_target_with_context',
+               'ufi_renderer', 'feedback', 'comment_count', 'total_count')},
+    roots=[('node',)])
+FACEBOOK_COMMENT_PAGE = RecordSchema({'comments': ('edges',)}, roots=[('data', 'feedback', 'display_comments')])
+FACEBOOK_COMMENT = RecordSchema(
+    {'text': ('body', 'text'), 'created_time': ('created_time',), 'post_id': ('parent_feedback', 'id')},
+    roots=[('node',)])
+TWEET_CONVERSATION = RecordSchema(
+    {'post': (0, 'content', 'itemContent', 'tweet_results', 'result', 'legacy', 'full_text'),
+     'reply': (0, 'content', 'itemContent', 'tweet_results', 'result', 'legacy', 'reply_count'),
+     'comments': (slice(1, None),)},
+    roots=[('data', 'threaded_conversation_with_injections', 'instructions', 0, 'entries'),
+           ('data', 'user', 'result', 'timeline', 'timeline', 'instructions', 0, 'entries')])
+TWEET_COMMENT = RecordSchema(
+    {'text': ('full_text',), 'created_at': ('created_at',)},
+    roots=[('content', 'items', 0, 'item', 'itemContent', 'tweet_results', 'result', 'legacy')])
+
+
+def _iter_json_array(path, buffer_size=1 << 20):
+    """
+    Yield the items of a top-level json array one at a time without loading the whole file.
+
+    Args:
+        path (str): path to the json file.
+        buffer_size (int): number of characters read at once.
+
+    Returns:
+        generator: parsed array items.
+    """
+    decoder = json.JSONDecoder()
+    with open(path, 'r') as f:
+        buffer = f.read(buffer_size)
+        while buffer.isspace():
+            more = f.read(buffer_size)
+            if not more:
+                break
+            buffer += more
+        # the parsed items are skipped by an index into the buffer, only dropped when it is refilled
+        idx = WHITESPACE.match(buffer).end()
+        if not buffer.startswith('[', idx):
+            raise ValueError('{} does not contain a top-level json array'.format(path))
+        idx += 1
+        eof = False
+        while True:
+            idx = WHITESPACE.match(buffer, idx).end()
+            if buffer.startswith(',', idx):
+                idx = WHITESPACE.match(buffer, idx + 1).end()
+            if buffer.startswith(']', idx):
+                return
+            start = time.perf_counter()
+            try:
+                item, end = decoder.raw_decode(buffer, idx)
+                # an item is only whole once the comma or bracket after it is read, a number may go on in the next read
+                after = WHITESPACE.match(buffer, end).end()
+                complete = eof or buffer[after:after + 1] in (',', ']')
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                complete = False
+            finally:
+                metrics.add_time('json_parse', time.perf_counter() - start)
+            if not complete:
+                # read at least as much as is left so a large item is not re-parsed too many times
+                buffer = buffer[idx:]
+                idx = 0
+                more = f.read(max(buffer_size, len(buffer)))
+                eof = not more
+                buffer += more
+                continue
+            yield item
+            idx = end
+
+
+def _write_chunks(chunks, columns, output_path, date_cols=()):
+    """
+    Write data frame chunks to one csv or parquet file as they come.
+
+    Args:
+        chunks (iterable): data frame chunks sharing the same columns.
+        columns (list): column names, used for the header when there is no chunk at all.
+        output_path (str): output path.
+        date_cols (list): date columns, stored as dates in parquet.
+
+    Returns:
+        int: number of rows written.
+    """
+    writer = TableWriter(output_path, date_cols=date_cols)
+    for chunk in chunks:
+        writer.write(chunk)
+    writer.close(columns=columns)
+    return writer.rows
+
+
+def _facebook_chunk(rows, columns, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL):
+    """Helper to build a facebook chunk, cleaning up its comments and converting their timestamps in one pass."""
+    chunk = pd.DataFrame(rows, columns=columns).astype({REPLY_COL: 'Int64'})
+    has_time = chunk[TIME_COMMENT_COL].notna()
+    with metrics.timer('dates'):
+        chunk[TIME_COMMENT_COL] = chunk[TIME_COMMENT_COL].astype(object)
+        chunk.loc[has_time, TIME_COMMENT_COL] = pd.Series(
+            facebook_dates(chunk.loc[has_time, TIME_COMMENT_COL].to_numpy()), index=chunk.index[has_time], dtype=object)
+    has_comment = chunk[COMMENT_COL].notna()
+    with metrics.timer('cleanup'):
+        chunk.loc[has_comment, COMMENT_COL] = text_cleanup_column(chunk.loc[has_comment, COMMENT_COL])
+    return chunk
+
+
+def iter_data_facebook(path_comment, path_post, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
+                       chunk_size=10000):
+    """
+    Parse the post and comment json files for facebook data and yield the cleaned rows in chunks.
+
+    Posts are kept in memory since there are far fewer of them, comments are streamed and joined to their post as
+    they are parsed. Posts without comments and comments without posts are kept as in an outer join. The rows come
+    in the order of the comment dump followed by the posts without comments, not sorted by post id as the outer join
+    sorted them, which would take every row in memory.
+
+    Args:
+        path_comment (str): path to comment json file.
+        path_post (str): path to post json file.
+        ID_COL (str): id column name.
+        POST_COL (str): post column name.
+        REPLY_COL (str): reply number column name.
+        COMMENT_COL (str): comment column name.
+        TIME_COMMENT_COL (str): time of comment column name.
+        chunk_size (int): number of rows per chunk.
+
+    Returns:
+        generator: pd.DataFrame chunks of posts joined by their comments.
+    """
+    columns = [ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL]
+
+    # posts
+    fb_posts = {}
+    posts_skipped = 0
+    for page in _iter_json_array(path_post):
+        posts = FACEBOOK_POST_PAGE.extract(page)
+        if posts is None:
+            raise ValueError('{} has a post page of unknown schema'.format(path_post))
+        for post in posts[0]:
+            fields = FACEBOOK_POST.extract(post)
+            if fields is None or not isinstance(fields[1], str):
+                posts_skipped += 1
+                continue
+            post_id, text, reply = fields
+            fb_posts.setdefault(post_id, []).append((_text_cleanup(text), reply))
+
+    metrics.increment('posts_parsed', sum(len(posts) for posts in fb_posts.values()))
+    metrics.increment('posts_skipped', posts_skipped)
+
+    # comments, joined to their post by the id
+    commented = set()
+    rows = []
+    parsed = skipped = 0
+    for page in _iter_json_array(path_comment):
+        comments = FACEBOOK_COMMENT_PAGE.extract(page)
+        if comments is None:
+            raise ValueError('{} has a comment page of unknown schema'.format(path_comment))
+        for comment in comments[0]:
+            fields = FACEBOOK_COMMENT.extract(comment)
+            if fields is None or not isinstance(fields[0], str):
+                skipped += 1
+                continue
+            text, created_time, post_id = fields
+            # the timestamps are converted to dates by chunk
+            if not isinstance(created_time, (int, float)) or created_time != created_time:
+                skipped += 1
+                continue
+            parsed += 1
+            commented.add(post_id)
+            for post_text, reply in fb_posts.get(post_id, [(None, None)]):
+                rows.append((post_id, post_text, reply, text, created_time))
+            if len(rows) >= chunk_size:
+                yield _facebook_chunk(rows, columns, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL)
+                rows = []
+
+    metrics.increment('comments_parsed', parsed)
+    metrics.increment('comments_skipped', skipped)
+
+    # posts without comments
+    for post_id, posts in fb_posts.items():
+        if post_id not in commented:
+            rows.extend((post_id, post_text, reply, None, None) for post_text, reply in posts)
+    if rows:
+        yield _facebook_chunk(rows, columns, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL)
+
+
 def process_data_facebook(path_comment, path_post, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
-                          output_path):
+                          output_path, chunk_size=10000):
     """
     Function to parse the post and comment json file for facebook data to get cleaned structured data.
 
@@ -45,61 +369,83 @@ def process_data_facebook(path_comment, path_post, ID_COL, POST_COL, REPLY_COL,
         COMMENT_COL (str): comment column name.
         TIME_COMMENT_COL (str): time of comment column name.
         output_path (str): output path
+        chunk_size (int): number of rows written at once.
 
     Returns:
-        pd.DataFrame: cleaned structured data with post joined by their comments.
+        int: number of rows written.
 
     """
-    # facebook data
-    comment_data = json.load(open(path_comment, 'r'))
-    posts_data = json.load(open(path_post, 'r'))
+    chunks = iter_data_facebook(path_comment, path_post, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
+                                chunk_size)
+    return _write_chunks(chunks, [ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL], output_path,
+                         [TIME_COMMENT_COL])
 
-    # posts
-    all_posts = []
-    ids = []
-    replys = []
-    for posts in posts_data:
-        for post in posts['data']['node']['timeline_feed_units']['edges']:
-            try:
-                post_id = post['node']['feedback']['id']
-                text = \
-                    post['node']['comet_sections']['content']['story']['comet_sections']['message']['story']['message'][
-                        'text']
-                text = _text_cleanup(text)
-                reply = post['node']['comet_sections']['feedback']['story']['feedback_context'][
-                    'feedback_target_with_context']['ufi_renderer']['feedback']['comment_count']['total_count']
-                all_posts.append(text)
-                ids.append(post_id)
-                replys.append(reply)
-            except (KeyError, TypeError) as exception:
-                pass
-    fb_posts_df = pd.DataFrame(list(zip(ids, all_posts, replys)), columns=[ID_COL, POST_COL, REPLY_COL])
-
-    # comments
-    all_comments = []
-    times = []
-    ids = []
-    for post in comment_data:
-        comments = post["data"]["feedback"]["display_comments"]["edges"]
+
+def _tweet_chunk(rows, columns, COMMENT_COL, TIME_COMMENT_COL):
+    """Helper to build a tweet chunk, cleaning up its comments and parsing their times in one pass."""
+    chunk = pd.DataFrame(rows, columns=columns)
+    with metrics.timer('dates'):
+        chunk[TIME_COMMENT_COL] = pd.Series(tweet_dates(chunk[TIME_COMMENT_COL].to_numpy()), index=chunk.index,
+                                            dtype=object)
+    with metrics.timer('cleanup'):
+        chunk[COMMENT_COL] = text_cleanup_column(chunk[COMMENT_COL])
+    return chunk
+
+
+def iter_data_tweet(path, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size=10000):
+    """
+    Parse the tweet json file one tweet at a time and yield the cleaned rows in chunks.
+
+    Args:
+        path (str): path to input tweet json data.
+        ID_COL (str): id column name.
+        POST_COL (str): post column name.
+        REPLY_COL (str): reply number column name.
+        COMMENT_COL (str): comment column name.
+        TIME_COMMENT_COL (str): time of comment column name.
+        chunk_size (int): number of rows per chunk.
+
+    Returns:
+        generator: pd.DataFrame chunks of posts joined by their comments.
+    """
+    columns = [ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL]
+    rows = []
+    posts_parsed = posts_skipped = comments_parsed = comments_skipped = 0
+
+    for i, tweet in enumerate(_iter_json_array(path)):
+        fields = TWEET_CONVERSATION.extract(tweet)
+        if fields is None:
+            posts_skipped += 1
+            continue
+        post, reply, comments = fields
+        post = _text_cleanup(post)
+
+        posts_parsed += 1
+        # posts without comments are dropped, as the output only keeps rows with a comment
         for comment in comments:
-            try:
-                text = comment["node"]["body"]["text"]
-                text = _text_cleanup(text)
-                time = datetime.datetime.fromtimestamp(comment["node"]["created_time"]).date()
-                post_id = comment["node"]["parent_feedback"]["id"]
-                all_comments.append(text)
-                times.append(time)
-                ids.append(post_id)
-            except (KeyError, TypeError) as exception:
-                pass
-    fb_comments_df = pd.DataFrame(list(zip(ids, all_comments, times)), columns=[ID_COL, COMMENT_COL, TIME_COMMENT_COL])
+            comment_fields = TWEET_COMMENT.extract(comment)
+            if comment_fields is None:
+                comments_skipped += 1
+                continue
+            text, created_at = comment_fields
+            # the times are parsed by chunk
+            rows.append((i, post, reply, text, created_at))
+            comments_parsed += 1
 
-    # join the post and comment by the id
-    fb_data = pd.merge(fb_posts_df, fb_comments_df, how='outer', on=ID_COL)
-    fb_data.to_csv(output_path, index=False)
+        if len(rows) >= chunk_size:
+            yield _tweet_chunk(rows, columns, COMMENT_COL, TIME_COMMENT_COL)
+            rows = []
 
+    metrics.increment('posts_parsed', posts_parsed)
+    metrics.increment('posts_skipped', posts_skipped)
+    metrics.increment('comments_parsed', comments_parsed)
+    metrics.increment('comments_skipped', comments_skipped)
+    if rows:
+        yield _tweet_chunk(rows, columns, COMMENT_COL, TIME_COMMENT_COL)
 
-def process_data_tweet(path, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, output_path):
+
+def process_data_tweet(path, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, output_path,
+                       chunk_size=10000):
     """
     Function to parse the post and comment json file for tweet data to get cleaned structured data.
 
@@ -111,72 +457,86 @@ def process_data_tweet(path, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMM
         COMMENT_COL (str): comment column name.
         TIME_COMMENT_COL (str): time of comment column name.
         output_path (str): output path
+        chunk_size (int): number of rows written at once.
 
     Returns:
-        pd.DataFrame: cleaned structured data with post joined by their comments.
+        int: number of rows written.
     """
+    chunks = iter_data_tweet(path, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size)
+    return _write_chunks(chunks, [ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL], output_path,
+                         [TIME_COMMENT_COL])
 
-    data = json.load(open(path, 'r'))
-    all_posts = []
-    post_ids = []
-    replys = []
 
-    all_comments = []
-    comment_times = []
-    comment_ids = []
+def load_manifest(path):
+    """
+    Load a manifest of input dumps.
 
-    for i, tweet in enumerate(data):
-        try:
-            post = tweet['data']['threaded_conversation_with_injections']['instructions'][0]['entries'][0]['content'][
-                'itemContent']['tweet_results']['result']['legacy']['full_text']
-        except KeyError:
-            try:
-                post = tweet['data']['user']['result']['timeline']['timeline']['instructions'][0]['entries'][0]['content'][
-                    'itemContent']['tweet_results']['result']['legacy']['full_text']
-            except KeyError:
-                continue
+    The manifest is a json list with one entry per dump, each with company, channel ("facebook" or "tweet") and
+    output, plus path_post and path_comment for facebook or path_both for tweet.
 
-        post = _text_cleanup(post)
+    Args:
+        path (str): path to the manifest json file.
 
-        try:
-            reply = tweet['data']['threaded_conversation_with_injections']['instructions'][0]['entries'][0]['content'][
-                'itemContent']['tweet_results']['result']['legacy']['reply_count']
-        except KeyError:
-            try:
-                reply = tweet['data']['user']['result']['timeline']['timeline']['instructions'][0]['entries'][0]['content'][
-                    'itemContent']['tweet_results']['result']['legacy']['reply_count']
-            except KeyError:
-                continue
+    Returns:
+        list: manifest entries.
+    """
+    with open(path, 'r') as f:
+        entries = json.load(f)
+    for entry in entries:
+        required = {'facebook': ['path_post', 'path_comment'], 'tweet': ['path_both']}.get(entry.get('channel'))
+        if required is None:
+            raise ValueError('unknown channel in manifest entry: {}'.format(entry))
+        missing = [key for key in ['company', 'output'] + required if not entry.get(key)]
+        if missing:
+            raise ValueError('manifest entry is missing {}: {}'.format(', '.join(missing), entry))
+    return entries
 
-        all_posts.append(post)
-        post_ids.append(i)
-        replys.append(reply)
 
-        try:
-            comments = tweet['data']['threaded_conversation_with_injections']['instructions'][0]['entries'][1:]
-        except KeyError:
-            try:
-                comments = tweet['data']['user']['result']['timeline']['timeline']['instructions'][0]['entries'][1:]
-            except KeyError:
-                continue
+def _process_entry(entry, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size):
+    """Helper to process one manifest entry and report its timing and row count."""
+    start = time.perf_counter()
+    if entry['channel'] == 'facebook':
+        rows = process_data_facebook(entry['path_comment'], entry['path_post'], ID_COL, POST_COL, REPLY_COL,
+                                     COMMENT_COL, TIME_COMMENT_COL, entry['output'], chunk_size)
+    else:
+        rows = process_data_tweet(entry['path_both'], ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
+                                  entry['output'], chunk_size)
+    return {'company': entry['company'], 'channel': entry['channel'], 'output': entry['output'],
+            'rows': rows, 'seconds': round(time.perf_counter() - start, 3)}
 
-        for comment in comments:
+
+def process_data_batch(entries, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size=10000,
+                       max_workers=None):
+    """
+    Process every dump of a manifest in a process pool, writing one output per entry.
+
+    A failing entry is reported with its error and does not stop the others.
+
+    Args:
+        entries (list): manifest entries, see load_manifest.
+        ID_COL (str): id column name.
+        POST_COL (str): post column name.
+        REPLY_COL (str): reply number column name.
+        COMMENT_COL (str): comment column name.
+        TIME_COMMENT_COL (str): time of comment column name.
+        chunk_size (int): number of rows written at once.
+        max_workers (int): number of worker processes, None to use all cores.
+
+    Returns:
+        list: one report per entry with company, channel, output, rows and seconds, or error if it failed.
+    """
+    reports = []
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_process_entry, entry, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
+                                   chunk_size) for entry in entries]
+        for entry, future in zip(entries, futures):
             try:
-                text = comment['content']['items'][0]['item']['itemContent']['tweet_results']['result']['legacy'][
-                    'full_text']
-                text = _text_cleanup(text)
-                time = parse(
-                    comment['content']['items'][0]['item']['itemContent']['tweet_results']['result']['legacy'][
-                        'created_at']).date()
-                all_comments.append(text)
-                comment_times.append(time)
-                comment_ids.append(i)
-            except KeyError as exception:
-                pass
-    tw_posts_df = pd.DataFrame(list(zip(post_ids, all_posts, replys)),
-                               columns=[ID_COL, POST_COL, REPLY_COL])
-    tw_comments_df = pd.DataFrame(list(zip(comment_ids, all_comments, comment_times)),
-                                  columns=[ID_COL, COMMENT_COL, TIME_COMMENT_COL])
-    tw_data = pd.merge(tw_posts_df, tw_comments_df, how='outer', on=ID_COL)
-    tw_data = tw_data.dropna(subset=[COMMENT_COL])
-    tw_data.to_csv(output_path, index=False)
+                report = future.result()
+                logger.info('%s %s: %d rows in %.3fs -> %s', report['company'], report['channel'], report['rows'],
+                            report['seconds'], report['output'])
+            except Exception as exception:
+                report = {'company': entry['company'], 'channel': entry['channel'], 'output': entry['output'],
+                          'error': repr(exception)}
+                logger.error('%s %s failed: %r', entry['company'], entry['channel'], exception)
+            reports.append(report)
+    return reports
@@ -0,0 +1,230 @@
+import datetime
+import logging
+import os
+import sqlite3
+from collections import Counter
+import pandas as pd
+from src import metrics
+from src.dashboard_cubes import CLASS_PREFIX, SHARE_PREFIX
+
+logger = logging.getLogger(__name__)
+
+# Persistent query index over the entity dashboard rows. The rows are kept in one sqlite table clustered by its primary
+# key (entity, company, channel, time): all the rows of an entity form one contiguous range, split into company and
+# channel partitions sorted by time. An entity query with company, channel and time filters reads only its range
+# through the key instead of scanning the entity output, and secondary indexes cover queries by company, type or time
+# range without an entity. Every data file is recorded with its size and modification time, so an update only
+# reindexes the files that are new or changed and drops the rows of the removed ones.
+ROW_COLUMNS = ['entity', 'type', 'time', 'sentiment', 'score', 'company', 'channel']
+# group by keys of the aggregate queries and the column expression of each
+GROUP_KEYS = {'entity': 'entity', 'type': 'type', 'company': 'company', 'channel': 'channel', 'day': 'time',
+              'month': 'substr(time, 1, 7)'}
+# stored time of the rows without a date, it sorts before every date
+NO_TIME = ''
+
+
+def _day(value):
+    """Helper to check an ISO date argument, e.g. 2021-09-02."""
+    return datetime.date.fromisoformat(str(value)).isoformat()
+
+
+class EntityIndex:
+    """
+    SQLite index of the entity rows of data files, answering filter and aggregate queries.
+
+    Args:
+        path (str): path to the sqlite database file.
+        entity_col (str): entity column the rows come from, an index only holds the rows of one entity column.
+    """
+
+    def __init__(self, path, entity_col=None):
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30)
+        self._conn.executescript('''
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+            PRAGMA cache_size = -65536;
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS files (file_id INTEGER PRIMARY KEY, company TEXT, channel TEXT, path TEXT,
+                                              size INTEGER, mtime_ns INTEGER, rows INTEGER, last_day TEXT,
+                                              UNIQUE (company, channel, path));
+            CREATE TABLE IF NOT EXISTS entities (entity TEXT NOT NULL, company TEXT NOT NULL, channel TEXT NOT NULL,
+                                                 time TEXT NOT NULL, file_id INTEGER NOT NULL, row INTEGER NOT NULL,
+                                                 type TEXT, sentiment TEXT, score REAL,
+                                                 PRIMARY KEY (entity, company, channel, time, file_id, row))
+                WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS entities_partition ON entities (company, channel, time);
+            CREATE INDEX IF NOT EXISTS entities_type ON entities (type, company, channel, time);
+            CREATE INDEX IF NOT EXISTS entities_time ON entities (time);
+            CREATE INDEX IF NOT EXISTS entities_file ON entities (file_id);
+        ''')
+        stored = self._conn.execute("SELECT value FROM meta WHERE key = 'entity_col'").fetchone()
+        if entity_col is not None:
+            if stored is None:
+                with self._conn:
+                    self._conn.execute("INSERT INTO meta VALUES ('entity_col', ?)", (entity_col,))
+            elif stored[0] != entity_col:
+                raise ValueError('{} indexes the {} column, not {}'.format(path, stored[0], entity_col))
+        self.entity_col = entity_col if stored is None else stored[0]
+
+    def close(self):
+        """Close the database."""
+        self._conn.close()
+
+    def update(self, data_files, build_rows):
+        """
+        Index the rows of the data files that are new or changed and drop the rows of the files no longer listed.
+
+        Args:
+            data_files (list): (company, channel, path) tuples of the data files.
+            build_rows (callable): function mapping (company, channel, path) to the entity rows of one data file,
+                with the columns of ROW_COLUMNS.
+
+        Returns:
+            dict: number of files indexed, reused and removed, and number of rows indexed.
+        """
+        known = {tuple(row[1:4]): (row[0],) + tuple(row[4:]) for row in self._conn.execute(
+            'SELECT file_id, company, channel, path, size, mtime_ns FROM files')}
+        report = {'indexed': 0, 'reused': 0, 'removed': 0, 'rows': 0}
+        for company, channel, path in data_files:
+            key = (company, channel, os.path.abspath(path))
+            stat = os.stat(path)
+            record = known.pop(key, None)
+            if record is not None and record[1:] == (stat.st_size, stat.st_mtime_ns):
+                report['reused'] += 1
+                continue
+            rows = build_rows(company, channel, path)
+            with metrics.timer('entity_index_update'), self._conn:
+                if record is not None:
+                    self._remove(record[0])
+                report['rows'] += self._insert(key, stat, rows)
+            report['indexed'] += 1
+
+        with self._conn:
+            for file_id, _, _ in known.values():
+                self._remove(file_id)
+                report['removed'] += 1
+        metrics.increment('entity_index_rows', report['rows'])
+        logger.info('entity index: %d files indexed, %d reused, %d removed, %d rows', report['indexed'],
+                    report['reused'], report['removed'], report['rows'])
+        return report
+
+    def _remove(self, file_id):
+        """Helper to drop a file and its rows, in the transaction of the caller."""
+        self._conn.execute('DELETE FROM entities WHERE file_id = ?', (file_id,))
+        self._conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
+
+    def _insert(self, key, stat, rows):
+        """Helper to add a file and its rows, in the transaction of the caller."""
+        times = pd.to_datetime(rows['time'], errors='coerce').dt.strftime('%Y-%m-%d').fillna(NO_TIME)
+        scores = pd.to_numeric(rows['score'], errors='coerce').astype(object)
+        scores = scores.where(scores.notna(), None)
+        last_day = max((time for time in times if time != NO_TIME), default=None)
+        # rows go in in key order, appending to the ranges of the clustered table instead of splitting its pages
+        rows = rows.assign(time=times.to_numpy(), score=scores.to_numpy(), row=range(len(rows)))
+        rows = rows.sort_values(['entity', 'company', 'channel', 'time'], kind='stable')
+        file_id = self._conn.execute(
+            'INSERT INTO files (company, channel, path, size, mtime_ns, rows, last_day) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            key + (stat.st_size, stat.st_mtime_ns, len(rows), last_day)).lastrowid
+        self._conn.executemany(
+            'INSERT INTO entities VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            zip(rows['entity'].astype(str), rows['company'].astype(str), rows['channel'].astype(str), rows['time'],
+                [file_id] * len(rows), rows['row'], rows['type'].where(rows['type'].notna(), None),
+                rows['sentiment'].where(rows['sentiment'].notna(), None), rows['score']))
+        return len(rows)
+
+    def last_day(self):
+        """Get the latest date of the indexed rows as an ISO string, None when the index is empty."""
+        return self._conn.execute('SELECT MAX(last_day) FROM files').fetchone()[0]
+
+    @staticmethod
+    def _where(entity=None, companies=None, channels=None, entity_type=None, start=None, end=None):
+        """Helper to build the where clause of the query filters and its parameters."""
+        clauses = []
+        params = []
+        for column, value in (('entity', entity), ('type', entity_type)):
+            if value is not None:
+                clauses.append(column + ' = ?')
+                params.append(value)
+        for column, values in (('company', companies), ('channel', channels)):
+            if values:
+                clauses.append('{} IN ({})'.format(column, ','.join('?' * len(values))))
+                params.extend(values)
+        if start is not None or end is not None:
+            # rows without a date are left out of time ranges
+            clauses.append('time BETWEEN ? AND ?')
+            params.extend([_day(start) if start is not None else '0000-01-01',
+                           _day(end) if end is not None else '9999-12-31'])
+        return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+    def query(self, entity=None, companies=None, channels=None, entity_type=None, start=None, end=None, limit=None):
+        """
+        Get the entity rows matching the filters, by entity, company, channel and time.
+
+        Args:
+            entity (str): normalized entity, as in the entity output, None for every entity.
+            companies (list): companies to keep, None for all.
+            channels (list): channels to keep, None for all.
+            entity_type (str): entity type to keep, e.g. ORG, None for all.
+            start (str): first day of the time range as an ISO date, None for no lower bound.
+            end (str): last day of the time range as an ISO date, included, None for no upper bound.
+            limit (int): maximum number of rows, None for all.
+
+        Returns:
+            pd.DataFrame: matching rows with the columns of the entity output.
+        """
+        where, params = self._where(entity, companies, channels, entity_type, start, end)
+        sql = 'SELECT {} FROM entities{} ORDER BY entity, company, channel, time, file_id, row'.format(
+            ', '.join(ROW_COLUMNS), where)
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with metrics.timer('entity_index_query'):
+            rows = pd.DataFrame(self._conn.execute(sql, params).fetchall(), columns=ROW_COLUMNS)
+        rows['time'] = rows['time'].replace(NO_TIME, None)
+        return rows
+
+    def aggregate(self, group_by=(), entity=None, companies=None, channels=None, entity_type=None, start=None,
+                  end=None):
+        """
+        Get the sentiment statistics of the entity rows matching the filters, see query for the filters.
+
+        Args:
+            group_by (list): keys of GROUP_KEYS to group by, none for one row over all the matching rows.
+
+        Returns:
+            pd.DataFrame: one row per group with count, score_sum, score_count, one sentiment_<class> count per class,
+                score_mean and one share_<class> per class, as in the dashboard cubes.
+        """
+        unknown = [key for key in group_by if key not in GROUP_KEYS]
+        if unknown:
+            raise ValueError('unknown group by keys: {}'.format(', '.join(unknown)))
+        where, params = self._where(entity, companies, channels, entity_type, start, end)
+        columns = [GROUP_KEYS[key] for key in group_by]
+        selected = ''.join(column + ', ' for column in columns)
+        sql = ('SELECT {0}sentiment, COUNT(*), TOTAL(score), COUNT(score) FROM entities{1} GROUP BY {0}sentiment '
+               'ORDER BY {0}sentiment').format(selected, where)
+        with metrics.timer('entity_index_query'):
+            rows = self._conn.execute(sql, params).fetchall()
+
+        groups = {}
+        for row in rows:
+            key = row[:len(columns)]
+            sentiment, count, score_sum, score_count = row[len(columns):]
+            stats = groups.setdefault(key, Counter(count=0, score_sum=0, score_count=0))
+            stats['count'] += count
+            stats['score_sum'] += score_sum
+            stats['score_count'] += score_count
+            if sentiment is not None:
+                stats[CLASS_PREFIX + sentiment] += count
+        result = pd.DataFrame([dict(zip(group_by, key), **stats) for key, stats in groups.items()])
+        class_cols = sorted(col for col in result.columns if col.startswith(CLASS_PREFIX))
+        result = result.reindex(columns=list(group_by) + ['count', 'score_sum', 'score_count'] + class_cols)
+        result[class_cols] = result[class_cols].fillna(0).astype('int64')
+        for key in ('day', 'month'):
+            if key in group_by:
+                result[key] = result[key].replace(NO_TIME, None)
+        result['score_mean'] = result['score_sum'] / result['score_count'].where(result['score_count'] > 0)
+        for col in class_cols:
+            result[SHARE_PREFIX + col[len(CLASS_PREFIX):]] = result[col] / result['count'].where(result['count'] > 0)
+        return result
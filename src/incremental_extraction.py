@@ -0,0 +1,98 @@
+import hashlib
+import logging
+import os
+import pandas as pd
+from src.table_io import entity_strings, is_parquet, read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+# Rows are keyed by their post id and a hash of the comment text. Repeated (id, comment) pairs get an occurrence
+# number so every row keeps its own key.
+KEY_SEPARATOR = '\x1f'
+
+
+def row_keys(data, ID_COL, COMMENT_COL):
+    """
+    Get the stable key of every row of a processed table.
+
+    Args:
+        data (pd.DataFrame): processed data.
+        ID_COL (str): id column name.
+        COMMENT_COL (str): comment column name.
+
+    Returns:
+        pd.Series: row keys, aligned with the data index.
+    """
+    comments = data[COMMENT_COL].fillna('').astype(str)
+    keys = [str(post_id) + KEY_SEPARATOR + hashlib.sha1(comment.encode('utf-8')).hexdigest()
+            for post_id, comment in zip(data[ID_COL], comments)]
+    keys = pd.Series(keys, index=data.index, dtype=object)
+    occurrence = keys.groupby(keys).cumcount().astype(str)
+    return keys + KEY_SEPARATOR + occurrence
+
+
+def _temporary_path(path):
+    """Helper to get a temporary path next to the output that keeps its extension."""
+    base, ext = os.path.splitext(path)
+    return base + '.tmp' + ext
+
+
+def incremental_extraction(data_path, output_path, analyze, ID_COL, COMMENT_COL, entity_cols=(), date_cols=()):
+    """
+    Analyze only the rows of the processed data that are missing from the existing output and merge them into it.
+
+    Rows of the output that are no longer in the data are dropped, the merged output follows the order of the data and
+    replaces the previous one atomically, so an interrupted run leaves the previous output untouched.
+
+    Args:
+        data_path (str): path to the processed data.
+        output_path (str): path to the extraction output, created if it does not exist.
+        analyze (callable): function adding the analysis columns to a data frame and returning it.
+        ID_COL (str): id column name.
+        COMMENT_COL (str): comment column name.
+        entity_cols (list): entity columns of the output.
+        date_cols (list): date columns of the output.
+
+    Returns:
+        None
+    """
+    if ID_COL is None:
+        raise ValueError('ID_COL is required for incremental extraction')
+
+    data = read_table(data_path)
+    keys = row_keys(data, ID_COL, COMMENT_COL)
+
+    if os.path.exists(output_path):
+        if is_parquet(output_path):
+            previous = read_table(output_path)
+            for col in entity_cols:
+                if col in previous:
+                    previous[col] = entity_strings(previous[col])
+            previous.index = row_keys(previous, ID_COL, COMMENT_COL)
+        else:
+            # keep the 'N/A' records of failed analyses as they were written, but key the rows with the missing
+            # values of read_table like the data, so a comment written as NA gets the same key on both sides
+            previous = pd.read_csv(output_path, keep_default_na=False, na_values=[''])
+            previous.index = row_keys(read_table(output_path, columns=[ID_COL, COMMENT_COL]), ID_COL, COMMENT_COL)
+    else:
+        previous = pd.DataFrame()
+
+    is_new = ~keys.isin(previous.index)
+    analyzed = analyze(data[is_new.values].copy())
+    analyzed.index = keys[is_new.values].values
+    # kept rows take their input columns from the data, e.g. updated reply counts, and only reuse the analysis
+    kept = data[~is_new.values].copy()
+    kept.index = keys[~is_new.values].values
+    kept = kept.join(previous[[col for col in previous.columns if col not in data.columns]])
+    logger.info('incremental extraction: %d rows, %d new, %d kept, %d dropped',
+                len(data), len(analyzed), len(kept), len(previous) - len(kept))
+
+    # the analyzed frame always has the full set of output columns, even without new rows
+    columns = list(analyzed.columns)
+    # empty frames are left out of the concat so they don't turn int columns into floats
+    merged = pd.concat([frame for frame in (kept, analyzed) if len(frame)] or [analyzed])
+    merged = merged.loc[keys.values, columns].reset_index(drop=True)
+
+    temporary_path = _temporary_path(output_path)
+    write_table(merged, temporary_path, entity_cols, date_cols)
+    os.replace(temporary_path, output_path)
@@ -0,0 +1,74 @@
+# Scraped records come in several schema variants that hold the same fields under different containers. A
+# RecordSchema lists the fields once, as paths relative to a root container, along with the path of the root in every
+# variant. Paths are walked step by step, checking every key and index before it is followed instead of raising and
+# catching KeyError, which is where most of the time went when records of another variant or entries without the
+# fields (cursors, conversation modules...) went through a try/except ladder.
+_MISSING = object()
+
+
+def _check_step(step):
+    """Helper to reject path steps that are not keys, indexes or slices without a step."""
+    if isinstance(step, slice):
+        if step.step is not None:
+            raise ValueError('slices with a step are not supported in json paths')
+    elif not isinstance(step, str) and (not isinstance(step, int) or isinstance(step, bool)):
+        raise ValueError('json path steps must be keys, indexes or slices, got {!r}'.format(step))
+
+
+def _follow(node, path):
+    """Helper to follow a path of keys, indexes and slices from a parsed json value, _MISSING when it isn't there."""
+    for step in path:
+        if isinstance(node, dict):
+            # json keys are strings, an index step on a dict is missing too
+            node = node.get(step, _MISSING)
+            if node is _MISSING:
+                return node
+        elif isinstance(node, list) and not isinstance(step, str):
+            if isinstance(step, int) and not -len(node) <= step < len(node):
+                return _MISSING
+            node = node[step]
+        else:
+            return _MISSING
+    return node
+
+
+class RecordSchema:
+    """
+    Fields to pull out of parsed json records (dicts and lists) that come in several schema variants.
+
+    Args:
+        fields (dict): mapping from field names to their paths (tuples of keys, indexes and slices) from the root.
+        roots (list): paths of the root container in every schema variant, tried in order.
+    """
+
+    def __init__(self, fields, roots=((),)):
+        self.names = tuple(fields)
+        self.roots = [tuple(root) for root in roots]
+        self.paths = [tuple(path) for path in fields.values()]
+        for path in self.roots + self.paths:
+            for step in path:
+                _check_step(step)
+
+    def extract(self, record):
+        """
+        Get the field values of a record from the first schema variant it matches.
+
+        Args:
+            record: parsed json record.
+
+        Returns:
+            tuple: field values in the order of the fields, None when the record matches no variant.
+        """
+        for root_path in self.roots:
+            root = _follow(record, root_path)
+            if root is _MISSING:
+                continue
+            values = []
+            for path in self.paths:
+                value = _follow(root, path)
+                if value is _MISSING:
+                    break
+                values.append(value)
+            else:
+                return tuple(values)
+        return None
@@ -0,0 +1,118 @@
+import contextlib
+import json
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+
+# Process wide counters and latency samples. The pipeline steps and the analyzers record into them whether or not a
+# metrics file is configured, recording is a dict update under a lock. Once configured, every step appends one json line
+# with its counters and the total and percentiles of every timer to the metrics file.
+PERCENTILES = (50, 90, 99)
+
+
+def _percentile(sorted_values, percent):
+    """Helper to get the nearest rank percentile of sorted values."""
+    rank = math.ceil(percent / 100 * len(sorted_values))
+    return sorted_values[max(rank, 1) - 1]
+
+
+class Metrics:
+    """
+    Counters and timers of a pipeline run, written to a json lines file.
+
+    Args:
+        path (str): path to the json lines metrics file, None to only keep the metrics in memory.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.context = {}
+        self._counters = Counter()
+        self._samples = defaultdict(list)
+        self._lock = threading.Lock()
+
+    def configure(self, path, **context):
+        """
+        Set the metrics file and the fields added to every record, e.g. the step name.
+
+        Args:
+            path (str): path to the json lines metrics file, None to only keep the metrics in memory.
+            context: fields added to every record.
+        """
+        self.path = path
+        self.context = context
+
+    def increment(self, name, value=1):
+        """Add to a counter."""
+        with self._lock:
+            self._counters[name] += value
+
+    def add_time(self, name, seconds):
+        """Add to the total time of a step too frequent to keep every sample of, counted as <name>_seconds."""
+        self.increment(name + '_seconds', seconds)
+
+    def observe(self, name, seconds):
+        """Record one latency sample of a timer."""
+        with self._lock:
+            self._samples[name].append(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time a block and record it as one latency sample of the given timer."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def summary(self):
+        """
+        Get the counters and the count, total, mean, percentiles and maximum of every timer.
+
+        Returns:
+            dict: counters and timers.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {name: sorted(values) for name, values in self._samples.items()}
+        timers = {}
+        for name, values in samples.items():
+            timer = {'count': len(values), 'total_seconds': sum(values), 'mean_seconds': sum(values) / len(values)}
+            for percent in PERCENTILES:
+                timer['p{}_seconds'.format(percent)] = _percentile(values, percent)
+            timer['max_seconds'] = values[-1]
+            timers[name] = timer
+        return {'counters': counters, 'timers': timers}
+
+    def emit(self, record):
+        """Append a record, along with the context fields and a timestamp, to the metrics file."""
+        if self.path is None:
+            return
+        record = dict(self.context, time=time.time(), **record)
+        with self._lock:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    def flush(self, **fields):
+        """Emit the summary of the metrics recorded so far with the given fields and start over."""
+        self.emit(dict(fields, **self.summary()))
+        self.reset()
+
+    def reset(self):
+        """Clear the counters and timers."""
+        with self._lock:
+            self._counters.clear()
+            self._samples.clear()
+
+
+_METRICS = Metrics()
+configure = _METRICS.configure
+increment = _METRICS.increment
+add_time = _METRICS.add_time
+observe = _METRICS.observe
+timer = _METRICS.timer
+summary = _METRICS.summary
+emit = _METRICS.emit
+flush = _METRICS.flush
+reset = _METRICS.reset
@@ -1,5 +1,25 @@
+import logging
 import re
-import pandas as pd
+import time
+import torch
+from src import metrics
+from src.analysis_utils import analyze_filtered, extract_file
+from src.analysis_cache import cache_version, cached_batch
+from src.text_filter import SKIPPED_ENTITY, SKIPPED_SENTIMENT
+
+logger = logging.getLogger(__name__)
+
+CACHE_BACKEND = 'open_source'
+
+
+EMOJI_PATTERN = re.compile(r""" [\U0001F600-\U0001F64F] # emoticons \
+                                 |\
+                                 [\U0001F300-\U0001F5FF] # symbols & pictographs\
+                                 |\
+                                 [\U0001F680-\U0001F6FF] # transport & map symbols\
+                                 |\
+                                 [\U0001F1E0-\U0001F1FF] # flags (iOS)\
+                          """, re.VERBOSE)
 
 
 def _give_emoji_free_text(text):
@@ -12,19 +32,28 @@ def _give_emoji_free_text(text):
     Returns:
         str: cleaned text.
     """
-    emoji_pattern = re.compile(r""" [\U0001F600-\U0001F64F] # emoticons \
-                                     |\
-                                     [\U0001F300-\U0001F5FF] # symbols & pictographs\
-                                     |\
-                                     [\U0001F680-\U0001F6FF] # transport & map symbols\
-                                     |\
-                                     [\U0001F1E0-\U0001F1FF] # flags (iOS)\
-                              """, re.VERBOSE)
+    return EMOJI_PATTERN.sub('', text)
+
 
-    return emoji_pattern.sub('', text)
+def _sentiment_cache_version(model, sentiment_score_map):
+    """Helper to get the cache version of sentiment results, the int8 and onnx backends have versions of their own."""
+    backend = getattr(model, 'sentiment_backend', None)
+    if backend is None:
+        return cache_version(model.model.name_or_path, sorted(sentiment_score_map.items()))
+    return cache_version(model.model.name_or_path, sorted(sentiment_score_map.items()), backend)
 
 
-def get_sentiment(text, model, sentiment_score_map):
+def _entity_cache_version(ner, blacklist):
+    """Helper to get the cache version of entity results."""
+    return cache_version(ner.meta['lang'], ner.meta['name'], ner.meta['version'], sorted(blacklist))
+
+
+def _is_cacheable_sentiment(result):
+    """Helper to keep failed sentiment records out of the cache."""
+    return result['sentiment'] != 'N/A'
+
+
+def get_sentiment(text, model, sentiment_score_map, cache=None):
     """
     Given a text string, get sentiment analysis results.
 
@@ -32,14 +61,22 @@ def get_sentiment(text, model, sentiment_score_map):
         text (str): target text.
         model (transformer sentiment model): sentiment model.
         sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
 
     Returns:
         dict: information dictionary containing sentiment class, prediction confidence and corresponding sentiment score.
     """
+    if cache is not None:
+        return cached_batch([text], cache, CACHE_BACKEND, 'sentiment',
+                            _sentiment_cache_version(model, sentiment_score_map),
+                            lambda texts: [get_sentiment(texts[0], model, sentiment_score_map)],
+                            _is_cacheable_sentiment)[0]
+
     # if api failed, returned failed record
     try:
         result = model(text)[0]
     except:
+        metrics.increment('sentiment_failures')
         return {"sentiment": 'N/A',
                 "confidence": 0,
                 "score": 0}
@@ -49,7 +86,66 @@ def get_sentiment(text, model, sentiment_score_map):
             "score": sentiment_score_map[result['label']]}
 
 
-def get_entity(text, ner, blacklist):
+def _predict_sentiment_batch(texts, model):
+    """Helper to run one padded forward pass of the sentiment pipeline's tokenizer and model."""
+    encoded = model.tokenizer(texts, padding=True, return_tensors='pt')
+    with torch.no_grad():
+        logits = model.model(**encoded).logits
+    scores, label_ids = torch.softmax(logits, dim=-1).max(dim=-1)
+    id2label = model.model.config.id2label
+    return [{'label': id2label[label_id], 'score': score} for label_id, score in zip(label_ids.tolist(), scores.tolist())]
+
+
+def get_sentiment_batch(texts, model, sentiment_score_map, batch_size=32, cache=None):
+    """
+    Given a list of text strings, get sentiment analysis results batch by batch.
+
+    Texts are sorted by length before being cut into batches so each batch pads to similar lengths. When a batch
+    fails, its texts fall back to get_sentiment one by one, so only the failing texts get the N/A record.
+
+    Args:
+        texts (list): list of target texts.
+        model (transformer sentiment model): sentiment model.
+        sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        batch_size (int): number of texts per forward pass.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+
+    Returns:
+        list: information dictionaries in the same order as the input texts.
+    """
+    if cache is not None:
+        return cached_batch(texts, cache, CACHE_BACKEND, 'sentiment', _sentiment_cache_version(model, sentiment_score_map),
+                            lambda misses: get_sentiment_batch(misses, model, sentiment_score_map, batch_size),
+                            _is_cacheable_sentiment)
+
+    results = [None] * len(texts)
+    order = sorted(range(len(texts)), key=lambda i: len(texts[i]))
+    for start in range(0, len(order), batch_size):
+        batch_index = order[start:start + batch_size]
+        batch = [texts[i] for i in batch_index]
+        try:
+            with metrics.timer('sentiment_batch'):
+                predictions = _predict_sentiment_batch(batch, model)
+        except:
+            metrics.increment('sentiment_batch_failures')
+            for i, text in zip(batch_index, batch):
+                results[i] = get_sentiment(text, model, sentiment_score_map)
+            continue
+
+        for i, result in zip(batch_index, predictions):
+            results[i] = {"sentiment": result['label'],
+                          "confidence": result['score'],
+                          "score": sentiment_score_map[result['label']]}
+
+    return results
+
+
+def _format_entities(doc, blacklist):
+    """Helper to join the unique non-blacklisted entities of a spacy doc into the 'text,LABEL|...' format."""
+    return '|'.join(dict.fromkeys(e.text + ',' + e.label_ for e in doc.ents if e.label_ not in blacklist))
+
+
+def get_entity(text, ner, blacklist, cache=None):
     """
     Given a text string, get sentiment analysis results.
 
@@ -57,18 +153,128 @@ def get_entity(text, ner, blacklist):
         text (str): target text.
         ner (spacy ner pipeline): ner model.
         blacklist (list): list of entity type that we don't want to include.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
 
     Returns:
         list: list of extracted entity along with the entity type (separate by comma)
     """
-    text = ner(_give_emoji_free_text(text))
-    return '|'.join(list(set([e.text + ',' + e.label_ for e in text.ents if e.label_ not in blacklist])))
+    if cache is not None:
+        return cached_batch([text], cache, CACHE_BACKEND, 'entity', _entity_cache_version(ner, blacklist),
+                            lambda texts: [get_entity(texts[0], ner, blacklist)])[0]
+    return _format_entities(ner(_give_emoji_free_text(text)), blacklist)
+
+
+def get_entity_batch(texts, ner, blacklist, batch_size=256, n_process=1, cache=None):
+    """
+    Given a list of text strings, stream them through the ner pipeline to get their entities.
+
+    Args:
+        texts (list): list of target texts.
+        ner (spacy ner pipeline): ner model.
+        blacklist (list): list of entity type that we don't want to include.
+        batch_size (int): number of texts buffered per spacy batch.
+        n_process (int): number of worker processes, -1 to use all cores.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+
+    Returns:
+        list: entity strings in the same order as the input texts.
+    """
+    if cache is not None:
+        return cached_batch(texts, cache, CACHE_BACKEND, 'entity', _entity_cache_version(ner, blacklist),
+                            lambda misses: get_entity_batch(misses, ner, blacklist, batch_size, n_process))
+
+    docs = ner.pipe((_give_emoji_free_text(text) for text in texts), batch_size=batch_size, n_process=n_process)
+    results = []
+    start = time.perf_counter()
+    # docs come out one by one, every batch_size of them is timed as one batch
+    for doc in docs:
+        results.append(_format_entities(doc, blacklist))
+        if len(results) % batch_size == 0 or len(results) == len(texts):
+            metrics.observe('ner_batch', time.perf_counter() - start)
+            start = time.perf_counter()
+    return results
+
+
+def analyze_text_columns(data, POST_COL, COMMENT_COL, SENTIMENT_COL,
+                         CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL, ENTITY_COMMENT_COL,
+                         transformer_sentiment_analyzer, spacy_ner, entity_blacklist, sentiment_score_map,
+                         batch_size=32, ner_batch_size=256, n_process=1, cache=None, text_filter=None):
+    """
+    Add the sentiment and entity columns to a data frame of posts and comments.
+
+    Args:
+        data (pd.DataFrame): processed data, modified in place.
+        POST_COL (str): post column name.
+        COMMENT_COL (str): comment column name.
+        SENTIMENT_COL (str): sentiment column name.
+        CONFIDENCE_COL (str): sentiment prediction confidence column name.
+        SCORE_COL (str): sentiment score column name.
+        ENTITY_POST_COL (str): post entity column name.
+        ENTITY_COMMENT_COL (str): comment entity column name.
+        transformer_sentiment_analyzer (transformer sentiment model): sentiment model.
+        spacy_ner (spacy ner pipeline): ner model.
+        entity_blacklist (list): list of entity type that we don't want to include.
+        sentiment_score_map (dict): mapping from sentiment class to quantitative score.
+        batch_size (int): number of comments per sentiment model forward pass.
+        ner_batch_size (int): number of texts buffered per spacy batch.
+        n_process (int): number of spacy worker processes, -1 to use all cores.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        text_filter (TextFilter): filter of the texts not worth analyzing, None to analyze every cell.
+
+    Returns:
+        pd.DataFrame: the data with the new columns.
+    """
+    data = fill_text_columns(
+        data, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL, ENTITY_COMMENT_COL,
+        lambda texts: get_sentiment_batch(texts, transformer_sentiment_analyzer, sentiment_score_map, batch_size, cache),
+        lambda texts: get_entity_batch(texts, spacy_ner, entity_blacklist, ner_batch_size, n_process, cache),
+        text_filter)
+    if cache is not None:
+        logger.info('analysis cache: %s', cache.stats())
+    return data
+
+
+def fill_text_columns(data, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL,
+                      ENTITY_COMMENT_COL, analyze_sentiment, analyze_entities, text_filter=None):
+    """
+    Add the sentiment and entity columns to a data frame of posts and comments with the given batch analyzers.
+
+    Args:
+        data (pd.DataFrame): processed data, modified in place.
+        POST_COL (str): post column name.
+        COMMENT_COL (str): comment column name.
+        SENTIMENT_COL (str): sentiment column name.
+        CONFIDENCE_COL (str): sentiment prediction confidence column name.
+        SCORE_COL (str): sentiment score column name.
+        ENTITY_POST_COL (str): post entity column name.
+        ENTITY_COMMENT_COL (str): comment entity column name.
+        analyze_sentiment (callable): function mapping a list of texts to their sentiment information dictionaries.
+        analyze_entities (callable): function mapping a list of texts to their entity strings.
+        text_filter (TextFilter): filter of the texts not worth analyzing, their rows get the skipped results. None to
+            analyze every cell.
+
+    Returns:
+        pd.DataFrame: the data with the new columns.
+    """
+    sentiment_results = analyze_filtered(list(data[COMMENT_COL]), analyze_sentiment, SKIPPED_SENTIMENT, text_filter,
+                                         'comment sentiment')
+    data[SENTIMENT_COL] = [e['sentiment'] for e in sentiment_results]
+    data[CONFIDENCE_COL] = [e['confidence'] for e in sentiment_results]
+    data[SCORE_COL] = [e['score'] for e in sentiment_results]
+
+    data[ENTITY_POST_COL] = analyze_filtered(list(data[POST_COL]), analyze_entities, SKIPPED_ENTITY, text_filter,
+                                             'post entities')
+    data[ENTITY_COMMENT_COL] = analyze_filtered(list(data[COMMENT_COL]), analyze_entities, SKIPPED_ENTITY, text_filter,
+                                                'comment entities')
+    return data
 
 
 def get_text_analysis_columns(data_path, POST_COL, COMMENT_COL, SENTIMENT_COL,
                               CONFIDENCE_COL, SCORE_COL, ENTITY_POST_COL, ENTITY_COMMENT_COL,
                               transformer_sentiment_analyzer, spacy_ner, entity_blacklist, sentiment_score_map,
-                              output_path):
+                              output_path, batch_size=32, ner_batch_size=256, n_process=1, cache=None,
+                              TIME_COMMENT_COL=None, incremental=False, ID_COL=None, chunk_size=None,
+                              text_filter=None):
     """
 
     Args:
@@ -85,20 +291,26 @@ def get_text_analysis_columns(data_path, POST_COL, COMMENT_COL, SENTIMENT_COL,
         entity_blacklist (list): list of entity type that we don't want to include.
         sentiment_score_map (dict): mapping from sentiment class to quantitative score.
         output_path (str): output path.
+        batch_size (int): number of comments per sentiment model forward pass.
+        ner_batch_size (int): number of texts buffered per spacy batch.
+        n_process (int): number of spacy worker processes, -1 to use all cores.
+        cache (AnalysisCache): analysis cache to read and write through, None to disable.
+        TIME_COMMENT_COL (str): time of comment column name, stored as dates in parquet output.
+        incremental (bool): only analyze the rows missing from the existing output and merge them into it.
+        ID_COL (str): id column name, part of the row key in incremental mode.
+        chunk_size (int): number of rows analyzed at a time with a checkpoint after each chunk, None to analyze the
+            whole data at once. Not used in incremental mode.
+        text_filter (TextFilter): filter of the texts not worth analyzing, None to analyze every cell.
 
     Returns:
         None
     """
-    data = pd.read_csv(data_path)
-    data['sentiment_results'] = data[COMMENT_COL].apply(
-        lambda e: get_sentiment(str(e), transformer_sentiment_analyzer, sentiment_score_map))
-    data[SENTIMENT_COL] = data['sentiment_results'].apply(lambda e: e['sentiment'])
-    data[CONFIDENCE_COL] = data['sentiment_results'].apply(lambda e: e['confidence'])
-    data[SCORE_COL] = data['sentiment_results'].apply(lambda e: e['score'])
-
-    data[ENTITY_POST_COL] = data[POST_COL].apply(
-        lambda e: get_entity(str(e), spacy_ner, entity_blacklist))
-    data[ENTITY_COMMENT_COL] = data[COMMENT_COL].apply(
-        lambda e: get_entity(str(e), spacy_ner, entity_blacklist))
+    def analyze(data):
+        return analyze_text_columns(data, POST_COL, COMMENT_COL, SENTIMENT_COL, CONFIDENCE_COL, SCORE_COL,
+                                    ENTITY_POST_COL, ENTITY_COMMENT_COL, transformer_sentiment_analyzer, spacy_ner,
+                                    entity_blacklist, sentiment_score_map, batch_size, ner_batch_size, n_process,
+                                    cache, text_filter)
 
-    data.to_csv(output_path, index=False)
+    entity_cols = [ENTITY_POST_COL, ENTITY_COMMENT_COL]
+    date_cols = [TIME_COMMENT_COL] if TIME_COMMENT_COL else []
+    extract_file(data_path, output_path, analyze, entity_cols, date_cols, incremental, ID_COL, COMMENT_COL, chunk_size)
@@ -0,0 +1,103 @@
+import inspect
+import os
+from types import SimpleNamespace
+import torch
+
+# CPU backends of the transformer sentiment model: int8 dynamic quantization of its linear layers in pytorch, or an
+# exported onnx graph run by onnxruntime. Both load a local copy of the model written by export_sentiment_model and
+# give the same star labels, through the interface of the transformers sentiment pipeline the open source analyzer
+# uses (tokenizer, model(**encoded).logits, model.config.id2label and calling it on a single text).
+ONNX_FILE = 'model.onnx'
+ONNX_OPSET = 14
+
+
+def export_sentiment_model(model_name, model_dir):
+    """
+    Save a local copy of a sentiment model with its tokenizer, and its onnx export, for the int8 and onnx backends.
+
+    Args:
+        model_name (str): model name on the hugging face hub or path of a saved model.
+        model_dir (str): directory to write the model to.
+    """
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name).eval()
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer.save_pretrained(model_dir)
+    model.save_pretrained(model_dir)
+
+    # batch and sequence axes stay dynamic, the sample inputs only trace the graph
+    encoded = tokenizer(['export sample', 'a longer export sample text'], padding=True, return_tensors='pt')
+    # graph inputs are named in the order of the forward arguments, not of the tokenizer outputs
+    names = [name for name in inspect.signature(model.forward).parameters if name in encoded]
+    dynamic_axes = {name: {0: 'batch', 1: 'sequence'} for name in names}
+    dynamic_axes['logits'] = {0: 'batch'}
+    # recent torch versions default to the dynamo exporter, which needs extra packages
+    options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(model, (dict(encoded),), os.path.join(model_dir, ONNX_FILE), input_names=names,
+                          output_names=['logits'], dynamic_axes=dynamic_axes, opset_version=ONNX_OPSET,
+                          do_constant_folding=True, **options)
+
+
+def load_int8_sentiment_analyzer(model_dir):
+    """
+    Load a local copy of the sentiment model with its linear layers quantized to int8.
+
+    Args:
+        model_dir (str): directory written by export_sentiment_model.
+
+    Returns:
+        transformers pipeline: sentiment pipeline running the quantized model.
+    """
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer, pipeline
+
+    model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+    model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    analyzer = pipeline('sentiment-analysis', model=model, tokenizer=AutoTokenizer.from_pretrained(model_dir))
+    # keeps its results apart from the float model's in the analysis cache
+    analyzer.sentiment_backend = 'int8'
+    return analyzer
+
+
+class _OnnxSequenceClassifier:
+    """Onnxruntime session with the call interface of a transformers sequence classification model."""
+
+    def __init__(self, session, config, name_or_path):
+        self.session = session
+        self.config = config
+        self.name_or_path = name_or_path
+        self._input_names = [graph_input.name for graph_input in session.get_inputs()]
+
+    def __call__(self, **encoded):
+        feeds = {name: encoded[name].numpy() for name in self._input_names}
+        return SimpleNamespace(logits=torch.from_numpy(self.session.run(['logits'], feeds)[0]))
+
+
+class OnnxSentimentAnalyzer:
+    """
+    Sentiment model running the onnx export of a local copy of the model on CPU.
+
+    Args:
+        model_dir (str): directory written by export_sentiment_model.
+        threads (int): number of intra op threads, None for the onnxruntime default.
+    """
+    sentiment_backend = 'onnx'
+
+    def __init__(self, model_dir, threads=None):
+        import onnxruntime
+        from transformers import AutoConfig, AutoTokenizer
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        session = onnxruntime.InferenceSession(os.path.join(model_dir, ONNX_FILE), options,
+                                               providers=['CPUExecutionProvider'])
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = _OnnxSequenceClassifier(session, AutoConfig.from_pretrained(model_dir), model_dir)
+
+    def __call__(self, text):
+        encoded = self.tokenizer([text], return_tensors='pt')
+        score, label_id = torch.softmax(self.model(**encoded).logits, dim=-1)[0].max(dim=-1)
+        return [{'label': self.model.config.id2label[int(label_id)], 'score': float(score)}]
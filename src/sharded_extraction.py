@@ -0,0 +1,408 @@
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from src import metrics
+from src.chunked_extraction import merge_parts
+from src.table_io import iter_table, read_table, write_table
+
+logger = logging.getLogger(__name__)
+
+# Extraction of one input spread over any number of workers, on one machine or on several sharing a filesystem. The
+# input is split once into shard files of a fixed number of rows, in a directory next to the output, along with a
+# sqlite queue of the shards. A worker claims the first pending shard with a lease, analyzes it into a part file and
+# marks it done, renewing the lease while it works. A shard whose lease expires, because its worker crashed or lost
+# the filesystem, goes back to pending and the next claim hands it to another worker. A worker whose analysis of a
+# shard raises gives it back right away. A shard that fails max_attempts times, by raising or by letting its lease
+# expire, is marked failed instead of going back to pending, so a bad shard doesn't take down every worker in turn.
+# Once every shard is done, the parts are merged in shard order into the same output as a single process run.
+SHARDS_SUFFIX = '.shards'
+QUEUE_FILE = 'queue.sqlite'
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def shards_dir(output_path):
+    """Get the directory holding the shards and the queue of an output."""
+    return output_path + SHARDS_SUFFIX
+
+
+def _shard_path(directory, kind, shard, ext):
+    """Helper to get the path of the input or part file of a shard."""
+    return os.path.join(directory, '{}-{:06d}{}'.format(kind, shard, ext))
+
+
+def _signature(path):
+    """Helper to identify the version of an input file by its path, size and modification time."""
+    stat = os.stat(path)
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns]
+
+
+class ShardQueue:
+    """
+    SQLite queue of the shards of a sharded extraction, claimed by workers with leases.
+
+    The queue relies on sqlite file locking, the directory must be on a filesystem with working locks when the
+    workers run on several machines. Leases are compared to the clock of the workers, which must be in sync.
+
+    Args:
+        directory (str): directory of the shards, see shards_dir.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        # the heartbeat of a worker renews its lease from another thread
+        self._lock = threading.Lock()
+        # no WAL, its shared memory index only works for processes of one machine
+        self._conn = sqlite3.connect(os.path.join(directory, QUEUE_FILE), timeout=60, isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE IF NOT EXISTS shards (shard INTEGER PRIMARY KEY, rows INTEGER, state TEXT, worker TEXT,
+                                               lease_until REAL, attempts INTEGER DEFAULT 0, seconds REAL,
+                                               error TEXT);
+        ''')
+
+    def close(self):
+        """Close the queue."""
+        self._conn.close()
+
+    def _execute(self, sql, params=()):
+        """Helper to run one statement, in its own transaction."""
+        with self._lock:
+            return self._conn.execute(sql, params)
+
+    def meta(self, key):
+        """Get a json value of the queue metadata, None when it is not set."""
+        row = self._execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def set_meta(self, key, value):
+        """Set a json value of the queue metadata."""
+        self._execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (key, json.dumps(value)))
+
+    def add_shards(self, rows):
+        """Add pending shards with the given number of rows each, numbered from 0."""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            self._conn.executemany('INSERT INTO shards (shard, rows, state) VALUES (?, ?, ?)',
+                                   [(shard, count, PENDING) for shard, count in enumerate(rows)])
+            self._conn.execute('COMMIT')
+
+    def check_settings(self, settings):
+        """
+        Record the analysis settings of the first worker and check the next workers use the same ones.
+
+        Args:
+            settings (dict): json settings of the analysis of a worker, e.g. api and text filter.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+                if row is None:
+                    self._conn.execute("INSERT INTO meta VALUES ('settings', ?)", (json.dumps(settings),))
+                elif json.loads(row[0]) != settings:
+                    raise ValueError('the shards of {} are analyzed with {}, not {}'.format(
+                        self.directory, row[0], json.dumps(settings)))
+            finally:
+                self._conn.execute('COMMIT')
+
+    def claim(self, worker, lease_seconds, max_attempts):
+        """
+        Lease the first pending shard to a worker, after requeuing the shards whose lease expired.
+
+        Args:
+            worker (str): worker id.
+            lease_seconds (float): duration of the lease.
+            max_attempts (int): number of leases after which a shard whose lease expired is marked failed.
+
+        Returns:
+            int: claimed shard, None when no shard is pending.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                failed = self._conn.execute(
+                    "UPDATE shards SET state = ?, worker = NULL, error = 'lease expired' "
+                    'WHERE state = ? AND lease_until < ? AND attempts >= ?',
+                    (FAILED, LEASED, now, max_attempts)).rowcount
+                expired = self._conn.execute(
+                    'UPDATE shards SET state = ?, worker = NULL WHERE state = ? AND lease_until < ?',
+                    (PENDING, LEASED, now)).rowcount
+                row = self._conn.execute('SELECT shard FROM shards WHERE state = ? ORDER BY shard LIMIT 1',
+                                         (PENDING,)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        'UPDATE shards SET state = ?, worker = ?, lease_until = ?, attempts = attempts + 1 '
+                        'WHERE shard = ?', (LEASED, worker, now + lease_seconds, row[0]))
+            finally:
+                self._conn.execute('COMMIT')
+        if expired:
+            logger.warning('sharded extraction: %d expired leases requeued', expired)
+            metrics.increment('shard_leases_expired', expired)
+        if failed:
+            logger.error('sharded extraction: %d shards failed after %d expired leases', failed, max_attempts)
+            metrics.increment('shards_failed', failed)
+        return None if row is None else row[0]
+
+    def release(self, shard, worker, error, max_attempts):
+        """
+        Give back the lease of a worker whose analysis of a shard failed, without waiting for the lease to expire.
+
+        Args:
+            shard (int): leased shard.
+            worker (str): worker id.
+            error (str): error of the analysis.
+            max_attempts (int): number of leases after which the shard is marked failed instead of pending.
+
+        Returns:
+            str: new state of the shard, None when the worker no longer held the lease.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT attempts FROM shards WHERE shard = ? AND worker = ? AND state = ?',
+                                         (shard, worker, LEASED)).fetchone()
+                state = None
+                if row is not None:
+                    state = FAILED if row[0] >= max_attempts else PENDING
+                    self._conn.execute('UPDATE shards SET state = ?, worker = NULL, error = ? WHERE shard = ?',
+                                       (state, error, shard))
+            finally:
+                self._conn.execute('COMMIT')
+        return state
+
+    def give_back(self, shard, worker):
+        """Put a leased shard back to pending without using up an attempt. Tells whether the worker held the lease."""
+        return self._execute('UPDATE shards SET state = ?, worker = NULL, attempts = attempts - 1 '
+                             'WHERE shard = ? AND worker = ? AND state = ?',
+                             (PENDING, shard, worker, LEASED)).rowcount == 1
+
+    def failed(self):
+        """Get the failed shards with their last error."""
+        return self._execute('SELECT shard, error FROM shards WHERE state = ? ORDER BY shard', (FAILED,)).fetchall()
+
+    def requeue_failed(self):
+        """Put the failed shards back to pending with a fresh number of attempts. Tells how many were requeued."""
+        return self._execute('UPDATE shards SET state = ?, attempts = 0, error = NULL WHERE state = ?',
+                             (PENDING, FAILED)).rowcount
+
+    def renew(self, shard, worker, lease_seconds):
+        """Extend the lease of a worker on a shard. Tells whether the worker still holds the lease."""
+        return self._execute('UPDATE shards SET lease_until = ? WHERE shard = ? AND worker = ? AND state = ?',
+                             (time.time() + lease_seconds, shard, worker, LEASED)).rowcount == 1
+
+    def finish(self, shard, worker, seconds):
+        """Mark a shard done by its worker. Tells whether the worker still held the lease."""
+        return self._execute('UPDATE shards SET state = ?, seconds = ? WHERE shard = ? AND worker = ? AND state = ?',
+                             (DONE, seconds, shard, worker, LEASED)).rowcount == 1
+
+    def counts(self):
+        """Get the number of shards per state."""
+        counts = dict.fromkeys((PENDING, LEASED, DONE, FAILED), 0)
+        counts.update(self._execute('SELECT state, COUNT(*) FROM shards GROUP BY state').fetchall())
+        return counts
+
+
+def split_shards(data_path, output_path, shard_rows, lease_seconds, max_attempts=3, date_cols=()):
+    """
+    Split an input into shards and queue them for the workers of a sharded extraction.
+
+    A split of the same input with the same settings keeps the queue and the shards already done and puts the failed
+    shards back to pending, any other split starts over.
+
+    Args:
+        data_path (str): path to the processed data.
+        output_path (str): output path of the extraction, the shards are kept next to it.
+        shard_rows (int): number of rows per shard.
+        lease_seconds (float): duration of the lease of a worker on a shard, renewed while the worker analyzes it.
+        max_attempts (int): number of failed analyses or expired leases after which a shard is marked failed.
+        date_cols (list): date columns of the input.
+
+    Returns:
+        dict: number of shards per state.
+    """
+    directory = shards_dir(output_path)
+    split = {'input': _signature(data_path), 'shard_rows': shard_rows, 'lease_seconds': lease_seconds,
+             'max_attempts': max_attempts}
+    if os.path.exists(os.path.join(directory, QUEUE_FILE)):
+        queue = ShardQueue(directory)
+        try:
+            if queue.meta('split') == split:
+                requeued = queue.requeue_failed()
+                if requeued:
+                    logger.info('sharded extraction: %d failed shards requeued', requeued)
+                counts = queue.counts()
+                logger.info('sharded extraction: keeping the queue of %s, %s', data_path, counts)
+                return counts
+        finally:
+            queue.close()
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+
+    ext = os.path.splitext(data_path)[1]
+    rows = []
+    with metrics.timer('shard_split'):
+        for shard, chunk in enumerate(iter_table(data_path, shard_rows)):
+            write_table(chunk, _shard_path(directory, 'input', shard, ext), date_cols=date_cols)
+            rows.append(len(chunk))
+        if not rows:
+            # no rows to analyze, one empty shard gives the output its columns
+            write_table(read_table(data_path), _shard_path(directory, 'input', 0, ext), date_cols=date_cols)
+            rows.append(0)
+
+    queue = ShardQueue(directory)
+    try:
+        queue.set_meta('input_ext', ext)
+        queue.add_shards(rows)
+        # written last, a split that stops halfway starts over
+        queue.set_meta('split', split)
+        counts = queue.counts()
+    finally:
+        queue.close()
+    logger.info('sharded extraction: %s split into %d shards of %d rows', data_path, len(rows), shard_rows)
+    return counts
+
+
+def _heartbeat(queue, shard, worker, lease_seconds, stop):
+    """Helper to renew the lease of a worker on a shard until stop is set."""
+    while not stop.wait(lease_seconds / 3):
+        if not queue.renew(shard, worker, lease_seconds):
+            logger.warning('sharded extraction: %s lost the lease on shard %d', worker, shard)
+            return
+
+
+def run_shard_worker(output_path, analyze, entity_cols=(), date_cols=(), settings=None, poll_seconds=5,
+                     max_shards=None):
+    """
+    Analyze the shards of a sharded extraction until every shard is done.
+
+    While the other shards are leased, the worker waits for them to be done or for their lease to expire, so the
+    shards of crashed workers are picked up by the ones still running.
+
+    Args:
+        output_path (str): output path of the extraction, see split_shards.
+        analyze (callable): function adding the analysis columns to a data frame and returning it.
+        entity_cols (list): entity columns of the output.
+        date_cols (list): date columns of the output.
+        settings (dict): json settings of the analysis, every worker of an extraction must use the same ones.
+        poll_seconds (float): seconds between two claims while the other shards are leased.
+        max_shards (int): number of shards after which the worker stops, None for no limit.
+
+    Returns:
+        dict: worker id, number of shards and rows analyzed, number of shards whose analysis failed and seconds.
+    """
+    directory = shards_dir(output_path)
+    if not os.path.exists(os.path.join(directory, QUEUE_FILE)):
+        raise ValueError('no shards for {}, split the input first'.format(output_path))
+    queue = ShardQueue(directory)
+    worker = '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+    report = {'worker': worker, 'shards': 0, 'rows': 0, 'failed': 0, 'seconds': 0}
+    start = time.perf_counter()
+    try:
+        split = queue.meta('split')
+        if split is None:
+            raise ValueError('the split of {} is not finished, split the input again'.format(output_path))
+        queue.check_settings(settings or {})
+        lease_seconds = split['lease_seconds']
+        max_attempts = split['max_attempts']
+        input_ext = queue.meta('input_ext')
+        ext = os.path.splitext(output_path)[1]
+        while max_shards is None or report['shards'] < max_shards:
+            shard = queue.claim(worker, lease_seconds, max_attempts)
+            if shard is None:
+                if queue.counts()[LEASED] == 0:
+                    break
+                time.sleep(poll_seconds)
+                continue
+
+            stop = threading.Event()
+            heartbeat = threading.Thread(target=_heartbeat, args=(queue, shard, worker, lease_seconds, stop),
+                                         daemon=True)
+            heartbeat.start()
+            shard_start = time.perf_counter()
+            try:
+                with metrics.timer('shard_analysis'):
+                    data = analyze(read_table(_shard_path(directory, 'input', shard, input_ext)))
+                # a worker whose lease expired writes the same part as the one that took the shard over
+                part_path = _shard_path(directory, 'part', shard, ext)
+                tmp_path = '{}.{}.tmp{}'.format(os.path.splitext(part_path)[0], worker, ext)
+                write_table(data, tmp_path, entity_cols, date_cols)
+                os.replace(tmp_path, part_path)
+            except Exception as exception:
+                # the shard goes back to the queue now rather than when the lease expires
+                state = queue.release(shard, worker, repr(exception), max_attempts)
+                logger.exception('sharded extraction: %s failed on shard %d, the shard is %s', worker, shard, state)
+                report['failed'] += 1
+                metrics.increment('shard_errors')
+                if state == FAILED:
+                    metrics.increment('shards_failed')
+                continue
+            except BaseException:
+                # interrupted, the shard is given back without using up an attempt
+                queue.give_back(shard, worker)
+                raise
+            finally:
+                stop.set()
+                heartbeat.join()
+            seconds = time.perf_counter() - shard_start
+            if not queue.finish(shard, worker, seconds):
+                logger.warning('sharded extraction: shard %d was taken over before %s finished it', shard, worker)
+                continue
+            report['shards'] += 1
+            report['rows'] += len(data)
+            metrics.increment('shards_done')
+            logger.info('sharded extraction: %s finished shard %d, %d rows in %.1fs', worker, shard, len(data),
+                        seconds)
+    finally:
+        queue.close()
+    report['seconds'] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def merge_shards(output_path, keep_shards=False):
+    """
+    Merge the parts of a finished sharded extraction into its output, in shard order.
+
+    Args:
+        output_path (str): output path of the extraction.
+        keep_shards (bool): keep the shards and the queue after the merge.
+
+    Returns:
+        int: number of shards merged.
+    """
+    directory = shards_dir(output_path)
+    if not os.path.exists(os.path.join(directory, QUEUE_FILE)):
+        raise ValueError('no shards for {}'.format(output_path))
+    queue = ShardQueue(directory)
+    try:
+        counts = queue.counts()
+        failed = queue.failed()
+    finally:
+        queue.close()
+    shards = sum(counts.values())
+    if failed:
+        raise ValueError('{} of {} shards of {} failed, split the input again to retry them: {}'.format(
+            len(failed), shards, output_path, '; '.join('shard {}: {}'.format(shard, error) for shard, error in failed)))
+    if counts[DONE] < shards:
+        raise ValueError('{} of {} shards of {} are not done'.format(shards - counts[DONE], shards, output_path))
+
+    ext = os.path.splitext(output_path)[1]
+    base = os.path.splitext(output_path)[0]
+    with metrics.timer('shard_merge'):
+        merge_parts([_shard_path(directory, 'part', shard, ext) for shard in range(shards)],
+                    base + '.tmp' + ext)
+    os.replace(base + '.tmp' + ext, output_path)
+    if not keep_shards:
+        shutil.rmtree(directory)
+    logger.info('sharded extraction: %d shards merged into %s', shards, output_path)
+    return shards
@@ -0,0 +1,229 @@
+import logging
+import queue
+import threading
+import time
+from src import metrics
+from src.dashboard_cubes import (ENTITY_DAILY_KEYS, SENTIMENT_KEYS, aggregate, sum_cubes, write_entity_tables,
+                                 write_sentiment_tables)
+from src.dashboard_data_prepare import ENTITY_COLUMNS, entity_frame
+from src.data_processing import iter_data_facebook, iter_data_tweet
+from src.table_io import TableWriter
+
+logger = logging.getLogger(__name__)
+
+# End to end run of process, extraction and summarize in one process. Every stage runs on a thread of its own and hands
+# chunks of rows to the next one through a bounded queue: the dumps are parsed and cleaned up chunk by chunk, a chunk
+# is analyzed as soon as it is ready and its dashboard rows are written while the next chunks are still parsed and
+# analyzed. A queue holds at most queue_size chunks, so memory stays bounded by the chunk size whatever the size of
+# the dumps, and a slow stage holds the others back instead of piling up chunks. The processed and extracted data don't
+# go through disk, they are only written as debug outputs.
+_DONE = object()
+_STOPPED = object()
+# seconds between two checks of the stop flag while a stage waits on a queue
+_WAIT_SECONDS = 0.1
+
+
+def _put(chunks, item, stop):
+    """Helper to put an item on a bounded queue, giving up when the run stops. Tells whether the item was queued."""
+    while not stop.is_set():
+        try:
+            chunks.put(item, timeout=_WAIT_SECONDS)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(chunks, stop):
+    """Helper to get an item from a queue, _STOPPED when the run stops first."""
+    while not stop.is_set():
+        try:
+            return chunks.get(timeout=_WAIT_SECONDS)
+        except queue.Empty:
+            continue
+    return _STOPPED
+
+
+def run_stages(source, stages, sink, queue_size=2):
+    """
+    Run a chunk source, chunk transforms and a chunk sink concurrently, connected by bounded queues.
+
+    The source and every transform run on a thread of their own, the sink on the calling thread. When a stage fails
+    the others stop after their current chunk and its exception is raised.
+
+    Args:
+        source (iterable): chunks to process.
+        stages (list): (name, transform) pairs, every transform maps a chunk to the chunk handed to the next stage.
+        sink (callable): function called with every chunk coming out of the last stage, in order.
+        queue_size (int): number of chunks a queue holds before its producer waits.
+    """
+    stop = threading.Event()
+    errors = []
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+
+    def produce():
+        try:
+            for chunk in source:
+                if not _put(queues[0], chunk, stop):
+                    return
+            _put(queues[0], _DONE, stop)
+        except BaseException as exception:
+            errors.append(exception)
+            stop.set()
+
+    def transform(name, function, inbox, outbox):
+        while True:
+            chunk = _get(inbox, stop)
+            if chunk is _STOPPED:
+                return
+            if chunk is not _DONE:
+                try:
+                    with metrics.timer('run_' + name):
+                        chunk = function(chunk)
+                except BaseException as exception:
+                    errors.append(exception)
+                    stop.set()
+                    return
+            if not _put(outbox, chunk, stop) or chunk is _DONE:
+                return
+
+    threads = [threading.Thread(target=produce, name='run_source', daemon=True)]
+    threads.extend(threading.Thread(target=transform, args=(name, function, queues[i], queues[i + 1]),
+                                    name='run_' + name, daemon=True) for i, (name, function) in enumerate(stages))
+    for thread in threads:
+        thread.start()
+    try:
+        while True:
+            chunk = _get(queues[-1], stop)
+            if chunk is _DONE or chunk is _STOPPED:
+                break
+            with metrics.timer('run_sink'):
+                sink(chunk)
+    finally:
+        # stops the other stages when the sink failed, they only finish their current chunk
+        stop.set()
+        for thread in threads:
+            thread.join()
+    if errors:
+        raise errors[0]
+
+
+def _entry_chunks(entry, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size, keep_intermediate):
+    """Helper to parse the dump of a manifest entry in chunks, writing them to its output with keep_intermediate."""
+    if entry['channel'] == 'facebook':
+        chunks = iter_data_facebook(entry['path_comment'], entry['path_post'], ID_COL, POST_COL, REPLY_COL,
+                                    COMMENT_COL, TIME_COMMENT_COL, chunk_size)
+    else:
+        chunks = iter_data_tweet(entry['path_both'], ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL,
+                                 chunk_size)
+    writer = TableWriter(entry['output'], date_cols=[TIME_COMMENT_COL]) if keep_intermediate else None
+    for chunk in chunks:
+        if writer is not None:
+            writer.write(chunk)
+        yield chunk
+    if writer is not None:
+        writer.close(columns=[ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL])
+
+
+def streaming_run(entries, analyze, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, SENTIMENT_COL,
+                  SCORE_COL, ENTITY_COLS, entity_col, entity_output=None, sentiment_output=None, cube_dir=None,
+                  cube_ext='.csv', top_n=10, period='M', chunk_size=10000, queue_size=2, keep_intermediate=False):
+    """
+    Process, analyze and summarize the dumps of a manifest in one streaming pass.
+
+    The dashboard outputs hold the same rows as summarize_entity and summarize_sentiment over the extraction outputs
+    of the dumps, and the cubes the same statistics, only for the dumps of the run.
+
+    Args:
+        entries (list): manifest entries, see load_manifest. With keep_intermediate, the processed data of an entry is
+            written to its output, and its extracted data to its extracted path when it has one.
+        analyze (callable): function adding the analysis columns to a data frame, see get_text_analysis_columns.
+        ID_COL (str): id column name.
+        POST_COL (str): post column name.
+        REPLY_COL (str): reply number column name.
+        COMMENT_COL (str): comment column name.
+        TIME_COMMENT_COL (str): time of comment column name.
+        SENTIMENT_COL (str): sentiment column name.
+        SCORE_COL (str): sentiment score column name.
+        ENTITY_COLS (list): entity column names of the extracted data.
+        entity_col (str): entity column the entity dashboard rows come from.
+        entity_output (str): path of the entity dashboard output, None to skip it.
+        sentiment_output (str): path of the sentiment dashboard output, None to skip it.
+        cube_dir (str): directory to write the pre-aggregated dashboard tables to, None to skip them.
+        cube_ext (str): file extension of the tables, .csv or .parquet.
+        top_n (int): number of top entities per period, company and channel.
+        period (str): pandas period alias of the top entities, e.g. D, W or M.
+        chunk_size (int): number of rows per chunk.
+        queue_size (int): number of chunks a queue between two stages holds.
+        keep_intermediate (bool): write the processed and extracted data of every entry as debug outputs.
+
+    Returns:
+        list: one report per entry with company, channel and rows, and the seconds to the first dashboard rows.
+    """
+    start = time.perf_counter()
+    # columns of the sentiment dashboard output, as sentiment_summerize reads them from the extraction output
+    sentiment_columns = [POST_COL, REPLY_COL, COMMENT_COL, SENTIMENT_COL, SCORE_COL, TIME_COMMENT_COL]
+    reports = [{'company': entry['company'], 'channel': entry['channel'], 'rows': 0} for entry in entries]
+    entity_writer = TableWriter(entity_output, date_cols=['time']) if entity_output else None
+    sentiment_writer = TableWriter(sentiment_output, date_cols=[TIME_COMMENT_COL]) if sentiment_output else None
+    extracted_writers = {}
+    entity_cubes = []
+    sentiment_cubes = []
+
+    def source():
+        for i, entry in enumerate(entries):
+            for chunk in _entry_chunks(entry, ID_COL, POST_COL, REPLY_COL, COMMENT_COL, TIME_COMMENT_COL, chunk_size,
+                                       keep_intermediate):
+                yield i, chunk
+
+    def extraction(item):
+        i, chunk = item
+        return i, analyze(chunk)
+
+    def summarize(item):
+        i, data = item
+        entry = entries[i]
+        if keep_intermediate and entry.get('extracted'):
+            if i not in extracted_writers:
+                extracted_writers[i] = TableWriter(entry['extracted'], ENTITY_COLS, [TIME_COMMENT_COL])
+            extracted_writers[i].write(data)
+
+        entities = entity_frame(data, entity_col, SENTIMENT_COL, SCORE_COL, TIME_COMMENT_COL, entry['company'],
+                                entry['channel'])
+        # reply counts as whole numbers whatever the chunk, a chunk without missing counts would otherwise differ
+        sentiment = data[sentiment_columns].astype({REPLY_COL: 'Int64'})
+        sentiment['company'] = entry['company']
+        sentiment['channel'] = entry['channel']
+        if entity_writer is not None:
+            entity_writer.write(entities)
+        if sentiment_writer is not None:
+            sentiment_writer.write(sentiment)
+        if cube_dir is not None:
+            entity_cubes.append(aggregate(entities, ENTITY_DAILY_KEYS, 'time', 'sentiment', 'score'))
+            sentiment_cubes.append(aggregate(sentiment, SENTIMENT_KEYS, TIME_COMMENT_COL, SENTIMENT_COL, SCORE_COL))
+            # keep the chunk cubes few, they only shrink when added up
+            if len(entity_cubes) > 1:
+                entity_cubes[:] = [sum_cubes(entity_cubes, ENTITY_DAILY_KEYS)]
+                sentiment_cubes[:] = [sum_cubes(sentiment_cubes, SENTIMENT_KEYS)]
+
+        if 'first_output_seconds' not in reports[i]:
+            reports[i]['first_output_seconds'] = round(time.perf_counter() - start, 3)
+            metrics.observe('run_first_output', time.perf_counter() - start)
+        reports[i]['rows'] += len(data)
+
+    run_stages(source(), [('extraction', extraction)], summarize, queue_size)
+
+    for writer in extracted_writers.values():
+        writer.close()
+    if entity_writer is not None:
+        entity_writer.close(columns=ENTITY_COLUMNS)
+    if sentiment_writer is not None:
+        sentiment_writer.close(columns=sentiment_columns + ['company', 'channel'])
+    if cube_dir is not None:
+        write_entity_tables(cube_dir, entity_col, sum_cubes(entity_cubes, ENTITY_DAILY_KEYS), top_n, period, cube_ext)
+        write_sentiment_tables(cube_dir, sum_cubes(sentiment_cubes, SENTIMENT_KEYS), cube_ext)
+
+    for report in reports:
+        logger.info('%s %s: %d rows, first dashboard rows after %ss', report['company'], report['channel'],
+                    report['rows'], report.get('first_output_seconds'))
+    return reports
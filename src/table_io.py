@@ -0,0 +1,212 @@
+import pandas as pd
+from src import metrics
+
+# Tables are read and written as csv, or as parquet when the path ends with .parquet. In parquet files entity columns
+# are stored as list<struct<text, type>> and date columns as date32 instead of the csv 'text,TYPE|text,TYPE' strings
+# and date strings.
+PARQUET_SUFFIX = '.parquet'
+
+
+def is_parquet(path):
+    """Tell whether a path is a parquet file."""
+    return str(path).endswith(PARQUET_SUFFIX)
+
+
+def split_entity(entity):
+    """
+    Split one 'text,TYPE' entity into its text and type.
+
+    The text is the first field and the type the second, as the dashboard has always read entity strings. Every reader
+    goes through this rule so csv and parquet intermediates give the same entities.
+
+    Args:
+        entity (str): entity string.
+
+    Returns:
+        tuple: text and type, None as type when the string has no comma.
+    """
+    parts = entity.split(',')
+    return parts[0], parts[1] if len(parts) > 1 else None
+
+
+def _entity_structs(value):
+    """Helper to turn a 'text,TYPE|text,TYPE' entity string into a list of text/type structs."""
+    if not isinstance(value, str) or not value:
+        return []
+    entities = []
+    for entity in value.split('|'):
+        text, entity_type = split_entity(entity)
+        entities.append({'text': text, 'type': entity_type})
+    return entities
+
+
+def entity_strings(series):
+    """
+    Turn an entity column read from a parquet file back into 'text,TYPE|text,TYPE' strings.
+
+    Args:
+        series (pd.Series): entity column of lists of text/type structs, strings are returned unchanged.
+
+    Returns:
+        pd.Series: entity strings, empty lists become NaN as they would when read from csv.
+    """
+    def to_string(value):
+        if isinstance(value, str) or value is None:
+            return value
+        return '|'.join(entity['text'] + ',' + entity['type'] for entity in value) or None
+    return series.map(to_string)
+
+
+def _arrow_schema(df, entity_cols, date_cols):
+    """Helper to get the parquet schema of a table, typing entity and date columns and columns with no values."""
+    import pyarrow as pa
+
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for i, field in enumerate(schema):
+        if field.name in entity_cols:
+            schema = schema.set(i, pa.field(field.name, pa.list_(pa.struct([('text', pa.string()),
+                                                                             ('type', pa.string())]))))
+        elif field.name in date_cols:
+            schema = schema.set(i, pa.field(field.name, pa.date32()))
+        elif pa.types.is_null(field.type):
+            schema = schema.set(i, pa.field(field.name, pa.string()))
+    return schema
+
+
+def _to_arrow_frame(df, entity_cols, date_cols):
+    """Helper to convert entity and date columns to the values stored in parquet."""
+    df = df.copy()
+    for col in entity_cols:
+        if col in df:
+            df[col] = df[col].map(_entity_structs)
+    for col in date_cols:
+        if col in df:
+            dates = pd.to_datetime(df[col], errors='coerce')
+            df[col] = dates.dt.date.astype(object).where(dates.notna(), None)
+    return df
+
+
+def read_table(path, columns=None):
+    """
+    Read a csv or parquet table, only loading the given columns.
+
+    Args:
+        path (str): path to the table.
+        columns (list): columns to read, None for all of them.
+
+    Returns:
+        pd.DataFrame: table data, with the columns in the given order.
+    """
+    with metrics.timer('table_read'):
+        if is_parquet(path):
+            data = pd.read_parquet(path, columns=columns)
+        else:
+            data = pd.read_csv(path, usecols=columns)
+            data = data if columns is None else data[list(columns)]
+    metrics.increment('rows_read', len(data))
+    return data
+
+
+def iter_table(path, chunk_size, columns=None, skip_chunks=0):
+    """
+    Read a csv or parquet table chunk by chunk.
+
+    Args:
+        path (str): path to the table.
+        chunk_size (int): number of rows per chunk.
+        columns (list): columns to read, None for all of them.
+        skip_chunks (int): number of leading chunks to skip.
+
+    Yields:
+        pd.DataFrame: chunks of the table, with the columns in the given order.
+    """
+    if is_parquet(path):
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=columns)
+        chunks = (batch.to_pandas() for i, batch in enumerate(batches) if i >= skip_chunks)
+    else:
+        skiprows = range(1, skip_chunks * chunk_size + 1) if skip_chunks else None
+        chunks = (chunk if columns is None else chunk[list(columns)]
+                  for chunk in pd.read_csv(path, usecols=columns, chunksize=chunk_size, skiprows=skiprows))
+    while True:
+        with metrics.timer('table_read'):
+            chunk = next(chunks, None)
+        if chunk is None:
+            return
+        metrics.increment('rows_read', len(chunk))
+        yield chunk
+
+
+def write_table(df, path, entity_cols=(), date_cols=()):
+    """
+    Write a table as csv or parquet.
+
+    Args:
+        df (pd.DataFrame): table data.
+        path (str): output path.
+        entity_cols (list): entity string columns, stored as list<struct<text, type>> in parquet.
+        date_cols (list): date columns, stored as date32 in parquet.
+    """
+    writer = TableWriter(path, entity_cols, date_cols)
+    writer.write(df)
+    writer.close(columns=df.columns)
+
+
+class TableWriter:
+    """
+    Write a table chunk by chunk as csv or parquet.
+
+    Args:
+        path (str): output path.
+        entity_cols (list): entity string columns, stored as list<struct<text, type>> in parquet.
+        date_cols (list): date columns, stored as date32 in parquet.
+        append (bool): append to an existing csv file instead of overwriting it.
+    """
+
+    def __init__(self, path, entity_cols=(), date_cols=(), append=False):
+        self.path = path
+        self.entity_cols = list(entity_cols)
+        self.date_cols = list(date_cols)
+        self.rows = 0
+        self._append = append
+        self._parquet_writer = None
+
+    def write(self, df):
+        """Write one chunk."""
+        with metrics.timer('table_write'):
+            self._write(df)
+        metrics.increment('rows_written', len(df))
+        self.rows += len(df)
+
+    def _write(self, df):
+        """Helper to write one chunk in the format of the output."""
+        if is_parquet(self.path):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            df = _to_arrow_frame(df, self.entity_cols, self.date_cols)
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(self.path, _arrow_schema(df, self.entity_cols,
+                                                                                 self.date_cols))
+            table = pa.Table.from_pandas(df, schema=self._parquet_writer.schema, preserve_index=False)
+            self._parquet_writer.write_table(table)
+        else:
+            header = self.rows == 0 and not self._append
+            df.to_csv(self.path, index=False, mode='w' if header else 'a', header=header)
+
+    def close(self, columns=None):
+        """
+        Finish the table.
+
+        Args:
+            columns (list): column names, used to write an empty table when no chunk was written.
+        """
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self.rows == 0 and not self._append:
+            empty = pd.DataFrame(columns=columns)
+            if is_parquet(self.path):
+                empty.to_parquet(self.path, index=False)
+            else:
+                empty.to_csv(self.path, index=False)
@@ -0,0 +1,82 @@
+import functools
+import math
+import unicodedata
+
+# Pre-filter of the texts sent to the models or to azure. Cells missing from the outer merge of the process step, and
+# texts the cleanup left empty, short or without any letter, carry no sentiment or entity worth a model call or a
+# billable request. Neither do texts in a script the models don't support. Skipped rows get SKIPPED_SENTIMENT and
+# SKIPPED_ENTITY instead, the skipped score is empty so it stays out of the dashboard score means.
+MISSING = 'missing'
+EMPTY = 'empty'
+TOO_SHORT = 'too_short'
+NO_LETTERS = 'no_letters'
+UNSUPPORTED_LANGUAGE = 'unsupported_language'
+SKIP_REASONS = (MISSING, EMPTY, TOO_SHORT, NO_LETTERS, UNSUPPORTED_LANGUAGE)
+
+# what str() gives for the missing cells of csv and parquet inputs
+MISSING_STRINGS = ('nan', 'None', '<NA>')
+
+SKIPPED_SENTIMENT = {'sentiment': 'skipped', 'confidence': 0, 'score': None}
+SKIPPED_ENTITY = ''
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def _script(char):
+    """Helper to get the script of a letter from its unicode name, e.g. LATIN, CYRILLIC or CJK."""
+    return unicodedata.name(char, '').split(' ', 1)[0]
+
+
+class TextFilter:
+    """
+    Tell which texts are not worth analyzing and why.
+
+    Args:
+        min_chars (int): number of characters, leading and trailing spaces aside, under which a text is too short.
+        scripts (list): unicode scripts of the supported languages, e.g. LATIN, None to accept every script.
+        min_script_share (float): share of the letters of a text that must be in a supported script.
+    """
+
+    def __init__(self, min_chars=2, scripts=('LATIN',), min_script_share=0.5):
+        self.min_chars = min_chars
+        self.scripts = None if scripts is None else frozenset(script.upper() for script in scripts)
+        self.min_script_share = min_script_share
+
+    def settings(self):
+        """Get the settings of the filter, jobs only share results of filters with the same settings."""
+        return {'min_chars': self.min_chars, 'scripts': None if self.scripts is None else sorted(self.scripts),
+                'min_script_share': self.min_script_share}
+
+    def skip_reason(self, value):
+        """
+        Get the reason to skip a cell.
+
+        Args:
+            value: cell of a text column, a string or a missing value.
+
+        Returns:
+            str: one of SKIP_REASONS, None when the text should be analyzed.
+        """
+        if value is None or (isinstance(value, float) and math.isnan(value)):
+            return MISSING
+        text = str(value).strip()
+        if text in MISSING_STRINGS:
+            return MISSING
+        if not text:
+            return EMPTY
+        if len(text) < self.min_chars:
+            return TOO_SHORT
+        # ascii texts are the common case, their letters are all latin
+        if text.isascii():
+            if not any(char.isalpha() for char in text):
+                return NO_LETTERS
+            if self.scripts is not None and 'LATIN' not in self.scripts:
+                return UNSUPPORTED_LANGUAGE
+            return None
+        letters = [char for char in text if char.isalpha()]
+        if not letters:
+            return NO_LETTERS
+        if self.scripts is not None:
+            supported = sum(_script(char) in self.scripts for char in letters)
+            if supported < self.min_script_share * len(letters):
+                return UNSUPPORTED_LANGUAGE
+        return None
@@ -0,0 +1,184 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import config
+from benchmarks.bench_pipeline import StubSentimentModel, stub_ner
+from src.analysis_client import AnalysisClient
+from src.analysis_worker import AnalysisWorker, MicroBatcher, _Handler
+from src.open_source_sentiment_analyzer import get_entity_batch, get_sentiment_batch
+
+
+class RecordingAnalyzer:
+    """Batch analyzer upper casing texts and recording the texts of every call."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, texts):
+        self.calls.append(list(texts))
+        return [text.upper() for text in texts]
+
+
+def test_concurrent_requests_share_a_call():
+    analyzer = RecordingAnalyzer()
+    batcher = MicroBatcher(analyzer, max_batch=100, max_wait=0.5)
+    try:
+        futures = [batcher.submit(['b', 'a']), batcher.submit(['a', 'c']), batcher.submit(['c'])]
+        assert [future.result(timeout=5) for future in futures] == [['B', 'A'], ['A', 'C'], ['C']]
+    finally:
+        batcher.close()
+    # one call with every distinct text once, in order of arrival
+    assert analyzer.calls == [['b', 'a', 'c']]
+
+
+def test_requests_from_threads_keep_their_order():
+    analyzer = RecordingAnalyzer()
+    batcher = MicroBatcher(analyzer, max_batch=8, max_wait=0.05)
+    requests = [['text {} {}'.format(i, j) for j in range(5)] + ['shared'] for i in range(20)]
+    results = [None] * len(requests)
+
+    def send(i):
+        results[i] = batcher(requests[i])
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(len(requests))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    batcher.close()
+    assert results == [[text.upper() for text in texts] for texts in requests]
+    assert len(analyzer.calls) < len(requests)
+
+
+def test_empty_request_skips_the_analyzer():
+    analyzer = RecordingAnalyzer()
+    batcher = MicroBatcher(analyzer)
+    try:
+        assert batcher([]) == []
+    finally:
+        batcher.close()
+    assert analyzer.calls == []
+
+
+def test_errors_fail_the_requests_and_the_batcher_keeps_going():
+    responses = [RuntimeError('model failed'), ['only one'], None]
+
+    def analyze_batch(texts):
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response if response is not None else [text.upper() for text in texts]
+
+    batcher = MicroBatcher(analyze_batch, max_wait=0)
+    try:
+        with pytest.raises(RuntimeError, match='model failed'):
+            batcher(['a', 'b'])
+        # a short result must not hand out misaligned results
+        with pytest.raises(ValueError, match='1 results for 2 texts'):
+            batcher(['a', 'b'])
+        assert batcher(['a', 'b']) == ['A', 'B']
+    finally:
+        batcher.close()
+
+
+@pytest.fixture(scope='module')
+def models():
+    return (StubSentimentModel(list(config.TRANSFORMER_SENTIMENT_MAP)), stub_ner(), config.ENTITY_BLACKLIST_SPACY,
+            config.TRANSFORMER_SENTIMENT_MAP)
+
+
+def test_worker_matches_direct_calls(models):
+    sentiment_model, ner, blacklist, score_map = models
+    texts = ['SpaceX launched Starship today', 'Blue Origin too', 'nothing here', 'SpaceX launched Starship today']
+    worker = AnalysisWorker(sentiment_model, ner, blacklist, score_map, max_wait=0.05)
+    results = [None] * 4
+
+    def send(i):
+        results[i] = worker.analyze(texts[i:] + texts[:i])
+
+    threads = [threading.Thread(target=send, args=(i,)) for i in range(len(results))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    worker.close()
+
+    sentiments = get_sentiment_batch(texts, sentiment_model, score_map)
+    entities = get_entity_batch(texts, ner, blacklist)
+    for i, result in enumerate(results):
+        assert result == {'sentiment': sentiments[i:] + sentiments[:i], 'entity': entities[i:] + entities[:i]}
+    assert worker.status()['jobs'] == 4
+    assert worker.status()['running'] == 0
+
+
+def test_worker_rejects_unknown_kinds(models):
+    worker = AnalysisWorker(*models)
+    try:
+        with pytest.raises(ValueError, match='unknown analysis kinds'):
+            worker.analyze(['text'], ['emotion'])
+    finally:
+        worker.close()
+
+
+class BrokenNer:
+    """Ner pipeline failing on every text."""
+
+    def pipe(self, texts, **kwargs):
+        raise RuntimeError('ner failed')
+
+
+def test_worker_propagates_model_errors(models):
+    sentiment_model, _, blacklist, score_map = models
+    worker = AnalysisWorker(sentiment_model, BrokenNer(), blacklist, score_map)
+    try:
+        with pytest.raises(RuntimeError, match='ner failed'):
+            worker.analyze(['some text'])
+        # the sentiment model is unaffected
+        result = worker.analyze(['some text'], ['sentiment'])
+        assert result == {'sentiment': get_sentiment_batch(['some text'], sentiment_model, score_map)}
+        assert worker.status()['running'] == 0
+    finally:
+        worker.close()
+
+
+class RecordingHandler(_Handler):
+    """Worker handler built without a connection, recording its replies."""
+
+    def __init__(self, path, client_address):
+        self.path = path
+        self.client_address = client_address
+        self.replies = []
+
+    def _reply(self, code, body):
+        self.replies.append((code, body))
+
+
+def test_extraction_only_from_the_local_host():
+    handler = RecordingHandler('/extraction', ('192.168.1.20', 50000))
+    handler.do_POST()
+    assert handler.replies[0][0] == 403
+
+
+def test_is_running_ignores_other_servers():
+    class OtherHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            payload = json.dumps(['not', 'a', 'worker']).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), OtherHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        assert not AnalysisClient('http://127.0.0.1:{}'.format(server.server_address[1])).is_running()
+    finally:
+        server.shutdown()
+        server.server_close()
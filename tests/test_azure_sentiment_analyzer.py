@@ -0,0 +1,194 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+from azure.core.exceptions import HttpResponseError, ServiceResponseError
+
+from src.azure_sentiment_analyzer import (RetryPolicy, TimeoutError, call_with_retry, get_entity_azure_batch,
+                                          get_sentiment_azure_batch)
+
+SENTIMENT_MAP = {'positive': 1, 'neutral': 0, 'negative': -1}
+
+
+class FakeTextAnalyticsClient:
+    """
+    Stand in for TextAnalyticsClient recording its requests.
+
+    Documents containing 'bad' come back as document errors and requests with a document containing 'reject' raise
+    an HttpResponseError. Other documents are positive when they contain 'good' and hold their capitalized words as
+    Organization entities and their digits as Quantity entities.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def _record(self, kind, documents):
+        with self._lock:
+            self.requests.append((kind, list(documents)))
+        if any('reject' in document for document in documents):
+            raise HttpResponseError(message='request rejected')
+
+    def analyze_sentiment(self, documents, **kwargs):
+        self._record('sentiment', documents)
+        results = []
+        for document in documents:
+            if 'bad' in document:
+                results.append(SimpleNamespace(is_error=True))
+                continue
+            sentiment = 'positive' if 'good' in document else 'neutral'
+            scores = SimpleNamespace(positive=0.0, neutral=0.0, negative=0.0)
+            setattr(scores, sentiment, 0.9)
+            results.append(SimpleNamespace(is_error=False, sentiment=sentiment, confidence_scores=scores))
+        return results
+
+    def recognize_entities(self, documents, **kwargs):
+        self._record('entity', documents)
+        results = []
+        for document in documents:
+            if 'bad' in document:
+                results.append(SimpleNamespace(is_error=True))
+                continue
+            entities = [SimpleNamespace(text=word, category='Organization') for word in document.split()
+                        if word[0].isupper()]
+            entities += [SimpleNamespace(text=word, category='Quantity') for word in document.split()
+                         if word.isdigit()]
+            results.append(SimpleNamespace(is_error=False, entities=entities))
+        return results
+
+
+@pytest.fixture
+def client():
+    return FakeTextAnalyticsClient()
+
+
+def test_sentiment_requests_hold_ten_documents(client):
+    texts = ['good text {}'.format(i) for i in range(23)]
+    results = get_sentiment_azure_batch(texts, client, SENTIMENT_MAP, max_workers=3)
+    assert sorted(len(documents) for _, documents in client.requests) == [3, 10, 10]
+    assert sorted(text for _, documents in client.requests for text in documents) == sorted(texts)
+    assert results == [{'sentiment': 'positive', 'confidence': 0.9, 'score': 1}] * len(texts)
+
+
+def test_entity_requests_hold_five_documents(client):
+    texts = ['Text {} of 12'.format(i) for i in range(12)]
+    results = get_entity_azure_batch(texts, client, ['Quantity'], max_workers=3)
+    assert sorted(len(documents) for _, documents in client.requests) == [2, 5, 5]
+    assert results == ['Text,Organization'] * len(texts)
+
+
+def test_sentiment_failures_fall_back_to_na(client):
+    texts = ['good'] * 9 + ['bad'] + ['reject'] + ['good'] * 9 + ['neutral text']
+    results = get_sentiment_azure_batch(texts, client, SENTIMENT_MAP)
+    na = {'sentiment': 'N/A', 'confidence': 0, 'score': 0}
+    # the document error only fails its document, the rejected request all of its documents
+    assert results[:9] == [{'sentiment': 'positive', 'confidence': 0.9, 'score': 1}] * 9
+    assert results[9:20] == [na] * 11
+    assert results[20:] == [{'sentiment': 'neutral', 'confidence': 0.9, 'score': 0}]
+
+
+def test_entity_failures_fall_back_to_empty(client):
+    texts = ['SpaceX 5', 'bad Starship', 'Starship', 'Blue Origin', 'NASA', 'reject NASA', 'NASA', 'ESA']
+    results = get_entity_azure_batch(texts, client, ['Quantity'])
+    assert results == ['SpaceX,Organization', '', 'Starship,Organization', 'Blue,Organization|Origin,Organization',
+                       'NASA,Organization', '', '', '']
+
+
+def http_error(status_code, retry_after=None):
+    """Build the HttpResponseError of a response with the given status code and Retry-After header."""
+    headers = {} if retry_after is None else {'Retry-After': str(retry_after)}
+    return HttpResponseError(message='status {}'.format(status_code),
+                             response=SimpleNamespace(status_code=status_code, reason='', headers=headers))
+
+
+class FlakyRequest:
+    """Request raising the given exceptions in turn, then returning 'ok', recording the keyword arguments of calls."""
+
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = []
+
+    def __call__(self, **kwargs):
+        self.calls.append(kwargs)
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        return 'ok'
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr('src.azure_sentiment_analyzer.time.sleep', delays.append)
+    return delays
+
+
+def test_transient_failures_are_retried(sleeps):
+    request = FlakyRequest(http_error(429, retry_after=2), http_error(503))
+    policy = RetryPolicy(timeout=1.5, backoff_base=0)
+    assert call_with_retry(request, policy) == 'ok'
+    assert request.calls == [{'connection_timeout': 1.5, 'read_timeout': 1.5}] * 3
+    # the throttled request waits as long as the service asked, the other one backs off
+    assert sleeps == [2.0, 0.0]
+
+
+def test_retry_budget_is_shared_across_requests(sleeps):
+    policy = RetryPolicy(max_retries=5, backoff_base=0, retry_budget=2)
+    request = FlakyRequest(*[http_error(503)] * 10)
+    with pytest.raises(TimeoutError):
+        call_with_retry(request, policy)
+    assert len(request.calls) == 3
+    assert policy.retry_budget == 0
+    # once spent, the next requests are not retried at all
+    request = FlakyRequest(ServiceResponseError('connection reset'))
+    with pytest.raises(TimeoutError):
+        call_with_retry(request, policy)
+    assert len(request.calls) == 1
+
+
+def test_retries_of_a_request_are_bounded(sleeps):
+    request = FlakyRequest(*[http_error(500)] * 10)
+    with pytest.raises(TimeoutError):
+        call_with_retry(request, RetryPolicy(max_retries=2, backoff_base=0))
+    assert len(request.calls) == 3
+
+
+@pytest.mark.parametrize('exception', [http_error(400), http_error(401), ValueError('bad documents')])
+def test_non_transient_failures_are_raised(sleeps, exception):
+    request = FlakyRequest(exception)
+    with pytest.raises(type(exception)):
+        call_with_retry(request, RetryPolicy(backoff_base=0))
+    assert len(request.calls) == 1
+    assert sleeps == []
+
+
+class SlowTextAnalyticsClient(FakeTextAnalyticsClient):
+    """Fake client whose requests with a document containing 'slow' fail as transient the first failures times."""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def _record(self, kind, documents):
+        super()._record(kind, documents)
+        with self._lock:
+            if self.failures and any('slow' in document for document in documents):
+                self.failures -= 1
+                raise ServiceResponseError('read timed out')
+
+
+def test_timed_out_documents_are_sent_again_at_the_end(sleeps):
+    client = SlowTextAnalyticsClient(failures=1)
+    texts = ['good {}'.format(i) for i in range(10)] + ['slow good', 'good']
+    results = get_sentiment_azure_batch(texts, client, SENTIMENT_MAP, retry_policy=RetryPolicy(max_retries=0))
+    assert results == [{'sentiment': 'positive', 'confidence': 0.9, 'score': 1}] * len(texts)
+    # the retry pass only sends the documents of the timed out request
+    assert client.requests[-1] == ('sentiment', ['slow good', 'good'])
+    assert len(client.requests) == 3
+
+
+def test_documents_still_timed_out_after_the_retry_passes(sleeps):
+    client = SlowTextAnalyticsClient(failures=2)
+    results = get_entity_azure_batch(['slow SpaceX', 'NASA'], client, [], retry_policy=RetryPolicy(max_retries=0),
+                                     retry_passes=1)
+    assert results == [None, None]
+    assert len(client.requests) == 2
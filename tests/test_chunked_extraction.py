@@ -0,0 +1,68 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.chunked_extraction import PARTS_SUFFIX, chunked_extraction
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FakeAnalyzer:
+    """Stand in for an extraction backend recording its chunks, interrupted after fail_after chunks if set."""
+
+    def __init__(self, fail_after=None):
+        self.chunks = []
+        self.fail_after = fail_after
+
+    def __call__(self, data):
+        if self.fail_after is not None and len(self.chunks) == self.fail_after:
+            raise Interrupted()
+        self.chunks.append(data['comment'].tolist())
+        data['sentiment'] = data['comment'].str.len()
+        return data
+
+
+def write_input(path, comments):
+    pd.DataFrame({'id': range(len(comments)), 'comment': comments}).to_csv(path, index=False)
+
+
+def test_interrupted_run_resumes_after_the_last_chunk(tmp_path):
+    data_path = str(tmp_path / 'data.csv')
+    output_path = str(tmp_path / 'output.csv')
+    comments = ['c{}'.format(i) for i in range(7)]
+    write_input(data_path, comments)
+
+    with pytest.raises(Interrupted):
+        chunked_extraction(data_path, output_path, FakeAnalyzer(fail_after=2), 3)
+    assert not os.path.exists(output_path)
+
+    analyzer = FakeAnalyzer()
+    chunked_extraction(data_path, output_path, analyzer, 3)
+    assert analyzer.chunks == [['c6']]
+    assert pd.read_csv(output_path)['comment'].tolist() == comments
+    assert not os.path.exists(output_path + PARTS_SUFFIX)
+
+
+@pytest.mark.parametrize('change', ['input', 'chunk_size'])
+def test_changed_run_restarts_from_the_first_chunk(tmp_path, change):
+    data_path = str(tmp_path / 'data.csv')
+    output_path = str(tmp_path / 'output.csv')
+    write_input(data_path, ['c{}'.format(i) for i in range(7)])
+
+    with pytest.raises(Interrupted):
+        chunked_extraction(data_path, output_path, FakeAnalyzer(fail_after=2), 3)
+
+    comments = ['c{}'.format(i) for i in range(7)]
+    chunk_size = 3
+    if change == 'input':
+        comments = ['new c{}'.format(i) for i in range(8)]
+        write_input(data_path, comments)
+    else:
+        chunk_size = 4
+    analyzer = FakeAnalyzer()
+    chunked_extraction(data_path, output_path, analyzer, chunk_size)
+    assert sum(analyzer.chunks, []) == comments
+    assert pd.read_csv(output_path)['comment'].tolist() == comments
@@ -0,0 +1,72 @@
+import os
+
+import pandas as pd
+
+from src.dashboard_cubes import SENTIMENT_KEYS, aggregate, rollup, sum_cubes
+
+
+class FakePartials:
+    """Builds sentiment partials of the data files, recording the files it aggregates."""
+
+    def __init__(self):
+        self.built = []
+
+    def __call__(self, company, channel, path):
+        self.built.append(os.path.basename(path))
+        data = pd.read_csv(path)
+        data['company'] = company
+        data['channel'] = channel
+        return aggregate(data, SENTIMENT_KEYS, 'time', 'sentiment', 'score')
+
+
+def write_data(path, rows):
+    pd.DataFrame(rows, columns=['time', 'sentiment', 'score']).to_csv(path, index=False)
+
+
+def test_rollup_reuses_unchanged_partials(tmp_path):
+    cube_dir = str(tmp_path / 'cubes')
+    first, second = str(tmp_path / 'first.csv'), str(tmp_path / 'second.csv')
+    write_data(first, [('2023-01-01', 'positive', 5), ('2023-01-01', 'negative', 1)])
+    write_data(second, [('2023-01-01', 'positive', 4)])
+    data_files = [('a', 'facebook', first), ('b', 'tweet', second)]
+
+    partials = FakePartials()
+    cube = rollup(cube_dir, 'sentiment', data_files, partials, SENTIMENT_KEYS)
+    assert partials.built == ['first.csv', 'second.csv']
+    assert cube['count'].tolist() == [2, 1]
+
+    partials = FakePartials()
+    assert rollup(cube_dir, 'sentiment', data_files, partials, SENTIMENT_KEYS).equals(cube)
+    assert partials.built == []
+
+    write_data(second, [('2023-01-01', 'positive', 4), ('2023-01-02', 'neutral', 3)])
+    partials = FakePartials()
+    cube = rollup(cube_dir, 'sentiment', data_files, partials, SENTIMENT_KEYS)
+    assert partials.built == ['second.csv']
+    assert cube[['company', 'count', 'score_sum']].values.tolist() == [['a', 2, 6], ['b', 1, 4], ['b', 1, 3]]
+
+
+def test_rollup_deletes_partials_of_removed_files(tmp_path):
+    cube_dir = str(tmp_path / 'cubes')
+    first, second = str(tmp_path / 'first.csv'), str(tmp_path / 'second.csv')
+    write_data(first, [('2023-01-01', 'positive', 5)])
+    write_data(second, [('2023-01-01', 'negative', 1)])
+
+    rollup(cube_dir, 'sentiment', [('a', 'facebook', first), ('b', 'tweet', second)], FakePartials(), SENTIMENT_KEYS)
+    assert len(os.listdir(os.path.join(cube_dir, 'sentiment'))) == 3
+
+    cube = rollup(cube_dir, 'sentiment', [('a', 'facebook', first)], FakePartials(), SENTIMENT_KEYS)
+    assert cube['company'].tolist() == ['a']
+    assert len(os.listdir(os.path.join(cube_dir, 'sentiment'))) == 2
+
+
+def test_summed_chunk_cubes_match_the_whole_table():
+    data = pd.DataFrame({'time': ['2023-01-01', '2023-01-01', '2023-01-02', None, '2023-01-02'],
+                         'sentiment': ['positive', 'negative', 'positive', 'neutral', 'skipped'],
+                         'score': [5, 1, 4, 3, None], 'company': 'a', 'channel': 'tweet'})
+    whole = aggregate(data, SENTIMENT_KEYS, 'time', 'sentiment', 'score')
+
+    # the chunks of a streaming run miss some classes and days of the whole table
+    chunks = [aggregate(data.iloc[start:start + 2], SENTIMENT_KEYS, 'time', 'sentiment', 'score')
+              for start in range(0, len(data), 2)]
+    pd.testing.assert_frame_equal(sum_cubes(chunks, SENTIMENT_KEYS)[whole.columns], whole)
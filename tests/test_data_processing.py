@@ -0,0 +1,40 @@
+import json
+
+import pytest
+
+from src.data_processing import _iter_json_array
+
+ITEMS = [{'id': i, 'text': 'x' * (i * 7 % 40), 'nested': [1, {'a': None}]} for i in range(50)] + \
+        [12345, 'str', [], {}, 3.5, True, None, -1.25e10]
+
+
+@pytest.mark.parametrize('separator', [',', ' ,\n ', '\n,'])
+@pytest.mark.parametrize('buffer_size', [1, 2, 3, 7, 64, 1 << 20])
+def test_iter_json_array_items_cut_by_the_reads(tmp_path, separator, buffer_size):
+    path = tmp_path / 'dump.json'
+    path.write_text('[\n ' + separator.join(json.dumps(item) for item in ITEMS) + ' \n]\n')
+
+    assert list(_iter_json_array(str(path), buffer_size)) == ITEMS
+
+
+def test_iter_json_array_empty(tmp_path):
+    path = tmp_path / 'dump.json'
+    path.write_text(' []')
+
+    assert list(_iter_json_array(str(path), 1)) == []
+
+
+def test_iter_json_array_truncated(tmp_path):
+    path = tmp_path / 'dump.json'
+    path.write_text('[{"id": 1}, {"id": 2')
+
+    with pytest.raises(json.JSONDecodeError):
+        list(_iter_json_array(str(path), 4))
+
+
+def test_iter_json_array_not_an_array(tmp_path):
+    path = tmp_path / 'dump.json'
+    path.write_text('{"id": 1}')
+
+    with pytest.raises(ValueError):
+        list(_iter_json_array(str(path)))
@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from src.entity_index import ROW_COLUMNS, EntityIndex
+
+
+class FakeRows:
+    """Builds the entity rows of tiny csv data files, recording the files it reads."""
+
+    def __init__(self):
+        self.built = []
+
+    def __call__(self, company, channel, path):
+        self.built.append(company)
+        rows = pd.read_csv(path)
+        rows['company'] = company
+        rows['channel'] = channel
+        return rows[ROW_COLUMNS]
+
+
+def write_data(path, rows):
+    pd.DataFrame(rows, columns=['entity', 'type', 'time', 'sentiment', 'score']).to_csv(path, index=False)
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = EntityIndex(str(tmp_path / 'entities.sqlite'), 'entity_comment')
+    yield index
+    index.close()
+
+
+def test_update_reindexes_changed_files_and_drops_removed_ones(tmp_path, index):
+    first, second = str(tmp_path / 'first.csv'), str(tmp_path / 'second.csv')
+    write_data(first, [('spacex', 'ORG', '2023-01-01', 'positive', 5), ('nasa', 'ORG', '2023-01-02', 'negative', 1)])
+    write_data(second, [('spacex', 'ORG', '2023-01-03', 'neutral', 3)])
+    data_files = [('a', 'facebook', first), ('b', 'tweet', second)]
+
+    rows = FakeRows()
+    assert index.update(data_files, rows) == {'indexed': 2, 'reused': 0, 'removed': 0, 'rows': 3}
+    assert index.query('spacex')['company'].tolist() == ['a', 'b']
+
+    rows = FakeRows()
+    assert index.update(data_files, rows) == {'indexed': 0, 'reused': 2, 'removed': 0, 'rows': 0}
+    assert rows.built == []
+
+    write_data(first, [('spacex', 'ORG', '2023-01-05', 'negative', 1)])
+    rows = FakeRows()
+    assert index.update(data_files, rows) == {'indexed': 1, 'reused': 1, 'removed': 0, 'rows': 1}
+    assert rows.built == ['a']
+    assert index.query('spacex')[['company', 'time']].values.tolist() == [['a', '2023-01-05'], ['b', '2023-01-03']]
+    assert len(index.query('nasa')) == 0
+    assert index.last_day() == '2023-01-05'
+
+    assert index.update([('a', 'facebook', first)], FakeRows())['removed'] == 1
+    assert index.query()['company'].tolist() == ['a']
+    assert index.aggregate(['entity'])[['entity', 'count', 'score_sum']].values.tolist() == [['spacex', 1, 1.0]]
+
+
+def test_index_keeps_its_entity_column(tmp_path, index):
+    with pytest.raises(ValueError):
+        EntityIndex(str(tmp_path / 'entities.sqlite'), 'entity_post')
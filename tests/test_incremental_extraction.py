@@ -0,0 +1,57 @@
+import pandas as pd
+
+from src.incremental_extraction import incremental_extraction, row_keys
+
+ID_COL = 'id'
+COMMENT_COL = 'comment'
+
+
+class FakeAnalyzer:
+    """Stand in for an extraction backend recording the comments it analyzes."""
+
+    def __init__(self):
+        self.analyzed = []
+
+    def __call__(self, data):
+        self.analyzed.extend(data[COMMENT_COL])
+        data['sentiment'] = data[COMMENT_COL].str.len()
+        return data
+
+
+def run(tmp_path, rows):
+    data_path = str(tmp_path / 'data.csv')
+    output_path = str(tmp_path / 'output.csv')
+    pd.DataFrame(rows, columns=[ID_COL, 'reply', COMMENT_COL]).to_csv(data_path, index=False)
+    analyzer = FakeAnalyzer()
+    incremental_extraction(data_path, output_path, analyzer, ID_COL, COMMENT_COL)
+    return analyzer.analyzed, pd.read_csv(output_path)
+
+
+def test_row_keys_count_repeated_rows():
+    data = pd.DataFrame({ID_COL: [1, 1, 1, 2], COMMENT_COL: ['a', 'a', 'b', 'a']})
+    keys = row_keys(data, ID_COL, COMMENT_COL)
+
+    assert keys.str.rsplit('\x1f', n=1).str[1].tolist() == ['0', '1', '0', '0']
+    assert keys.is_unique
+
+
+def test_only_new_and_changed_rows_are_analyzed(tmp_path):
+    analyzed, output = run(tmp_path, [(1, 3, 'first'), (1, 3, 'second'), (2, 0, 'third')])
+    assert analyzed == ['first', 'second', 'third']
+
+    # a changed comment, a removed row and an updated reply count
+    analyzed, output = run(tmp_path, [(1, 5, 'first'), (2, 0, 'third changed')])
+    assert analyzed == ['third changed']
+    assert output.values.tolist() == [[1, 5, 'first', 5], [2, 0, 'third changed', 13]]
+
+
+def test_duplicate_rows_are_matched_by_occurrence(tmp_path):
+    run(tmp_path, [(1, 0, 'same'), (2, 0, 'other')])
+
+    analyzed, output = run(tmp_path, [(1, 0, 'same'), (1, 0, 'same'), (2, 0, 'other')])
+    assert analyzed == ['same']
+    assert output[COMMENT_COL].tolist() == ['same', 'same', 'other']
+
+    analyzed, output = run(tmp_path, [(1, 0, 'same'), (2, 0, 'other')])
+    assert analyzed == []
+    assert output[COMMENT_COL].tolist() == ['same', 'other']
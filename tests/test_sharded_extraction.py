@@ -0,0 +1,93 @@
+import os
+
+import pandas as pd
+import pytest
+
+from src.sharded_extraction import (DONE, FAILED, LEASED, PENDING, ShardQueue, merge_shards, run_shard_worker,
+                                    shards_dir, split_shards)
+
+
+def analyze(data):
+    if (data['comment'] == 'bad').any():
+        raise RuntimeError('analysis failed')
+    data['sentiment'] = data['comment'].str.len()
+    return data
+
+
+def split(tmp_path, comments, max_attempts=3):
+    data_path = str(tmp_path / 'data.csv')
+    output_path = str(tmp_path / 'output.csv')
+    pd.DataFrame({'id': range(len(comments)), 'comment': comments}).to_csv(data_path, index=False)
+    split_shards(data_path, output_path, 2, 60, max_attempts)
+    return data_path, output_path
+
+
+def states(output_path):
+    queue = ShardQueue(shards_dir(output_path))
+    try:
+        return queue._execute('SELECT state, attempts FROM shards ORDER BY shard').fetchall()
+    finally:
+        queue.close()
+
+
+def test_workers_analyze_every_shard_once(tmp_path):
+    comments = ['c{}'.format(i) for i in range(5)]
+    _, output_path = split(tmp_path, comments)
+
+    first = run_shard_worker(output_path, analyze, max_shards=1)
+    second = run_shard_worker(output_path, analyze)
+    assert (first['shards'], second['shards']) == (1, 2)
+    assert states(output_path) == [(DONE, 1)] * 3
+
+    assert merge_shards(output_path) == 3
+    assert pd.read_csv(output_path)['comment'].tolist() == comments
+    assert not os.path.exists(shards_dir(output_path))
+
+
+def test_expired_leases_are_requeued_then_failed(tmp_path):
+    _, output_path = split(tmp_path, ['c0', 'c1'], max_attempts=2)
+    queue = ShardQueue(shards_dir(output_path))
+    try:
+        # negative leases are expired by the next claim
+        assert queue.claim('crashed', -1, 2) == 0
+        assert queue.claim('other', -1, 2) == 0
+        assert queue._execute('SELECT worker, attempts FROM shards').fetchone() == ('other', 2)
+        assert queue.claim('last', 60, 2) is None
+        assert queue.failed() == [(0, 'lease expired')]
+        # the worker that lost its lease can't finish the shard
+        assert not queue.finish(0, 'other', 1.0)
+    finally:
+        queue.close()
+
+
+def test_failing_shard_is_failed_after_max_attempts(tmp_path):
+    data_path, output_path = split(tmp_path, ['c0', 'c1', 'bad', 'c3'], max_attempts=2)
+
+    report = run_shard_worker(output_path, analyze)
+    assert (report['shards'], report['failed']) == (1, 2)
+    assert states(output_path) == [(DONE, 1), (FAILED, 2)]
+    with pytest.raises(ValueError, match='shard 1'):
+        merge_shards(output_path)
+
+    # splitting the same input again retries the failed shard with fresh attempts
+    split_shards(data_path, output_path, 2, 60, 2)
+    assert states(output_path) == [(DONE, 1), (PENDING, 0)]
+
+
+def test_interrupted_worker_gives_the_attempt_back(tmp_path):
+    _, output_path = split(tmp_path, ['c0', 'c1'])
+
+    def interrupted(data):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        run_shard_worker(output_path, interrupted)
+    assert states(output_path) == [(PENDING, 0)]
+
+    queue = ShardQueue(shards_dir(output_path))
+    try:
+        assert queue.claim('worker', 60, 3) == 0
+        assert not queue.give_back(0, 'another worker')
+        assert queue.counts()[LEASED] == 1
+    finally:
+        queue.close()
@@ -0,0 +1,19 @@
+import pandas as pd
+
+from src.dashboard_data_prepare import _explode_entities
+from src.table_io import _entity_structs, split_entity
+
+
+def test_split_entity_first_comma():
+    assert split_entity('Contoso,Organization') == ('Contoso', 'Organization')
+    assert split_entity('Washington, D.C.,GPE') == ('Washington', ' D.C.')
+    assert split_entity('Contoso') == ('Contoso', None)
+
+
+def test_explode_entities_same_for_csv_and_parquet():
+    entities = ['Contoso,Organization|Washington, D.C.,GPE', 'Fabrikam,Organization']
+    csv = _explode_entities(pd.DataFrame({'entity': entities}), 'entity')
+    parquet = _explode_entities(pd.DataFrame({'entity': [_entity_structs(value) for value in entities]}), 'entity')
+
+    pd.testing.assert_frame_equal(csv, parquet)
+    assert list(csv['type']) == ['Organization', ' D.C.', 'Organization']